@@ -0,0 +1,77 @@
+"""Micro-benchmark of the memoized Accept / Content-Type negotiation.
+
+Compares ``negotiate_media_type`` and ``content_media_type``, which the
+api entrypoints negotiate requests with, against their unmemoized versions
+on headers sent by real browsers, SDKs and tools::
+
+    $ python benchmarks/bench_negotiation.py
+"""
+import argparse
+import sys
+import timeit
+
+from nameko_http.serialization import content_media_type, negotiate_media_type
+from nameko_http.utils import negotiation_cache_info
+
+
+ACCEPT_HEADERS = [
+    # browsers
+    'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8',
+    'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+    'application/json, text/plain, */*',  # axios
+    'application/json, text/javascript, */*; q=0.01',  # jQuery
+    '*/*',  # fetch, curl
+    # SDKs and tools
+    'application/json',
+    'application/json;charset=UTF-8',
+    'application/vnd.github+json',
+    'application/hal+json, application/json;q=0.9',
+    'text/plain',
+    'application/xml',
+    'application/json, application/*+json',
+]
+
+CONTENT_TYPE_HEADERS = [
+    'application/json',
+    'application/json; charset=utf-8',
+    'application/json;charset=UTF-8',
+    'application/merge-patch+json',
+    'application/vnd.api+json',
+    'text/plain; charset=utf-8',
+    'application/x-www-form-urlencoded',
+    'multipart/form-data; boundary=----WebKitFormBoundary7MA4YWxkTrZu0gW',
+]
+
+
+def bench(func, corpus, number):
+    def run():
+        for header in corpus:
+            func(header)
+    return min(timeit.repeat(run, number=number, repeat=5)) / (number * len(corpus))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=2000)
+    args = parser.parse_args()
+
+    ok = True
+    for func, corpus in (
+            (negotiate_media_type, ACCEPT_HEADERS),
+            (content_media_type, CONTENT_TYPE_HEADERS)):
+        uncached = bench(func.__wrapped__, corpus, args.number)
+        cached = bench(func, corpus, args.number)
+        speedup = uncached / cached
+        ok = ok and speedup > 1
+        print('{:<22} uncached {:>8.0f} ns  memoized {:>6.0f} ns  speedup {:>5.1f}x'.format(
+            func.__name__, uncached * 1e9, cached * 1e9, speedup
+        ))
+
+    for name, info in negotiation_cache_info().items():
+        print('{:<22} hit rate {:.4f}'.format(name, info['hit_rate']))
+
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
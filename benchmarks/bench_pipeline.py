@@ -0,0 +1,136 @@
+"""Throughput and latency of the HttpApiEntrypoint request pipeline.
+
+Starts an example service and drives it over a local socket with keep-alive
+connections, one scenario at a time.
+"""
+import http.client
+import json
+import time
+
+import eventlet
+import pytest
+
+from nameko_http import api
+from nameko_http.exceptions import HttpError
+from nameko_http.utils import api_response, get_json
+
+
+LARGE_PAYLOAD = [
+    {'id': i, 'name': 'item {}'.format(i), 'tags': ['a', 'b', 'c'], 'price': i * 1.5}
+    for i in range(5000)
+]
+
+
+class HttpConflict(HttpError):
+    error_code = 'CONFLICT'
+    status_code = 409
+
+
+class BenchService(object):
+    name = 'benchservice'
+
+    @api('GET', '/items/<int:item_id>', cors_enabled=True)
+    def get_item(self, request, item_id):
+        return api_response(status=200, data={'id': item_id, 'name': 'item'})
+
+    @api('POST', '/items')
+    def create_item(self, request):
+        return api_response(status=201, data=get_json(request))
+
+    @api('GET', '/error')
+    def error(self, request):
+        raise HttpConflict('Item already exists')
+
+    @api('GET', '/large')
+    def large(self, request):
+        return api_response(status=200, data=LARGE_PAYLOAD)
+
+
+SCENARIOS = {
+    'plain_get': ('GET', '/items/42', None, {}, 200),
+    'json_post': (
+        'POST', '/items',
+        json.dumps({'name': 'item', 'tags': ['a', 'b'], 'price': 10.5}),
+        {'Content-Type': 'application/json'},
+        201,
+    ),
+    'cors_preflight': (
+        'OPTIONS', '/items/42', None,
+        {
+            'Origin': 'https://app.example.com',
+            'Access-Control-Request-Method': 'GET',
+            'Access-Control-Request-Headers': 'Authorization, Content-Type',
+        },
+        200,
+    ),
+    'error_response': ('GET', '/error', None, {}, 409),
+    'large_payload': ('GET', '/large', None, {}, 200),
+}
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def drive(port, method, path, body, headers, expected_status, requests, concurrency):
+    """Sends ``requests`` requests over ``concurrency`` keep-alive
+    connections and returns throughput and latency percentiles.
+    """
+    headers = dict({'Accept': 'application/json'}, **headers)
+    latencies = []
+    errors = []
+    per_connection = max(1, requests // concurrency)
+
+    def client():
+        conn = http.client.HTTPConnection('127.0.0.1', port)
+        try:
+            for _ in range(per_connection):
+                start = time.perf_counter()
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                response.read()
+                latencies.append(time.perf_counter() - start)
+                if response.status != expected_status:
+                    errors.append(response.status)
+        finally:
+            conn.close()
+
+    pool = eventlet.GreenPool(concurrency)
+    start = time.perf_counter()
+    for _ in range(concurrency):
+        pool.spawn(client)
+    pool.waitall()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'rps': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+    }
+
+
+@pytest.fixture
+def service_port(container_factory, web_config, web_config_port):
+    container = container_factory(BenchService, web_config)
+    container.start()
+    return web_config_port
+
+
+@pytest.mark.parametrize('scenario', sorted(SCENARIOS))
+def test_pipeline(request, service_port, bench_results, scenario):
+    method, path, body, headers, expected_status = SCENARIOS[scenario]
+    requests = request.config.getoption('--bench-requests')
+    concurrency = request.config.getoption('--bench-concurrency')
+
+    # warm up connections and caches
+    drive(service_port, method, path, body, headers, expected_status, 50, 1)
+    result = drive(
+        service_port, method, path, body, headers, expected_status, requests, concurrency
+    )
+
+    assert result['errors'] == 0
+    bench_results[scenario] = result
@@ -0,0 +1,65 @@
+"""Micro-benchmark of the overhead the profiling hook adds to requests.
+
+Times what ``HttpApiEntrypoint.handle_request`` runs around each request,
+with profiling off, configured but not sampling the request, watching it
+with the stack sampler, and profiling it with cProfile::
+
+    $ python benchmarks/bench_profiling.py
+"""
+import argparse
+import sys
+import tempfile
+import timeit
+
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request
+
+from nameko_http.profiling import Profiler
+
+
+def handler():
+    return sum(range(200))
+
+
+def hook(profiler, request):
+    """Runs ``handler`` the way ``handle_request`` wraps it."""
+    def run():
+        profile = profiler.start(request) if profiler is not None else None
+        try:
+            handler()
+        finally:
+            if profile is not None:
+                profile.stop()
+        if profile is not None:
+            profiler.save(profile, '/bench', request, 200, 0.001)
+    return run
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=20000)
+    args = parser.parse_args()
+
+    request = Request(EnvironBuilder(path='/bench').get_environ())
+    directory = tempfile.mkdtemp()
+    setups = [
+        ('off', None),
+        ('not sampled', Profiler(directory, sample_rate=0.0, token='secret')),
+        ('sampled at 1%', Profiler(directory, sample_rate=0.01, max_files=10)),
+        ('slow capture', Profiler(directory, slow_threshold=1.0)),
+        ('cProfile', Profiler(directory, sample_rate=1.0, max_files=10)),
+    ]
+
+    baseline = min(timeit.repeat(handler, number=args.number, repeat=5)) / args.number
+    print('{:<14} {:>12} {:>12}'.format('profiling', 'us/request', 'overhead us'))
+    for name, profiler in setups:
+        number = args.number if name != 'cProfile' else args.number // 100
+        elapsed = min(timeit.repeat(hook(profiler, request), number=number, repeat=5)) / number
+        print('{:<14} {:>12.2f} {:>12.2f}'.format(
+            name, elapsed * 1e6, (elapsed - baseline) * 1e6,
+        ))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
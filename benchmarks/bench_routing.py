@@ -0,0 +1,88 @@
+"""Micro-benchmark of route matching as the number of routes grows.
+
+Compares the werkzeug url map nameko builds against ``CompiledRouter`` on
+services with an increasing number of static and dynamic routes, matching
+requests to the first, middle and last routes registered. Routes either
+start with a segment of their own, or all share an ``/api/v1`` prefix::
+
+    $ python benchmarks/bench_routing.py --routes 10 100 400 1000
+"""
+import argparse
+import sys
+import timeit
+
+from werkzeug.routing import Map, Rule
+
+from nameko_http.routing import CompiledRouter
+
+
+PREFIXES = {
+    'distinct': '',
+    'shared': '/api/v1',
+}
+
+
+def build_map(count, prefix):
+    """Builds a url map of ``count`` routes under ``prefix``, as ``@api``
+    entrypoints with CORS enabled register them, half static and half
+    dynamic.
+    """
+    rules = []
+    for index in range(count // 2):
+        rules.append(Rule(
+            '{}/resource{}/items'.format(prefix, index),
+            endpoint='list{}'.format(index), methods=['OPTIONS', 'GET'],
+        ))
+        rules.append(Rule(
+            '{}/resource{}/items/<int:item_id>'.format(prefix, index),
+            endpoint='get{}'.format(index), methods=['OPTIONS', 'GET'],
+        ))
+    return Map(rules)
+
+
+def requests_for(count, prefix):
+    half = count // 2
+    return [
+        prefix + path.format(index)
+        for index in (0, half // 2, half - 1)
+        for path in ('/resource{}/items', '/resource{}/items/42')
+    ]
+
+
+def bench(match, paths, number):
+    def run():
+        for path in paths:
+            match(path, 'GET')
+    return min(timeit.repeat(run, number=number, repeat=5)) / (number * len(paths))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--routes', type=int, nargs='+', default=[10, 100, 400, 1000])
+    parser.add_argument('--number', type=int, default=2000)
+    args = parser.parse_args()
+
+    print('{:>9} {:>7} {:>14} {:>14} {:>8}'.format(
+        'prefix', 'routes', 'werkzeug us', 'compiled us', 'speedup'
+    ))
+    for layout, prefix in PREFIXES.items():
+        for count in args.routes:
+            url_map = build_map(count, prefix)
+            adapter = url_map.bind('localhost')
+            router = CompiledRouter(url_map)
+            paths = requests_for(count, prefix)
+
+            for path in paths:
+                assert router.match(path, 'GET') == adapter.match(path, 'GET')
+
+            werkzeug_time = bench(adapter.match, paths, args.number)
+            compiled_time = bench(router.match, paths, args.number)
+            print('{:>9} {:>7} {:>14.2f} {:>14.2f} {:>7.1f}x'.format(
+                layout, count, werkzeug_time * 1e6, compiled_time * 1e6,
+                werkzeug_time / compiled_time,
+            ))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
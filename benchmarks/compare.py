@@ -0,0 +1,56 @@
+"""Compares two benchmark result files and fails on regressions.
+
+A scenario regresses when its throughput drops, or its p99 latency grows,
+by more than the threshold::
+
+    $ python benchmarks/compare.py baseline.json results.json --threshold 0.1
+"""
+import argparse
+import json
+import sys
+
+
+def compare(baseline, current, threshold):
+    """Returns ``(rows, regressions)`` for the scenarios in both files."""
+    rows = []
+    regressions = []
+    for name in sorted(set(baseline['scenarios']) & set(current['scenarios'])):
+        before = baseline['scenarios'][name]
+        after = current['scenarios'][name]
+        rps_change = after['rps'] / before['rps'] - 1
+        p99_change = after['p99_ms'] / before['p99_ms'] - 1
+        rows.append((name, before['rps'], after['rps'], rps_change,
+                     before['p99_ms'], after['p99_ms'], p99_change))
+        if rps_change < -threshold or p99_change > threshold:
+            regressions.append(name)
+    return rows, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('baseline')
+    parser.add_argument('current')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Allowed relative change, 0.1 being 10%%.')
+    args = parser.parse_args()
+
+    with open(args.baseline) as fp:
+        baseline = json.load(fp)
+    with open(args.current) as fp:
+        current = json.load(fp)
+
+    rows, regressions = compare(baseline, current, args.threshold)
+    print('{:<18} {:>10} {:>10} {:>8} {:>9} {:>9} {:>8}'.format(
+        'scenario', 'req/s', 'req/s', 'change', 'p99 ms', 'p99 ms', 'change'
+    ))
+    for name, rps_before, rps_after, rps_change, p99_before, p99_after, p99_change in rows:
+        print('{:<18} {:>10.0f} {:>10.0f} {:>+7.1%} {:>9.2f} {:>9.2f} {:>+7.1%}{}'.format(
+            name, rps_before, rps_after, rps_change, p99_before, p99_after, p99_change,
+            '  REGRESSION' if name in regressions else '',
+        ))
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,59 @@
+"""Pytest plugin collecting benchmark results and writing them as JSON.
+
+Run with::
+
+    $ nameko test benchmarks -o python_files='bench_*.py' --bench-output=results.json
+"""
+import datetime
+import json
+import platform
+import subprocess
+
+import pytest
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('benchmarks')
+    group.addoption('--bench-output', default=None,
+                    help='Write benchmark results to this JSON file.')
+    group.addoption('--bench-requests', type=int, default=2000,
+                    help='Requests sent per scenario.')
+    group.addoption('--bench-concurrency', type=int, default=10,
+                    help='Concurrent client connections per scenario.')
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL
+        ).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@pytest.fixture(scope='session')
+def bench_results(request):
+    results = {}
+    yield results
+
+    summary = ['', 'scenario              req/s     p50 ms    p99 ms']
+    for name, result in sorted(results.items()):
+        summary.append('{:<18} {:>9.0f} {:>10.2f} {:>9.2f}'.format(
+            name, result['rps'], result['p50_ms'], result['p99_ms']
+        ))
+    print('\n'.join(summary))
+
+    output = request.config.getoption('--bench-output')
+    if output:
+        with open(output, 'w') as fp:
+            json.dump({
+                'meta': {
+                    'commit': git_commit(),
+                    'python': platform.python_version(),
+                    'platform': platform.platform(),
+                    'timestamp': datetime.datetime.utcnow().isoformat(),
+                    'requests': request.config.getoption('--bench-requests'),
+                    'concurrency': request.config.getoption('--bench-concurrency'),
+                },
+                'scenarios': results,
+            }, fp, indent=2, sort_keys=True)
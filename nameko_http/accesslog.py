@@ -0,0 +1,206 @@
+import random
+import sys
+import time
+import uuid
+from collections import deque
+from logging import getLogger
+
+import eventlet
+from eventlet import tpool
+from nameko.exceptions import ConfigurationError
+
+from nameko_http import constants, serialization
+
+
+_log = getLogger(__name__)
+
+OVERFLOW_POLICIES = ('drop_newest', 'drop_oldest')
+
+# entries of errors are always kept
+SAMPLED_STATUS_CLASSES = ('1xx', '2xx', '3xx')
+
+
+class AccessLog(object):
+    """Access log buffering entries in memory, written as JSON lines in
+    batches by a background green thread so that requests never wait for
+    the log to be written.
+
+    The buffer is bounded by ``max_entries``: once full, ``drop_newest``
+    drops the entries logged until it is flushed, ``drop_oldest`` the oldest
+    entries buffered. Entries of successful requests can be sampled with
+    ``sample_rates``, mapping status classes such as ``'2xx'`` to the
+    fraction of entries kept, error entries always being kept.
+
+    Args:
+        path (str): File entries are appended to, ``'-'`` for stdout.
+        stream: Binary stream entries are written to, instead of ``path``.
+        max_entries (int): Entries buffered before dropping.
+        overflow (str): ``'drop_newest'`` or ``'drop_oldest'``.
+        sample_rates (dict): Fraction of entries kept per status class.
+        batch_size (int): Entries written at once.
+        flush_interval (float): Seconds between flushes.
+        request_id_header (str): Request header holding the request id.
+
+    Raises:
+        ConfigurationError: Unknown overflow policy, error status class
+            sampled, or neither ``path`` nor ``stream`` given.
+    """
+
+    def __init__(self, path=None, stream=None,
+                 max_entries=constants.ACCESS_LOG_MAX_ENTRIES, overflow='drop_newest',
+                 sample_rates=None, batch_size=constants.ACCESS_LOG_BATCH_SIZE,
+                 flush_interval=constants.ACCESS_LOG_FLUSH_INTERVAL,
+                 request_id_header=constants.ACCESS_LOG_REQUEST_ID_HEADER):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ConfigurationError('Unknown access log overflow policy `{}`'.format(overflow))
+        if path is None and stream is None:
+            raise ConfigurationError('Access log needs a `path` or a `stream`')
+        for status_class in sample_rates or {}:
+            if status_class not in SAMPLED_STATUS_CLASSES:
+                raise ConfigurationError(
+                    'Access log can only sample {}, not `{}`'.format(
+                        ', '.join(SAMPLED_STATUS_CLASSES), status_class
+                    )
+                )
+
+        self.path = path
+        self.stream = stream
+        self.max_entries = max_entries
+        self.overflow = overflow
+        self.sample_rates = {
+            int(status_class[0]): rate for status_class, rate in (sample_rates or {}).items()
+        }
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.request_id_header = request_id_header
+        self.entries = deque(maxlen=max_entries if overflow == 'drop_oldest' else None)
+        self.logged = 0
+        self.dropped = 0
+        self.sampled_out = 0
+        self.written = 0
+        self._file = None
+        self._gt = None
+        self._running = False
+        self._flushing = False
+
+    @classmethod
+    def from_config(cls, value):
+        """Build an access log out of the ``HTTP_ACCESS_LOG`` config value: a
+        dict of keyword arguments or the path of the log file.
+        """
+        if isinstance(value, dict):
+            return cls(**value)
+        return cls(path=value)
+
+    def log(self, request, route, response, duration):
+        """Buffers the entry of a request, unless sampled out or dropped."""
+        rate = self.sample_rates.get(response.status_code // 100)
+        if rate is not None and random.random() >= rate:
+            self.sampled_out += 1
+            return
+
+        entries = self.entries
+        if len(entries) >= self.max_entries:
+            self.dropped += 1
+            if self.overflow == 'drop_newest':
+                return
+        entries.append(self.entry(request, route, response, duration))
+        self.logged += 1
+
+    def start(self):
+        if self.stream is None:
+            if self.path == '-':
+                self.stream = sys.stdout.buffer
+            else:
+                self.stream = self._file = open(self.path, 'ab')
+        self._running = True
+        self._gt = eventlet.spawn(self.run)
+
+    def stop(self):
+        """Stops the flusher, writing the entries still buffered."""
+        self._running = False
+        if self._gt is not None:
+            # a batch being written would be lost if killed
+            if self._flushing:
+                self._gt.wait()
+            else:
+                self._gt.kill()
+            self._gt = None
+        try:
+            self.flush()
+        except Exception:  # pylint: disable=broad-except
+            _log.exception('Could not write the access log')
+        self.close()
+
+    def kill(self):
+        """Stops the flusher at once, dropping the entries still buffered."""
+        self._running = False
+        if self._gt is not None:
+            self._gt.kill()
+            self._gt = None
+        if self.entries:
+            _log.warning('Access log killed, %d entries dropped', len(self.entries))
+            self.entries.clear()
+        self.close()
+
+    def close(self):
+        if self._file is not None:
+            try:
+                self._file.close()
+            except Exception:  # pylint: disable=broad-except
+                _log.exception('Could not close the access log')
+            self._file = None
+
+    def run(self):
+        while self._running:
+            eventlet.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:  # pylint: disable=broad-except
+                _log.exception('Could not write the access log')
+
+    def flush(self):
+        """Writes the buffered entries in batches of ``batch_size``."""
+        entries = self.entries
+        self._flushing = True
+        try:
+            while entries:
+                batch = [entries.popleft() for _ in range(min(self.batch_size, len(entries)))]
+                data = b'\n'.join(serialization.dumps(entry) for entry in batch) + b'\n'
+                # file writes block the process, they are left to a native thread
+                tpool.execute(self._write, data)
+                self.written += len(batch)
+        finally:
+            self._flushing = False
+
+    def _write(self, data):
+        self.stream.write(data)
+        self.stream.flush()
+
+    def request_id(self, request):
+        """Returns the id the client sent in the request id header, or a new one."""
+        return request.headers.get(self.request_id_header) or uuid.uuid4().hex
+
+    def entry(self, request, route, response, duration):
+        """Returns the access log entry of a request."""
+        return {
+            'time': time.time(),
+            'request_id': request.request_id,
+            'method': request.method,
+            'route': route,
+            'path': request.path,
+            'status': response.status_code,
+            'duration': duration,
+            'bytes_in': request.content_length or 0,
+            'bytes_out': response.content_length or 0,
+            'client': request.remote_addr,
+        }
+
+    def stats(self):
+        return {
+            'buffered': len(self.entries),
+            'logged': self.logged,
+            'dropped': self.dropped,
+            'sampled_out': self.sampled_out,
+            'written': self.written,
+        }
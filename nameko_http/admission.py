@@ -0,0 +1,131 @@
+from eventlet.semaphore import Semaphore
+from nameko.exceptions import ConfigurationError
+
+from nameko_http import constants
+from nameko_http.exceptions import HttpServiceUnavailable
+
+
+class Limiter(object):
+    """Limits the number of requests being handled at once, queueing the
+    ones above the limit and shedding them with ``HttpServiceUnavailable``
+    once the queue is full or they have waited too long.
+
+    Args:
+        name (str): Name the limiter is reported under.
+        max_concurrency (int): Requests handled at once.
+        max_queue (int): Requests waiting for a slot, ``None`` for unbounded.
+        max_queue_time (float): Seconds a request may wait for a slot,
+            ``None`` for no limit.
+        retry_after (int): Value of the ``Retry-After`` header of shed requests.
+    """
+
+    def __init__(self, name, max_concurrency, max_queue=None, max_queue_time=None,
+                 retry_after=constants.ADMISSION_RETRY_AFTER):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_queue_time = max_queue_time
+        self.retry_after = retry_after
+        self.semaphore = Semaphore(max_concurrency)
+        self.in_flight = 0
+        self.queued = 0
+        self.admitted = 0
+        self.shed = 0
+
+    @classmethod
+    def from_config(cls, name, value):
+        """Build a limiter out of the ``admission`` api argument or the
+        ``HTTP_ADMISSION`` config value: a limiter, a dict of keyword
+        arguments or the maximum concurrency.
+        """
+        if isinstance(value, cls):
+            return value
+        if isinstance(value, dict):
+            return cls(name, **value)
+        return cls(name, max_concurrency=value)
+
+    def acquire(self):
+        """Takes a slot, waiting for one if needed.
+
+        Raises:
+            HttpServiceUnavailable: The queue is full or the request waited
+                longer than ``max_queue_time``.
+        """
+        if not self.semaphore.acquire(blocking=False):
+            if self.max_queue is not None and self.queued >= self.max_queue:
+                self.reject('Too many requests queued')
+
+            self.queued += 1
+            try:
+                acquired = self.semaphore.acquire(timeout=self.max_queue_time)
+            finally:
+                self.queued -= 1
+            if not acquired:
+                self.reject('Request queued for too long')
+
+        self.in_flight += 1
+        self.admitted += 1
+
+    def release(self):
+        self.in_flight -= 1
+        self.semaphore.release()
+
+    def reject(self, reason):
+        self.shed += 1
+        raise HttpServiceUnavailable(reason, retry_after=self.retry_after)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    @property
+    def utilisation(self):
+        return float(self.in_flight) / self.max_concurrency
+
+    def stats(self):
+        return {
+            'in_flight': self.in_flight,
+            'queued': self.queued,
+            'admitted': self.admitted,
+            'shed': self.shed,
+            'utilisation': self.utilisation,
+        }
+
+
+class Bulkhead(Limiter):
+    """Slice of the service workers dedicated to a route or a named group of
+    routes, so that slow routes can't take the workers of the others.
+
+    Args:
+        name (str): Name of the pool.
+        size (int): Workers the routes of the pool can use at once.
+        overflow (str): What happens to requests once all workers of the pool
+            are busy, ``'queue'`` them or ``'reject'`` them straight away.
+        max_queue (int): Requests waiting for a worker, when queueing.
+        max_queue_time (float): Seconds a request may wait, when queueing.
+        retry_after (int): Value of the ``Retry-After`` header of rejected requests.
+    """
+
+    def __init__(self, name, size, overflow='queue', max_queue=None, max_queue_time=None,
+                 retry_after=constants.ADMISSION_RETRY_AFTER):
+        if overflow not in ('queue', 'reject'):
+            raise ConfigurationError(
+                'Unknown overflow `{}` of pool `{}`. Should be `queue` or `reject`'.format(
+                    overflow, name)
+            )
+        if overflow == 'reject':
+            max_queue = 0
+        self.overflow = overflow
+        super().__init__(name, size, max_queue, max_queue_time, retry_after)
+
+    @classmethod
+    def from_config(cls, name, value):
+        """Build a pool out of the ``pool`` api argument or an ``HTTP_POOLS``
+        entry: a dict of keyword arguments or the size of the pool.
+        """
+        if isinstance(value, dict):
+            return cls(name, **value)
+        return cls(name, size=value)
@@ -0,0 +1,196 @@
+from eventlet import GreenPool
+from werkzeug.datastructures import Headers
+from werkzeug.exceptions import HTTPException, MethodNotAllowed
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request, Response
+
+from nameko_http import constants
+from nameko_http.exceptions import HttpBadBatch, HttpError, HttpPayloadTooLarge
+from nameko_http.utils import limit_body_size
+
+
+# Headers of the batch request that sub-requests don't inherit, they describe
+# the batch body or would make sub-responses unreadable inside the batch one.
+NOT_INHERITED_HEADERS = (
+    'Content-Type', 'Content-Length', 'Transfer-Encoding', 'Accept-Encoding',
+    'If-None-Match', 'If-Modified-Since',
+)
+
+
+def error_body(error_code, reason):
+    return {'error_code': error_code, 'reason': reason}
+
+
+def error_response(exc, dumps):
+    return Response(
+        dumps(error_body(exc.error_code, str(exc))),
+        status=exc.status_code,
+        headers=exc.headers,
+        mimetype='application/json',
+    )
+
+
+def error_result(status, error_code, reason):
+    return {'status': status, 'headers': {}, 'body': error_body(error_code, reason)}
+
+
+class BatchHandler(object):
+    """Serves the batch route of the web server.
+
+    The batch request body is a JSON array of sub-requests, objects with a
+    ``method``, a ``path`` (with an optional query string), ``headers`` and a
+    ``body``. Each of them is dispatched through the url map to its api
+    entrypoint, as if it had been sent on its own, and the response is a
+    JSON array of ``{status, headers, body}`` results in the same order.
+
+    Args:
+        server (WebServer): Server the batch route belongs to.
+        url_map (werkzeug.routing.Map): Routes of the api entrypoints.
+        path (str): Path of the batch route.
+        max_size (int): Maximum number of sub-requests in a batch.
+        concurrency (int): Sub-requests handled at once, ``1`` handling them
+            one after the other.
+        max_body_size (int): Maximum size in bytes of the batch body.
+    """
+
+    def __init__(self, server, url_map, path, max_size=constants.BATCH_MAX_SIZE,
+                 concurrency=constants.BATCH_CONCURRENCY,
+                 max_body_size=constants.BATCH_MAX_BODY_SIZE):
+        self.server = server
+        self.url_map = url_map
+        self.path = path
+        self.max_size = max_size
+        self.concurrency = concurrency
+        self.max_body_size = max_body_size
+
+    @classmethod
+    def from_config(cls, server, url_map, value):
+        """Build a handler out of the ``HTTP_BATCH`` config value: the path
+        of the batch route or a dict of keyword arguments.
+        """
+        if isinstance(value, dict):
+            return cls(server, url_map, **value)
+        return cls(server, url_map, path=value)
+
+    def __call__(self, environ, start_response):
+        request = Request(environ)
+        try:
+            if request.method != 'POST':
+                raise MethodNotAllowed(valid_methods=['POST'])
+            items = self.parse(request)
+            response = Response(
+                self.server.media_codecs.dumps(self.handle(request, items)),
+                mimetype='application/json',
+            )
+        except HTTPException as exc:
+            response = exc
+        except HttpError as exc:
+            response = error_response(exc, self.server.media_codecs.dumps)
+        return response(environ, start_response)
+
+    def parse(self, request):
+        limit_body_size(request, self.max_body_size)
+        try:
+            items = self.server.media_codecs.loads(request.get_data())
+        except ValueError:
+            raise HttpBadBatch('Batch body should be a JSON array')
+        if not isinstance(items, list):
+            raise HttpBadBatch('Batch body should be a JSON array')
+        if len(items) > self.max_size:
+            raise HttpPayloadTooLarge(
+                'Batch of {} requests exceeds the limit of {}'.format(len(items), self.max_size)
+            )
+        return items
+
+    def handle(self, request, items):
+        """Returns the results of the sub-requests ``items`` of ``request``."""
+        headers = Headers(request.headers)
+        for name in NOT_INHERITED_HEADERS:
+            headers.remove(name)
+
+        def handle_item(item):
+            return self.handle_item(request, headers, item)
+
+        if self.concurrency <= 1 or len(items) <= 1:
+            return [handle_item(item) for item in items]
+        pool = GreenPool(min(self.concurrency, len(items)))
+        return list(pool.imap(handle_item, items))
+
+    def handle_item(self, request, headers, item):
+        if not isinstance(item, dict) or not isinstance(item.get('path'), str):
+            return error_result(400, 'BAD_REQUEST', 'Sub-request should have a `path`')
+        if item['path'].split('?', 1)[0] == self.path:
+            return error_result(400, 'BAD_REQUEST', 'Batches can not be nested')
+
+        try:
+            environ = self.make_environ(request, headers, item)
+        except (AttributeError, TypeError, ValueError) as exc:
+            return error_result(400, 'BAD_REQUEST', 'Invalid sub-request: {}'.format(exc))
+
+        sub_request = Request(environ, shallow=True)
+        adapter = self.url_map.bind_to_environ(environ)
+        try:
+            provider, values = adapter.match()
+            sub_request.path_values = values
+            response = provider.handle_request(sub_request)
+        except HTTPException as exc:
+            return error_result(
+                exc.code, exc.name.upper().replace(' ', '_'), exc.description
+            )
+        except Exception as exc:  # pylint: disable=broad-except
+            return error_result(500, 'UNEXPECTED_ERROR', str(exc))
+
+        try:
+            return self.result(response)
+        except ValueError:
+            return error_result(
+                500, 'UNEXPECTED_ERROR', 'Could not decode the sub-request response body'
+            )
+
+    def make_environ(self, request, headers, item):
+        headers = Headers(headers)
+        for name, value in (item.get('headers') or {}).items():
+            headers.set(name, value)
+        # sub-responses are embedded decoded in the batch response
+        headers.remove('Accept-Encoding')
+
+        body = item.get('body')
+        if body is None:
+            data = b''
+        elif isinstance(body, str):
+            data = body.encode('utf-8')
+        else:
+            data = self.server.media_codecs.dumps(body)
+            headers.setdefault('Content-Type', 'application/json')
+
+        builder = EnvironBuilder(
+            path=item['path'],
+            method=item.get('method', 'GET').upper(),
+            headers=headers,
+            data=data,
+            environ_base={
+                'REMOTE_ADDR': request.environ.get('REMOTE_ADDR'),
+                'wsgi.url_scheme': request.scheme,
+            },
+        )
+        try:
+            return builder.get_environ()
+        finally:
+            builder.close()
+
+    def result(self, response):
+        data = response.get_data()
+        codecs = self.server.media_codecs.codecs
+        if not data:
+            body = None
+        elif (
+            response.mimetype in codecs and
+            'Content-Encoding' not in response.headers
+        ):
+            body = codecs[response.mimetype].loads(data)
+        else:
+            body = data.decode(response.charset or 'utf-8', 'replace')
+
+        headers = dict(response.headers)
+        headers.pop('Content-Length', None)
+        return {'status': response.status_code, 'headers': headers, 'body': body}
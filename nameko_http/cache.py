@@ -0,0 +1,160 @@
+import time
+from collections import OrderedDict
+
+from werkzeug.wrappers import Response
+
+from nameko_http import constants
+
+
+class CachedResponse(object):
+    """Snapshot of a finished response that can be replayed any number of
+    times.
+    """
+    __slots__ = ('status', 'headers', 'body', 'expires')
+
+    def __init__(self, status, headers, body, expires=None):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.expires = expires
+
+    @classmethod
+    def from_response(cls, response, expires=None):
+        return cls(
+            response.status_code,
+            list(response.headers.items()),
+            response.get_data(),
+            expires,
+        )
+
+    @property
+    def size(self):
+        return len(self.body) + sum(len(k) + len(v) for k, v in self.headers)
+
+    def to_response(self):
+        return Response(self.body, status=self.status, headers=self.headers)
+
+
+def is_cacheable(response):
+    if response.status_code != 200 or response.is_streamed:
+        return False
+    if 'Set-Cookie' in response.headers:
+        return False
+    cache_control = response.cache_control
+    return not (cache_control.no_store or cache_control.private)
+
+
+class ResponseCache(object):
+    """Bounded in-memory LRU of responses, shared by the api entrypoints of
+    a service.
+
+    Args:
+        max_entries (int): Maximum number of cached responses.
+        max_bytes (int): Maximum total size of the cached responses.
+    """
+
+    def __init__(self, max_entries=constants.CACHE_MAX_ENTRIES,
+                 max_bytes=constants.CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._paths = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Returns the cached response for ``key``, if not expired."""
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry.expires > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self._remove(key)
+        self.misses += 1
+        return None
+
+    def set(self, key, response, ttl):
+        """Caches a snapshot of ``response`` under ``key`` for ``ttl`` seconds."""
+        entry = CachedResponse.from_response(response, time.monotonic() + ttl)
+        if entry.size > self.max_bytes:
+            return None
+
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = entry
+        self._paths.setdefault(key[1], set()).add(key)
+        self.size += entry.size
+
+        while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+        return entry
+
+    def invalidate(self, path=None):
+        """Drops the cached responses of ``path``, whatever their method,
+        query string or varying headers, or all of them if no path is given.
+        """
+        if path is None:
+            self._entries.clear()
+            self._paths.clear()
+            self.size = 0
+            return
+
+        for key in list(self._paths.get(path, ())):
+            self._remove(key)
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.size -= entry.size
+        keys = self._paths[key[1]]
+        keys.discard(key)
+        if not keys:
+            del self._paths[key[1]]
+
+
+class CacheRule(object):
+    """Caching settings of an api entrypoint.
+
+    Args:
+        ttl (float): Seconds a response is served from the cache.
+        vary (list): Request headers the response depends on.
+    """
+
+    def __init__(self, ttl, vary=()):
+        self.ttl = ttl
+        self.vary = tuple(vary)
+
+    @classmethod
+    def from_config(cls, value):
+        """Build a rule out of the ``cache`` api argument: a rule, a ttl in
+        seconds or a dict of keyword arguments.
+        """
+        if isinstance(value, cls):
+            return value
+        if isinstance(value, dict):
+            return cls(**value)
+        return cls(ttl=value)
+
+    def key(self, request):
+        headers = request.headers
+        return (
+            request.method,
+            request.path,
+            request.query_string,
+            tuple(headers.get(name) for name in self.vary),
+        )
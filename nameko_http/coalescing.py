@@ -0,0 +1,112 @@
+from eventlet import Timeout
+from eventlet.event import Event
+
+from nameko_http import constants
+from nameko_http.cache import CachedResponse
+
+
+class SingleFlight(object):
+    """Runs at most one request handler per key at a time. Requests arriving
+    while one with the same key is in flight wait for it and get a copy of
+    its response instead of running the handler themselves.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self.leaders = 0
+        self.followers = 0
+
+    def do(self, key, handler, timeout=None):
+        """Returns the response of ``handler``, or of the in-flight call
+        with the same ``key``.
+
+        Args:
+            key: Hashable key of the request.
+            handler (callable): Produces a ``werkzeug.Response``.
+            timeout (float): Seconds to wait for an in-flight call before
+                running ``handler`` anyway.
+
+        Returns:
+            werkzeug.Response
+        """
+        event = self._calls.get(key)
+        if event is not None:
+            snapshot = None
+            with Timeout(timeout, False):
+                snapshot = event.wait()
+            if snapshot is not None:
+                self.followers += 1
+                return snapshot.to_response()
+            return handler()
+
+        event = Event()
+        self._calls[key] = event
+        self.leaders += 1
+        snapshot = None
+        try:
+            response = handler()
+            # streamed responses can only be sent once, waiting requests
+            # run their own handler instead
+            if not response.is_streamed:
+                snapshot = CachedResponse.from_response(response)
+            return response
+        finally:
+            del self._calls[key]
+            event.send(snapshot)
+
+    def stats(self):
+        return {
+            'in_flight': len(self._calls),
+            'leaders': self.leaders,
+            'followers': self.followers,
+        }
+
+
+# requests of different users must not share responses
+CREDENTIAL_HEADERS = ('Authorization', 'Cookie')
+
+
+def default_key(request, vary=()):
+    headers = request.headers
+    return (
+        request.method,
+        request.path,
+        request.query_string,
+        tuple(headers.get(name) for name in CREDENTIAL_HEADERS + tuple(vary)),
+    )
+
+
+class CoalesceRule(object):
+    """Request coalescing settings of an api entrypoint.
+
+    Args:
+        key (callable): Builds the key identifying identical requests out of
+            the request. Defaults to method, path, query string and the
+            ``Authorization`` and ``Cookie`` headers, along with the headers
+            the cached responses of the entrypoint vary on.
+        timeout (float): Seconds a request waits for an identical in-flight
+            one before running its own handler.
+    """
+
+    def __init__(self, key=None, timeout=constants.COALESCE_TIMEOUT):
+        self.key_func = key
+        self.timeout = timeout
+
+    @classmethod
+    def from_config(cls, value):
+        """Build a rule out of the ``coalesce`` api argument: a rule, a dict of
+        keyword arguments or ``True`` for the defaults.
+        """
+        if isinstance(value, cls):
+            return value
+        if value is True:
+            return cls()
+        return cls(**value)
+
+    def key(self, request, vary=()):
+        """Returns the key of ``request``, ``vary`` naming further headers
+        the response depends on.
+        """
+        if self.key_func is not None:
+            return self.key_func(request)
+        return default_key(request, vary)
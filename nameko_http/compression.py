@@ -0,0 +1,106 @@
+import zlib
+
+from nameko_http import constants
+
+
+# wbits selecting the gzip and zlib containers
+WBITS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+
+
+class CompressionPolicy(object):
+    """Response compression negotiated from the ``Accept-Encoding`` header.
+
+    Args:
+        min_size (int): Bodies smaller than this are sent uncompressed.
+            Streamed bodies have no known size and are always compressed.
+        level (int): zlib compression level, 1 (fastest) to 9 (smallest).
+        mimetypes (list): Mimetypes of the responses to compress.
+        encodings (list): Supported encodings, in order of preference.
+    """
+
+    def __init__(self, min_size=constants.COMPRESSION_MIN_SIZE,
+                 level=constants.COMPRESSION_LEVEL, mimetypes=None, encodings=None):
+        if mimetypes is None:
+            mimetypes = constants.COMPRESSION_MIMETYPES_LIST
+        if encodings is None:
+            encodings = list(WBITS)
+
+        self.min_size = min_size
+        self.level = level
+        self.mimetypes = frozenset(mimetypes)
+        self.encodings = [encoding for encoding in encodings if encoding in WBITS]
+
+    @classmethod
+    def from_config(cls, value):
+        """Build a policy out of the ``compress`` api argument or the
+        ``HTTP_COMPRESSION`` config value: a policy, a dict of keyword
+        arguments or ``True`` for the defaults.
+        """
+        if isinstance(value, cls):
+            return value
+        if value is True:
+            return cls()
+        return cls(**value)
+
+    def negotiate(self, request):
+        """Returns the encoding preferred by the client, if any."""
+        return request.accept_encodings.best_match(self.encodings)
+
+    def compressible(self, response):
+        return (
+            response.mimetype in self.mimetypes and
+            'Content-Encoding' not in response.headers and
+            200 <= response.status_code and
+            response.status_code not in (204, 304)
+        )
+
+    def apply(self, response, request):
+        """Compresses the response body, if the response is compressible and
+        the client accepts one of the supported encodings.
+
+        Args:
+            response (werkzeug.Response): Outgoing response.
+            request (werkzeug.Request): Incoming nameko web request.
+
+        Returns:
+            werkzeug.Response
+        """
+        if not self.compressible(response):
+            return response
+
+        response.vary.add('Accept-Encoding')
+        encoding = self.negotiate(request)
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            response.response = self.compress_stream(response.iter_encoded(), encoding)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < self.min_size:
+                return response
+            response.set_data(self.compress(data, encoding))
+
+        response.headers['Content-Encoding'] = encoding
+        # the compressed body differs from the one the ETag was computed on
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
+
+    def compress(self, data, encoding):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, WBITS[encoding])
+        return compressor.compress(data) + compressor.flush()
+
+    def compress_stream(self, chunks, encoding):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, WBITS[encoding])
+        for chunk in chunks:
+            # flush every chunk so clients can decode it as soon as it arrives
+            data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+        yield compressor.flush()
@@ -15,3 +15,131 @@ CORS_ALLOW_HEADERS_LIST = [
 ]
 
 CORS_ALLOW_CREDENTIALS = True
+
+CORS_MAX_AGE = 600
+
+CORS_CONFIG_KEY = 'HTTP_CORS'
+
+JSON_CODEC_CONFIG_KEY = 'HTTP_JSON_CODEC'
+
+MEDIA_CODECS_CONFIG_KEY = 'HTTP_MEDIA_CODECS'
+
+MAX_BODY_SIZE_CONFIG_KEY = 'HTTP_MAX_BODY_SIZE'
+
+JSON_STREAM_CHUNK_SIZE = 64 * 1024
+
+# characters buffered ahead of an array item before giving up on it
+JSON_STREAM_MAX_ITEM_SIZE = 1024 * 1024
+
+COMPRESSION_MIN_SIZE = 1024
+COMPRESSION_LEVEL = 6
+COMPRESSION_MIMETYPES_LIST = [
+    'application/json',
+    'application/x-ndjson',
+    'text/plain',
+    'text/html',
+]
+
+COMPRESSION_CONFIG_KEY = 'HTTP_COMPRESSION'
+
+CACHE_MAX_ENTRIES = 1024
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+CACHE_CONFIG_KEY = 'HTTP_CACHE'
+
+COALESCE_TIMEOUT = 30
+
+NEGOTIATION_CACHE_SIZE = 256
+
+METRICS_LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+METRICS_PATH_CONFIG_KEY = 'HTTP_METRICS_PATH'
+
+ADMISSION_RETRY_AFTER = 1
+
+ADMISSION_CONFIG_KEY = 'HTTP_ADMISSION'
+
+POOLS_CONFIG_KEY = 'HTTP_POOLS'
+
+RATE_LIMIT_MAX_KEYS = 100000
+
+BATCH_MAX_SIZE = 20
+
+BATCH_CONCURRENCY = 10
+
+BATCH_MAX_BODY_SIZE = 1024 * 1024
+
+BATCH_CONFIG_KEY = 'HTTP_BATCH'
+
+SERVER_CONFIG_KEY = 'HTTP_SERVER'
+
+SERVER_DEFAULTS = {
+    'backlog': 1024,
+    'reuse_port': False,
+    # True, False or the idle timeout of keep-alive connections in seconds
+    'keepalive': True,
+    'drain_timeout': 10,
+    'health_path': None,
+    # listening socket inherited from a pre-fork parent process
+    'fd': None,
+}
+
+SERVER_DRAIN_POLL_INTERVAL = 0.05
+
+PREFORK_RESTART_DELAY = 1
+
+PREFORK_POLL_INTERVAL = 0.1
+
+PREFORK_KILL_GRACE = 5
+
+ROUTER_CONFIG_KEY = 'HTTP_ROUTER'
+
+PROFILING_CONFIG_KEY = 'HTTP_PROFILING'
+
+PROFILING_HEADER = 'X-Debug-Profile'
+
+PROFILING_MAX_FILES = 100
+
+PROFILING_SAMPLE_INTERVAL = 0.005
+
+PROFILING_MAX_SAMPLES = 100000
+
+# seconds the client is willing to wait for the response
+DEADLINE_HEADER = 'X-Request-Timeout'
+
+DEADLINE_CONFIG_KEY = 'HTTP_REQUEST_TIMEOUT'
+
+# context data key of the seconds left when the worker was spawned
+DEADLINE_CONTEXT_KEY = 'deadline_timeout'
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+
+IDEMPOTENCY_TTL = 24 * 60 * 60
+
+IDEMPOTENCY_MAX_ENTRIES = 10000
+
+IDEMPOTENCY_WAIT_TIMEOUT = 30
+
+# seconds a key stays claimed, so that claims of crashed processes expire
+IDEMPOTENCY_CLAIM_TTL = 60
+
+# seconds between lookups of a key claimed by another process
+IDEMPOTENCY_POLL_INTERVAL = 0.05
+
+IDEMPOTENCY_CONFIG_KEY = 'HTTP_IDEMPOTENCY'
+
+UPLOAD_MAX_MEMORY_SIZE = 1024 * 1024
+
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+ACCESS_LOG_CONFIG_KEY = 'HTTP_ACCESS_LOG'
+
+ACCESS_LOG_MAX_ENTRIES = 10000
+
+ACCESS_LOG_BATCH_SIZE = 500
+
+ACCESS_LOG_FLUSH_INTERVAL = 1.0
+
+ACCESS_LOG_REQUEST_ID_HEADER = 'X-Request-Id'
@@ -0,0 +1,136 @@
+from nameko_http import constants
+from nameko_http.utils import as_string
+
+
+class CorsPolicy(object):
+    """CORS policy of an api entrypoint.
+
+    All header values are built once, when the policy gets created, so
+    that adding CORS headers to a response or answering a preflight
+    request is a matter of a few dictionary lookups.
+
+    Args:
+        origins (list): Allowed origins. ``'*'`` allows any origin, entries
+            like ``'https://*.example.com'`` or ``'*.example.com'`` allow
+            any subdomain of ``example.com``.
+        methods (list): Allowed request methods.
+        headers (list): Allowed request headers.
+        allow_credentials (bool): Value of ``Access-Control-Allow-Credentials``.
+        max_age (int): Seconds a preflight response may be cached by the
+            client. ``None`` omits ``Access-Control-Max-Age``.
+    """
+
+    def __init__(self, origins=None, methods=None, headers=None,
+                 allow_credentials=None, max_age=constants.CORS_MAX_AGE):
+        if origins is None:
+            origins = constants.CORS_ALLOW_ORIGINS_LIST
+        if methods is None:
+            methods = constants.CORS_ALLOW_METHODS_LIST
+        if headers is None:
+            headers = constants.CORS_ALLOW_HEADERS_LIST
+        if allow_credentials is None:
+            allow_credentials = constants.CORS_ALLOW_CREDENTIALS
+
+        self.allow_any_origin = '*' in origins
+        self.origins = frozenset(
+            origin.lower() for origin in origins if '*' not in origin
+        )
+        self.origin_suffixes = tuple(
+            _wildcard_suffix(origin) for origin in origins
+            if '*' in origin and origin != '*'
+        )
+        self.methods = frozenset(method.upper() for method in methods)
+        self.headers = frozenset(header.lower() for header in headers)
+
+        self.allow_methods = as_string(methods)
+        self.allow_headers = as_string(headers)
+        self.allow_credentials = str(allow_credentials).lower()
+        self.max_age = str(max_age) if max_age is not None else None
+
+    @classmethod
+    def from_config(cls, value):
+        """Build a policy out of the ``cors`` api argument or the
+        ``HTTP_CORS`` config value, which can either be a policy or a dict
+        of keyword arguments.
+        """
+        if isinstance(value, cls):
+            return value
+        return cls(**(value or {}))
+
+    def allowed_origin(self, origin):
+        """Returns the value of ``Access-Control-Allow-Origin`` for the
+        given request origin, or ``None`` if the origin is not allowed.
+        """
+        if not origin:
+            return '*' if self.allow_any_origin else None
+        if self.allow_any_origin:
+            return origin
+
+        lowered = origin.lower()
+        if lowered in self.origins:
+            return origin
+        if self.origin_suffixes:
+            host = lowered.split('://', 1)[-1]
+            for scheme, suffix in self.origin_suffixes:
+                if scheme and not lowered.startswith(scheme):
+                    continue
+                if host.endswith(suffix):
+                    return origin
+        return None
+
+    def allowed_method(self, method):
+        if method and method.upper() in self.methods:
+            return method
+        return self.allow_methods
+
+    def allowed_headers(self, headers):
+        if headers:
+            requested = (header.strip().lower() for header in headers.split(','))
+            if all(header in self.headers for header in requested if header):
+                return headers
+        return self.allow_headers
+
+    def apply(self, response, request):
+        """Adds CORS headers to the response.
+
+        Args:
+            response (werkzeug.Response): Outgoing response.
+            request (werkzeug.Request): Incoming nameko web request.
+
+        Returns:
+            werkzeug.Response
+        """
+        origin = request.headers.get('origin')
+        allow_origin = self.allowed_origin(origin)
+        if allow_origin is None:
+            return response
+
+        headers = response.headers
+        headers['Access-Control-Allow-Origin'] = allow_origin
+        headers['Access-Control-Allow-Headers'] = self.allowed_headers(
+            request.headers.get('access-control-request-headers')
+        )
+        headers['Access-Control-Allow-Methods'] = self.allowed_method(
+            request.headers.get('access-control-request-method')
+        )
+        headers['Access-Control-Allow-Credentials'] = self.allow_credentials
+        if origin and allow_origin != '*':
+            response.vary.add('Origin')
+
+        return response
+
+    def preflight(self, response, request):
+        """Adds CORS headers to a preflight response, along with
+        ``Access-Control-Max-Age`` so that clients can cache it.
+        """
+        response = self.apply(response, request)
+        if self.max_age is not None and 'Access-Control-Allow-Origin' in response.headers:
+            response.headers['Access-Control-Max-Age'] = self.max_age
+        return response
+
+
+def _wildcard_suffix(origin):
+    scheme, _, host = origin.lower().rpartition('://')
+    scheme = scheme + '://' if scheme else ''
+    # '*.example.com' matches 'api.example.com' but not 'example.com'
+    return scheme, host.lstrip('*')
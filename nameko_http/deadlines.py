@@ -0,0 +1,86 @@
+import time
+from logging import getLogger
+
+from greenlet import GreenletExit
+
+from nameko_http import constants
+
+
+_log = getLogger(__name__)
+
+
+class DeadlineExceeded(GreenletExit):
+    """Raised in workers cancelled once the deadline of their request has
+    passed. A ``GreenletExit`` so that the container doesn't treat it as an
+    error of the worker thread.
+    """
+
+
+def parse_timeout(value):
+    """Returns the timeout in seconds of a request timeout header value,
+    ``None`` if it isn't a positive number.
+    """
+    if value is None:
+        return None
+    try:
+        timeout = float(value)
+    except ValueError:
+        return None
+    return timeout if timeout > 0 else None
+
+
+class DeadlineContextData(dict):
+    """Context data of a worker whose request has a deadline.
+
+    The deadline is propagated to downstream services as the seconds left
+    rather than as a point in time, as gRPC does, so that it doesn't depend
+    on the clocks of the hosts being in sync. nameko copies the context data
+    of a worker into the headers of each call the worker makes, and copies
+    of this one hold the seconds left at the time of the call as
+    ``deadline_timeout``, so that every hop gets the budget actually left.
+
+    Args:
+        data (dict): Context data of the worker.
+        deadline (float): ``time.monotonic()`` time of the deadline.
+    """
+
+    def __init__(self, data, deadline):
+        super().__init__(data)
+        self.deadline = deadline
+
+    def copy(self):
+        data = dict(self)
+        data[constants.DEADLINE_CONTEXT_KEY] = max(0, self.deadline - time.monotonic())
+        return data
+
+
+def with_deadline(data):
+    """Returns the context data a worker received, its ``deadline_timeout``
+    counted down from now on.
+    """
+    timeout = data.get(constants.DEADLINE_CONTEXT_KEY)
+    if timeout is None or isinstance(data, DeadlineContextData):
+        return data
+    return DeadlineContextData(data, time.monotonic() + timeout)
+
+
+def time_remaining(context_data):
+    """Returns the seconds left before the deadline in the context data of
+    a worker, ``worker_ctx.data``, ``None`` if the request has no deadline.
+    """
+    deadline = getattr(context_data, 'deadline', None)
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def get_worker_thread(container, worker_ctx):
+    """Returns the green thread running a worker, ``None`` if it has
+    completed or if the container doesn't expose its worker threads.
+    """
+    # worker threads aren't part of the public api of the container
+    worker_threads = getattr(container, '_worker_threads', None)
+    if worker_threads is None:
+        _log.warning('Worker threads of %s not found, workers can\'t be cancelled', container)
+        return None
+    return worker_threads.get(worker_ctx)
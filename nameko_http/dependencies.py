@@ -0,0 +1,51 @@
+from functools import partial
+
+from nameko.extensions import DependencyProvider
+
+from nameko_http.deadlines import time_remaining, with_deadline
+from nameko_http.server import WebServer
+
+
+class HttpCache(DependencyProvider):
+    """Gives services access to the response cache of the api entrypoints,
+    so they can invalidate cached responses after writes::
+
+        class OrderService:
+            name = 'orders'
+
+            http_cache = HttpCache()
+
+            @api('PUT', '/orders/<int:order_id>')
+            def update_order(self, request, order_id):
+                ...
+                self.http_cache.invalidate('/orders/{}'.format(order_id))
+    """
+    server = WebServer()
+
+    def get_dependency(self, worker_ctx):
+        return self.server.response_cache
+
+
+class Deadline(DependencyProvider):
+    """Gives workers the seconds left before the deadline of the request
+    they handle, propagated by the api entrypoints to downstream services::
+
+        class InventoryService:
+            name = 'inventory'
+
+            deadline = Deadline()
+
+            @rpc
+            def reserve(self, item_id):
+                remaining = self.deadline()
+                ...
+
+    Calling it returns ``None`` if the request has no deadline. Services
+    calling further services should declare it too, so that the calls they
+    make carry the budget left rather than the one they received.
+    """
+
+    def get_dependency(self, worker_ctx):
+        # the budget is counted down from the time the worker starts
+        worker_ctx.data = with_deadline(worker_ctx.data)
+        return partial(time_remaining, worker_ctx.data)
@@ -2,6 +2,8 @@
 class HttpError(Exception):
     error_code = 'INTERNAL_SERVER_ERROR'
     status_code = 500
+    # additional response headers
+    headers = None
 
 
 class HttpNotAcceptable(HttpError):
@@ -17,3 +19,62 @@ class HttpUnsupportedMediaType(HttpError):
 class HttpMalformedJSON(HttpError):
     error_code = 'MALFORMED_JSON'
     status_code = 753
+
+
+class HttpPayloadTooLarge(HttpError):
+    error_code = 'PAYLOAD_TOO_LARGE'
+    status_code = 413
+
+
+class HttpServiceUnavailable(HttpError):
+    error_code = 'SERVICE_UNAVAILABLE'
+    status_code = 503
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        if retry_after is not None:
+            self.headers = {'Retry-After': str(retry_after)}
+
+
+class HttpTooManyRequests(HttpError):
+    error_code = 'TOO_MANY_REQUESTS'
+    status_code = 429
+
+    def __init__(self, message, headers=None):
+        super().__init__(message)
+        self.headers = headers
+
+
+class HttpBadBatch(HttpError):
+    error_code = 'BAD_BATCH'
+    status_code = 400
+
+
+class HttpValidationError(HttpError):
+    error_code = 'VALIDATION_ERROR'
+    status_code = 400
+
+    def __init__(self, message, errors=None):
+        super().__init__(message)
+        # details added to the error response body
+        self.errors = errors
+
+
+class HttpGatewayTimeout(HttpError):
+    error_code = 'GATEWAY_TIMEOUT'
+    status_code = 504
+
+
+class HttpIdempotencyKeyInUse(HttpError):
+    error_code = 'IDEMPOTENCY_KEY_IN_USE'
+    status_code = 409
+
+
+class HttpIdempotencyKeyReused(HttpError):
+    error_code = 'IDEMPOTENCY_KEY_REUSED'
+    status_code = 422
+
+
+class HttpBadGateway(HttpError):
+    error_code = 'BAD_GATEWAY'
+    status_code = 502
@@ -0,0 +1,159 @@
+import time
+
+from eventlet import GreenPool, Timeout
+from eventlet.queue import LightQueue
+
+from nameko_http.exceptions import HttpBadGateway, HttpError, HttpGatewayTimeout
+
+
+class Call(object):
+    """Call of a fan-out, with its own options.
+
+    Args:
+        func (callable): Called with ``args`` and ``kwargs``, typically a
+            method of an RPC proxy such as ``self.users.get``.
+        args (tuple): Positional arguments of the call.
+        kwargs (dict): Keyword arguments of the call.
+        timeout (float): Seconds the call may take, overriding the timeout
+            of the fan-out.
+        required (bool): Whether a failure of the call fails the fan-out,
+            overriding the policy of the fan-out.
+        default: Result of the call if it fails without failing the fan-out.
+    """
+
+    def __init__(self, func, args=(), kwargs=None, timeout=None, required=None, default=None):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.timeout = timeout
+        self.required = required
+        self.default = default
+
+    @classmethod
+    def from_config(cls, value):
+        """Build a call out of a ``fan_out`` value: a call or a callable
+        taking no arguments.
+        """
+        if isinstance(value, cls):
+            return value
+        return cls(value)
+
+    def __call__(self):
+        return self.func(*self.args, **self.kwargs)
+
+
+class FanOutResult(dict):
+    """Results of a fan-out by call name, failed calls holding their
+    ``default``.
+
+    Attributes:
+        errors (dict): ``HttpError`` of each failed call, by call name.
+        durations (dict): Seconds each completed call took, by call name.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.errors = {}
+        self.durations = {}
+
+    @property
+    def complete(self):
+        return not self.errors
+
+    def error_details(self):
+        """Returns the failed calls as dicts with their ``call`` name,
+        ``error_code`` and ``reason``, to be added to partial responses.
+        """
+        return [
+            {'call': name, 'error_code': exc.error_code, 'reason': str(exc)}
+            for name, exc in sorted(self.errors.items())
+        ]
+
+
+def as_http_error(name, exc):
+    """Maps the failure of a call to the error the API responds with."""
+    if isinstance(exc, HttpError):
+        return exc
+    if isinstance(exc, Timeout):
+        return HttpGatewayTimeout('Call to `{}` timed out'.format(name))
+    return HttpBadGateway('Call to `{}` failed: {!r}'.format(name, exc))
+
+
+def _run(name, call, timeout, deadline, done):
+    if call.timeout is not None:
+        timeout = call.timeout
+    if deadline is not None:
+        # calls waiting for a slot of the pool have less time left
+        remaining = max(0, deadline - time.monotonic())
+        if timeout is None or timeout > remaining:
+            timeout = remaining
+
+    started_at = time.monotonic()
+    try:
+        with Timeout(timeout):
+            value = call()
+    except (Exception, Timeout) as exc:  # pylint: disable=broad-except
+        done.put((name, None, exc, None))
+    else:
+        done.put((name, value, None, time.monotonic() - started_at))
+
+
+def fan_out(calls, timeout=None, required=True, deadline=None, max_concurrency=None):
+    """Runs calls concurrently in green threads, so that a handler waits
+    for the slowest of them rather than for their sum::
+
+        result = fan_out({
+            'user': Call(self.users.get, (user_id,)),
+            'orders': Call(self.orders.list, (user_id,), timeout=0.5),
+            'offers': Call(self.offers.list, (user_id,), required=False, default=[]),
+        }, timeout=1, deadline=request.deadline)
+
+    Once a required call fails the others are killed and its error raised.
+    Other failures are reported in ``errors``, their result being the
+    ``default`` of the call.
+
+    Args:
+        calls (dict): ``Call``, or callables taking no arguments, by name.
+        timeout (float): Seconds each call may take.
+        required (bool): Whether calls fail the fan-out by default.
+        deadline (float): ``time.monotonic()`` time by which every call
+            must complete, such as the ``deadline`` of the request.
+        max_concurrency (int): Calls run at once, all of them by default.
+
+    Returns:
+        FanOutResult
+
+    Raises:
+        HttpGatewayTimeout: A required call timed out.
+        HttpBadGateway: A required call failed.
+    """
+    calls = {name: Call.from_config(value) for name, value in calls.items()}
+    result = FanOutResult()
+    if not calls:
+        return result
+
+    done = LightQueue()
+    pool = GreenPool(max_concurrency or len(calls))
+    threads = []
+    for name, call in calls.items():
+        threads.append(pool.spawn(_run, name, call, timeout, deadline, done))
+
+    try:
+        for _ in range(len(calls)):
+            name, value, exc, duration = done.get()
+            call = calls[name]
+            if exc is None:
+                result[name] = value
+                result.durations[name] = duration
+                continue
+
+            error = as_http_error(name, exc)
+            if call.required if call.required is not None else required:
+                raise error
+            result[name] = call.default
+            result.errors[name] = error
+    finally:
+        for thread in threads:
+            thread.kill()
+
+    return result
@@ -1,20 +1,45 @@
 # -*- coding: utf-8 -*-
 
 """Main module."""
-import json
+import time
+from contextlib import ExitStack
+from functools import partial
+from logging import getLogger
 
+from eventlet import Timeout
+from eventlet.event import Event
 from nameko.exceptions import safe_for_serialization
 from nameko.web.handlers import HttpRequestHandler
+from werkzeug.http import is_resource_modified
 from werkzeug.wrappers import Response
 
 from nameko_http.exceptions import (
-    HttpError, HttpNotAcceptable, HttpUnsupportedMediaType,
+    HttpError, HttpGatewayTimeout, HttpNotAcceptable,
+    HttpUnsupportedMediaType, HttpValidationError,
 )
 from nameko_http import constants
-from nameko_http.utils import client_accepts_json, is_json_request, as_string
+from nameko_http.admission import Bulkhead, Limiter
+from nameko_http.cache import CacheRule, is_cacheable
+from nameko_http.coalescing import CoalesceRule, SingleFlight
+from nameko_http.deadlines import DeadlineExceeded, get_worker_thread, parse_timeout
+from nameko_http.compression import CompressionPolicy
+from nameko_http.cors import CorsPolicy
+from nameko_http.idempotency import IdempotencyRule
+from nameko_http.metrics import RouteMetrics
+from nameko_http.ratelimit import RateLimiter
+from nameko_http.schema import SchemaValidator
+from nameko_http.utils import (
+    ApiResponse, generate_etag, get_json, is_chunked, limit_body_size, read_body,
+)
 from nameko_http.server import WebServer
 
 
+_log = getLogger(__name__)
+
+# the deadline header as found in the WSGI environ
+DEADLINE_ENVIRON_KEY = 'HTTP_' + constants.DEADLINE_HEADER.upper().replace('-', '_')
+
+
 class HttpApiEntrypoint(HttpRequestHandler):
     """Rest API http Entrypoint."""
     server = WebServer()
@@ -22,20 +47,179 @@ class HttpApiEntrypoint(HttpRequestHandler):
     # TODO: Add authorization header parsing on context_from_headers
 
     def __init__(self, method, url, **kwargs):
-        self.cors_enabled = kwargs.pop('cors_enabled', False)
+        self.cors = kwargs.pop('cors', None)
+        self.cors_enabled = kwargs.pop('cors_enabled', self.cors is not None)
+        self.cors_policy = None
+        self.max_body_size = kwargs.pop('max_body_size', None)
+        self.compress = kwargs.pop('compress', None)
+        self.compression_policy = None
+        self.etag = kwargs.pop('etag', False)
+        self.version_key = kwargs.pop('version_key', None)
+        self.cache = kwargs.pop('cache', None)
+        self.cache_rule = None
+        self.coalesce = kwargs.pop('coalesce', None)
+        self.coalesce_rule = None
+        self.single_flight = None
+        self.admission = kwargs.pop('admission', None)
+        self.admission_limiter = None
+        self.pool = kwargs.pop('pool', None)
+        self.pool_limiter = None
+        self.rate_limit = kwargs.pop('rate_limit', None)
+        self.rate_limiter = None
+        self.schema = kwargs.pop('schema', None)
+        self.schema_validator = None
+        self.timeout = kwargs.pop('timeout', None)
+        self.idempotency = kwargs.pop('idempotency', None)
+        self.idempotency_rule = None
+        # upload bodies may be of any media type
+        self.upload = kwargs.pop('upload', False)
+        self.metrics = None
         if self.cors_enabled:
             parts = method.split(',')
             method = ','.join(['OPTIONS'] + parts)
 
         super().__init__(method, url, **kwargs)
 
+    def setup(self):
+        config = self.container.config
+        if self.max_body_size is None:
+            self.max_body_size = config.get(constants.MAX_BODY_SIZE_CONFIG_KEY)
+
+        if self.cors_enabled:
+            cors = self.cors
+            if cors is None:
+                cors = config.get(constants.CORS_CONFIG_KEY)
+            self.cors_policy = CorsPolicy.from_config(cors)
+
+        compress = self.compress
+        if compress is None:
+            compress = config.get(constants.COMPRESSION_CONFIG_KEY)
+        if compress:
+            self.compression_policy = CompressionPolicy.from_config(compress)
+
+        if self.cache:
+            self.cache_rule = CacheRule.from_config(self.cache)
+
+        if self.coalesce:
+            self.coalesce_rule = CoalesceRule.from_config(self.coalesce)
+            self.single_flight = SingleFlight()
+
+        if self.admission:
+            self.admission_limiter = Limiter.from_config(self.url, self.admission)
+
+        if isinstance(self.pool, str):
+            self.pool_limiter = self.server.get_pool(self.pool)
+        elif self.pool:
+            self.pool_limiter = Bulkhead.from_config(self.url, self.pool)
+
+        if self.rate_limit:
+            self.rate_limiter = RateLimiter.from_config(self.rate_limit)
+
+        if self.schema is not None:
+            self.schema_validator = SchemaValidator.from_config(self.schema)
+
+        if self.timeout is None:
+            self.timeout = config.get(constants.DEADLINE_CONFIG_KEY)
+
+        if self.idempotency:
+            self.idempotency_rule = IdempotencyRule.from_config(self.idempotency)
+
+        self.metrics = self.server.route_metrics.get(self.url)
+        if self.metrics is None:
+            self.metrics = self.server.route_metrics[self.url] = RouteMetrics(self.url)
+
+        super().setup()
+
     def handle_request(self, request):
+        """Entry point of every request routed to this entrypoint.
+
+        CORS preflight requests are answered straight away from the
+        precomputed CORS policy, any other request goes through
+        ``process_request`` and gets CORS headers added to its response,
+        which is then compressed if compression is enabled.
+        """
+        request.received_at = time.monotonic()
+        request.deadline = self.get_deadline(request)
+        access_log = self.server.access_log
+        if access_log is not None:
+            request.request_id = access_log.request_id(request)
+        metrics = self.metrics
+        method_metrics = metrics.method(request.method)
+        method_metrics.in_flight += 1
+        profiler = self.server.profiler
+        profile = request.profile = profiler.start(request) if profiler is not None else None
+        try:
+            # OPTIONS case
+            if self.cors_policy is not None and request.method == 'OPTIONS':
+                response = self.cors_policy.preflight(Response(), request)
+            else:
+                response = self.encode_response(request, self.rate_limited(request))
+                if self.cors_policy is not None:
+                    response = self.cors_policy.apply(response, request)
+                if self.compression_policy is not None:
+                    response = self.compression_policy.apply(response, request)
+        finally:
+            method_metrics.in_flight -= 1
+            if profile is not None:
+                profile.stop()
+
+        duration = time.monotonic() - request.received_at
+        metrics.observe(
+            request.method,
+            response.status_code,
+            duration,
+            request.content_length or 0,
+            0 if response.is_streamed else response.content_length or 0,
+        )
+        if response.is_streamed:
+            response.response = metrics.count_streamed(request.method, response.response)
+        if profile is not None:
+            profiler.save(profile, self.url, request, response.status_code, duration)
+        if access_log is not None:
+            response.headers[access_log.request_id_header] = request.request_id
+            access_log.log(request, self.url, response, duration)
+        return response
+
+    def get_deadline(self, request):
+        """Returns the ``time.monotonic()`` time by which the request should
+        be answered, out of the timeout the client sent in the
+        ``X-Request-Timeout`` header and the ``timeout`` of the entrypoint,
+        whichever is shorter.
+        """
+        timeout = parse_timeout(request.environ.get(DEADLINE_ENVIRON_KEY))
+        if self.timeout is not None and (timeout is None or timeout > self.timeout):
+            timeout = self.timeout
+        if timeout is None:
+            return None
+        return time.monotonic() + timeout
+
+    def rate_limited(self, request):
+        """Runs ``process_request`` unless the client has exceeded the rate
+        limit of the entrypoint, in which case it gets a `429 Too Many Requests`.
+        """
+        if self.rate_limiter is None:
+            return self.process_request(request)
+
+        context_data = self.server.context_data_from_headers(request)
+        try:
+            headers = self.rate_limiter.check(request, context_data)
+        except HttpError as exc:
+            return self.response_from_exception(exc)
+
+        response = self.process_request(request)
+        response.headers.extend(headers)
+        return response
+
+    def process_request(self, request):
         """Process incoming request and check request headers.
         Depending on request method & request headers a http error may be raised.
 
         - If client doesn't accept json responses, then HTTP Not Acceptable error will be raised
         - If request method is one of 'POST', 'PUT', 'PATCH' and header `Content-Type` is not
-          `application/json`, then HTTP Unsupported MediaType will be raised.
+          `application/json`, then HTTP Unsupported MediaType will be raised, unless the
+          entrypoint takes uploads.
+        - If `max_body_size` is set and `Content-Length` exceeds it, then HTTP Payload
+          Too Large will be raised. Chunked bodies are cut off once they exceed it.
 
         Args:
 
@@ -48,42 +232,253 @@ class HttpApiEntrypoint(HttpRequestHandler):
             HttpNotAcceptable: Client doesn't accept json
             HttpUnsupportedMediaType: Request method in ['post', 'put', 'pach'] but
                                       `Content-Type` does not support `application/json`.
+            HttpPayloadTooLarge: Request body is larger than `max_body_size`.
         """
-        self.request = request
-
-        # OPTIONS case
-        if self.cors_enabled and request.method.lower() == 'options':
-            return self.response_from_result(result='')
-
         accept = request.headers.get('accept', 'text/plain')
+        # the codecs of the service, which get_json decodes the body with
+        media_codecs = request.media_codecs = self.server.media_codecs
 
         try:
-            if not client_accepts_json(accept):
-                raise HttpNotAcceptable('Only responses encoded as json supported')
+            media_type = media_codecs.negotiate_media_type(accept)
+            if media_type is None:
+                raise HttpNotAcceptable('Only responses encoded as {} supported'.format(
+                    ' or '.join(media_codecs.names())
+                ))
+            request.media_type = media_type
 
             if request.method.lower() in ['post', 'put', 'patch']:
-                mimetype = request.mimetype
-                if mimetype is None:
-                    mimetype = request.content_type
+                # the raw header is what negotiation results are memoized on
+                mimetype = request.headers.get('content-type')
 
                 content_length = request.headers.get('content-length')
 
-                if content_length and content_length != '0':
-                    if not is_json_request(mimetype):
-                        raise HttpUnsupportedMediaType('JSON payload expected')
+                if content_length and content_length != '0' and not self.upload:
+                    if media_codecs.content_media_type(mimetype) is None:
+                        raise HttpUnsupportedMediaType('{} payload expected'.format(
+                            ' or '.join(name.upper() for name in media_codecs.names())
+                        ))
+
+            if self.max_body_size is not None:
+                self.limit_body_size(request)
+            elif self.upload and is_chunked(request):
+                # werkzeug reads chunked bodies as empty unless told they
+                # end, uploads are spooled to disk whatever their size
+                request.environ['wsgi.input_terminated'] = True
+
+            if self.schema_validator is not None and request.method in ('POST', 'PUT', 'PATCH'):
+                self.validate_body(request)
 
         except HttpError as exc:
             return self.response_from_exception(exc)
 
-        return super().handle_request(request)
+        cache_key = None
+        if self.cache_rule is not None and request.method in ('GET', 'HEAD'):
+            cache_key = self.cache_rule.key(request) + (request.media_type,)
+            cached = self.server.response_cache.get(cache_key)
+            if cached is not None:
+                return self.make_conditional(request, cached.to_response())
+
+        version = None
+        if self.version_key is not None and request.method in ('GET', 'HEAD'):
+            try:
+                version = self.version_key(request, **request.path_values)
+            except Exception as exc:  # pylint: disable=broad-except
+                return self.response_from_exception(exc)
+
+            if version is not None and not is_resource_modified(request.environ, etag=version):
+                response = Response(status=304)
+                response.set_etag(version)
+                return response
+
+        if self.coalesce_rule is not None and request.method in ('GET', 'HEAD'):
+            vary = self.cache_rule.vary if self.cache_rule is not None else ()
+            response = self.single_flight.do(
+                (self.coalesce_rule.key(request, vary), request.media_type),
+                partial(self.execute, request),
+                self.coalesce_rule.timeout,
+            )
+        elif self.idempotency_rule is not None:
+            response = self.replay_idempotent(request)
+        else:
+            response = self.execute(request)
+        response = self.add_etag(request, response, version)
+
+        if cache_key is not None and is_cacheable(response):
+            response.vary.update(self.cache_rule.vary)
+            self.server.response_cache.set(cache_key, response, self.cache_rule.ttl)
 
-    def response_from_result(self, result):
-        response = super().response_from_result(result)
-        if self.cors_enabled:
-            response = self.add_cors_headers(response)
+        return self.make_conditional(request, response)
+
+    def replay_idempotent(self, request):
+        """Runs requests carrying an idempotency key once, replaying the
+        stored response to retries without spawning a worker.
+        """
+        rule = self.idempotency_rule
+        if not rule.applies(request):
+            return self.execute(request)
+
+        # the body is read to fingerprint the request
+        request.shallow = False
+        key = rule.key(request, self.server.context_data_from_headers(request))
+        store = rule.store if rule.store is not None else self.server.idempotency_store
+        try:
+            return rule.replay(key, request, partial(self.execute, request), store)
+        except HttpError as exc:
+            return self.response_from_exception(exc)
+
+    def execute(self, request):
+        """Runs the handler once the request is admitted by the service and
+        route limiters and gets a worker of its pool, or responds with
+        `503 Service Unavailable`.
+        """
+        limiters = (self.server.admission_limiter, self.admission_limiter, self.pool_limiter)
+        try:
+            with ExitStack() as stack:
+                for limiter in limiters:
+                    if limiter is not None:
+                        stack.enter_context(limiter)
+                response = self.run_worker(request)
+        except HttpError as exc:
+            response = self.response_from_exception(exc)
+        # encoded before being cached or shared with coalesced requests
+        return self.encode_response(request, response)
+
+    def encode_response(self, request, response):
+        """Encodes responses of ``api_response`` and error responses in the
+        media type negotiated with the client.
+        """
+        if isinstance(response, ApiResponse):
+            media_codecs = self.server.media_codecs
+            response.encode(getattr(request, 'media_type', 'application/json'), media_codecs)
+            if len(media_codecs.codecs) > 1:
+                response.vary.add('Accept')
+        return response
+
+    def run_worker(self, request):
+        """Spawns a worker to run the handler and builds the response out of
+        its result, as `HttpRequestHandler.handle_request` does, recording how
+        long the request waited for the worker and how long the handler took.
+        """
+        request.shallow = False
+        deadline = request.deadline
+        try:
+            if deadline is not None and time.monotonic() >= deadline:
+                raise HttpGatewayTimeout('Request deadline exceeded before a worker started')
+
+            context_data = self.server.context_data_from_headers(request)
+            args, kwargs = self.get_entrypoint_parameters(request)
+
+            self.check_signature(args, kwargs)
+            event = Event()
+            # blocks while the worker pool is full
+            worker_ctx = self.container.spawn_worker(
+                self, args, kwargs, context_data=context_data,
+                handle_result=partial(self.handle_result, event))
+            spawned_at = time.monotonic()
+            self.profile_worker(request, worker_ctx)
+            try:
+                if deadline is None:
+                    result = event.wait()
+                else:
+                    result = self.wait_until(deadline, event, worker_ctx)
+            finally:
+                self.metrics.observe_worker(
+                    request.method, spawned_at - request.received_at,
+                    time.monotonic() - spawned_at,
+                )
+
+            response = self.response_from_result(result)
+
+        except Exception as exc:  # pylint: disable=broad-except
+            response = self.response_from_exception(exc)
+        return response
+
+    def profile_worker(self, request, worker_ctx):
+        """Adds the green thread of the worker to the profile of the request,
+        so that the samples taken while the handler runs are kept.
+        """
+        profile = getattr(request, 'profile', None)
+        if profile is not None and profile.cprofile is None:
+            worker_thread = get_worker_thread(self.container, worker_ctx)
+            if worker_thread is not None:
+                profile.add_greenlet(worker_thread)
+
+    def wait_until(self, deadline, event, worker_ctx):
+        """Waits for the result of the worker, cancelling it once the
+        deadline has passed.
+
+        Raises:
+            HttpGatewayTimeout: The worker didn't complete in time.
+        """
+        timeout = Timeout(max(0, deadline - time.monotonic()))
+        try:
+            return event.wait()
+        except Timeout as exc:
+            if exc is not timeout:
+                raise
+            self.cancel_worker(worker_ctx)
+            raise HttpGatewayTimeout('Request deadline exceeded')
+        finally:
+            timeout.cancel()
+
+    def cancel_worker(self, worker_ctx):
+        worker_thread = get_worker_thread(self.container, worker_ctx)
+        if worker_thread is not None:
+            _log.warning('Cancelling %s, its request deadline has passed', worker_ctx)
+            worker_thread.kill(DeadlineExceeded())
+
+    def add_etag(self, request, response, version=None):
+        """Adds an ETag to successful GET responses, either the version
+        returned by `version_key` or a hash of the body when `etag` is enabled.
+        """
+        if (
+            request.method not in ('GET', 'HEAD') or
+            response.status_code != 200 or
+            response.is_streamed
+        ):
+            return response
+
+        if version is not None:
+            response.set_etag(version)
+        elif self.etag and 'ETag' not in response.headers:
+            response.set_etag(generate_etag(response.get_data()))
 
         return response
 
+    def make_conditional(self, request, response):
+        """Turns the response into a `304 Not Modified` when its ETag or
+        Last-Modified date match `If-None-Match` or `If-Modified-Since`.
+        """
+        if response.status_code != 200 or response.is_streamed:
+            return response
+
+        if 'ETag' in response.headers or 'Last-Modified' in response.headers:
+            response.make_conditional(request)
+
+        return response
+
+    def limit_body_size(self, request):
+        """Rejects bodies whose declared length is over `max_body_size` before
+        reading any of them, and bounds bodies of unknown length.
+        """
+        limit_body_size(request, self.max_body_size)
+
+    def validate_body(self, request):
+        """Parses the body of POST, PUT and PATCH requests and validates it
+        against the schema of the entrypoint, keeping the parsed body on the
+        request for ``get_json`` to return.
+
+        Raises:
+            HttpValidationError: Empty body, or body not matching the schema.
+            HttpMalformedJSON: Body isn't valid JSON.
+        """
+        request.shallow = False
+        if not read_body(request):
+            raise HttpValidationError('Empty request body')
+        body = get_json(request)
+        self.schema_validator.validate(body)
+        request.parsed_json = body
+
     def response_from_exception(self, exc):
 
         if isinstance(exc, HttpError):
@@ -95,43 +490,15 @@ class HttpApiEntrypoint(HttpRequestHandler):
         else:
             status_code, error_code = 500, 'UNEXPECTED_ERROR'
 
-        reason = safe_for_serialization(exc)
+        body = {
+            'error_code': error_code,
+            'reason': safe_for_serialization(exc),
+        }
+        errors = getattr(exc, 'errors', None)
+        if errors is not None:
+            body['errors'] = errors
 
-        response = Response(
-            json.dumps({
-                'error_code': error_code,
-                'reason': reason
-            }),
-            status=status_code,
-            mimetype='application/json'
-        )
-        if self.cors_enabled:
-            response = self.add_cors_headers(response)
-
-        return response
-
-    def add_cors_headers(self, response):
-        """Adds required cors headers."""
-        # Some validation should be applied regarding cors headers
-        context_data = self.server.context_data_from_headers(self.request)
-        response.headers.add(
-            'Access-Control-Allow-Origin',
-            context_data.get('origin') or as_string(constants.CORS_ALLOW_ORIGINS_LIST)
-        )
-        response.headers.add(
-            'Access-Control-Allow-Headers',
-            context_data.get('headers') or as_string(constants.CORS_ALLOW_HEADERS_LIST)
-        )
-        response.headers.add(
-            'Access-Control-Allow-Methods',
-            context_data.get('methods') or as_string(constants.CORS_ALLOW_METHODS_LIST)
-        )
-        response.headers.add(
-            'Access-Control-Allow-Credentials',
-            str(constants.CORS_ALLOW_CREDENTIALS).lower()
-        )
-
-        return response
+        return ApiResponse(body, status=status_code, headers=getattr(exc, 'headers', None))
 
 
 api = HttpApiEntrypoint.decorator
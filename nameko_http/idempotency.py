@@ -0,0 +1,237 @@
+import hashlib
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+import eventlet
+from eventlet import Timeout
+from eventlet.event import Event
+
+from nameko_http import constants
+from nameko_http.cache import CachedResponse
+from nameko_http.exceptions import HttpIdempotencyKeyInUse, HttpIdempotencyKeyReused
+from nameko_http.ratelimit import get_key_func
+from nameko_http.utils import read_body
+
+
+IDEMPOTENT_METHODS = ('POST', 'PUT', 'PATCH')
+
+
+class IdempotencyStore(ABC):
+    """Interface of the stores keeping the first response of each
+    idempotency key. Stores shared by several processes, such as one backed
+    by Redis, only need to persist the fingerprint and the ``status``,
+    ``headers`` and ``body`` of the response.
+
+    The handler runs once per key only if ``claim`` is atomic across every
+    process sharing the store, as ``SET key value NX PX ttl`` is in Redis:
+    of the duplicates handled at once by several processes, exactly one
+    claims the key and runs the handler, the others wait for its response.
+    """
+
+    @abstractmethod
+    def get(self, key):
+        """Returns ``(fingerprint, CachedResponse)`` stored for ``key``, or
+        ``None``.
+        """
+
+    @abstractmethod
+    def set(self, key, fingerprint, response, ttl):
+        """Stores the ``CachedResponse`` of ``key`` for ``ttl`` seconds,
+        replacing its claim.
+        """
+
+    @abstractmethod
+    def claim(self, key, ttl):
+        """Claims ``key`` for ``ttl`` seconds, unless a response is stored
+        or a claim is held for it already. Must be atomic.
+
+        Returns:
+            bool: Whether the key was claimed.
+        """
+
+    @abstractmethod
+    def release(self, key):
+        """Drops the claim of ``key``, its response not being stored."""
+
+
+class MemoryIdempotencyStore(IdempotencyStore):
+    """Bounded in-memory store, the least recently used keys being dropped
+    first.
+
+    Args:
+        max_entries (int): Maximum number of keys stored.
+    """
+
+    def __init__(self, max_entries=constants.IDEMPOTENCY_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._claims = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        fingerprint, response = entry
+        if response.expires <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def set(self, key, fingerprint, response, ttl):
+        response.expires = time.monotonic() + ttl
+        self._entries[key] = (fingerprint, response)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        self._claims.pop(key, None)
+
+    def claim(self, key, ttl):
+        # green threads only switch on I/O, which makes this atomic
+        if self.get(key) is not None or self._claims.get(key, 0) > time.monotonic():
+            return False
+        self._claims[key] = time.monotonic() + ttl
+        return True
+
+    def release(self, key):
+        self._claims.pop(key, None)
+
+
+def fingerprint(request):
+    """Hash of the method, path, query string and body of a request."""
+    digest = hashlib.blake2b(digest_size=16)
+    for part in (request.method.encode(), request.path.encode(), request.query_string):
+        digest.update(part)
+        digest.update(b'\0')
+    digest.update(read_body(request))
+    return digest.hexdigest()
+
+
+def is_replayable(response):
+    # server errors are not stored, so that retries run the handler again
+    return response.status_code < 500 and not response.is_streamed
+
+
+class IdempotencyRule(object):
+    """Idempotency-Key support of an api entrypoint.
+
+    The first response to a POST, PUT or PATCH request carrying the
+    ``Idempotency-Key`` header is stored, and replayed to retries with the
+    same key and the same method, path and body, without running the
+    handler again. Retries with another body get a ``422``. Duplicates
+    arriving while the first request is being handled wait for it, for at
+    most ``wait_timeout`` seconds before getting a ``409``: the first
+    request claims the key in the store, so that duplicates handled by
+    other processes sharing it wait too.
+
+    Args:
+        ttl (float): Seconds responses are replayed for.
+        store (IdempotencyStore): Where responses are stored, defaults to
+            the in-memory store of the service.
+        scope: Keys are scoped per client, told apart as for rate limits by
+            ``'ip'``, ``'origin'``, ``'header:<name>'`` or a callable.
+        header (str): Request header holding the key.
+        wait_timeout (float): Seconds duplicates wait for the first request.
+        claim_ttl (float): Seconds a key stays claimed by the first request,
+            its claim expiring should its process die.
+    """
+
+    def __init__(self, ttl=constants.IDEMPOTENCY_TTL, store=None, scope='ip',
+                 header=constants.IDEMPOTENCY_HEADER,
+                 wait_timeout=constants.IDEMPOTENCY_WAIT_TIMEOUT,
+                 claim_ttl=constants.IDEMPOTENCY_CLAIM_TTL):
+        self.ttl = ttl
+        self.store = store
+        self.scope = get_key_func(scope)
+        self.header = header
+        self.wait_timeout = wait_timeout
+        self.claim_ttl = claim_ttl
+        self._in_flight = {}
+
+    @classmethod
+    def from_config(cls, value):
+        """Build a rule out of the ``idempotency`` api argument: a rule, a
+        dict of keyword arguments, a TTL in seconds or ``True``.
+        """
+        if isinstance(value, cls):
+            return value
+        if isinstance(value, dict):
+            return cls(**value)
+        if value is True:
+            return cls()
+        return cls(ttl=value)
+
+    def applies(self, request):
+        return request.method in IDEMPOTENT_METHODS and bool(request.headers.get(self.header))
+
+    def key(self, request, context_data):
+        """Returns the store key of a request the rule applies to."""
+        return (
+            self.scope(request, context_data), request.method, request.path,
+            request.headers[self.header], request.media_type,
+        )
+
+    def replay(self, key, request, handler, store):
+        """Returns the stored response of ``key``, or the response of
+        ``handler`` once stored.
+
+        Raises:
+            HttpIdempotencyKeyReused: The key was used for another request.
+            HttpIdempotencyKeyInUse: The first request with the key is still
+                being handled after ``wait_timeout``.
+        """
+        request_fingerprint = fingerprint(request)
+        waiting_since = None
+        while True:
+            stored = store.get(key)
+            if stored is not None:
+                stored_fingerprint, snapshot = stored
+                if stored_fingerprint != request_fingerprint:
+                    raise HttpIdempotencyKeyReused(
+                        'Idempotency key already used for another request'
+                    )
+                response = snapshot.to_response()
+                response.headers['Idempotent-Replayed'] = 'true'
+                return response
+
+            event = self._in_flight.get(key)
+            if event is not None:
+                # the response may not be stored, in which case this request
+                # runs the handler
+                with Timeout(self.wait_timeout, False):
+                    event.wait()
+                    continue
+                raise HttpIdempotencyKeyInUse(
+                    'A request with this idempotency key is in progress'
+                )
+
+            if store.claim(key, self.claim_ttl):
+                break
+            # claimed by another process, polled until its response is stored
+            if waiting_since is None:
+                waiting_since = time.monotonic()
+            elif time.monotonic() - waiting_since >= self.wait_timeout:
+                raise HttpIdempotencyKeyInUse(
+                    'A request with this idempotency key is in progress'
+                )
+            eventlet.sleep(constants.IDEMPOTENCY_POLL_INTERVAL)
+
+        event = self._in_flight[key] = Event()
+        stored = False
+        try:
+            response = handler()
+            if is_replayable(response):
+                store.set(
+                    key, request_fingerprint, CachedResponse.from_response(response), self.ttl
+                )
+                stored = True
+            return response
+        finally:
+            if not stored:
+                store.release(key)
+            del self._in_flight[key]
+            event.send()
@@ -0,0 +1,201 @@
+from bisect import bisect_left
+
+from nameko_http import constants
+
+
+# Green threads only switch on I/O, so plain integer and float updates are
+# never interleaved and need no locking.
+
+class Histogram(object):
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=constants.METRICS_LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """Yields ``(upper bound, cumulative count)`` pairs, the last bound
+        being ``'+Inf'``.
+        """
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            yield bound, total
+
+
+class MethodMetrics(object):
+    """Request metrics of a route for one request method."""
+
+    def __init__(self, buckets):
+        self.in_flight = 0
+        self.queue_time = Histogram(buckets)
+        self.handler_time = Histogram(buckets)
+        self.request_bytes = 0
+        self.response_bytes = 0
+
+
+class RouteMetrics(object):
+    """Request metrics of a route, shared by the api entrypoints of its
+    methods so that each series is reported once.
+    """
+
+    def __init__(self, route, buckets=constants.METRICS_LATENCY_BUCKETS):
+        self.route = route
+        self.buckets = buckets
+        # method -> MethodMetrics
+        self.methods = {}
+        # (method, status class) -> latency histogram
+        self.latency = {}
+
+    def method(self, method):
+        metrics = self.methods.get(method)
+        if metrics is None:
+            metrics = self.methods[method] = MethodMetrics(self.buckets)
+        return metrics
+
+    def observe(self, method, status_code, duration, request_bytes, response_bytes):
+        key = (method, '{}xx'.format(status_code // 100))
+        histogram = self.latency.get(key)
+        if histogram is None:
+            histogram = self.latency[key] = Histogram(self.buckets)
+        histogram.observe(duration)
+        metrics = self.method(method)
+        metrics.request_bytes += request_bytes
+        metrics.response_bytes += response_bytes
+
+    def observe_worker(self, method, queue_time, handler_time):
+        metrics = self.method(method)
+        metrics.queue_time.observe(queue_time)
+        metrics.handler_time.observe(handler_time)
+
+    def count_streamed(self, method, iterable):
+        """Wraps the body of a streamed response, counting its bytes as
+        they are sent.
+        """
+        metrics = self.method(method)
+        try:
+            for chunk in iterable:
+                metrics.response_bytes += len(chunk)
+                yield chunk
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+
+def _labels(**labels):
+    return ','.join(
+        '{}="{}"'.format(
+            name,
+            str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'),
+        )
+        for name, value in labels.items()
+    )
+
+
+def _histogram_lines(name, histogram, **labels):
+    for bound, count in histogram.cumulative():
+        yield '{}_bucket{{{},le="{}"}} {}'.format(name, _labels(**labels), bound, count)
+    yield '{}_sum{{{}}} {}'.format(name, _labels(**labels), histogram.sum)
+    yield '{}_count{{{}}} {}'.format(name, _labels(**labels), histogram.count)
+
+
+def render_metrics(providers, limiters=()):
+    """Renders the metrics of the given entrypoints and admission limiters
+    in the Prometheus text exposition format.
+    """
+    routes = []
+    for provider in providers:
+        metrics = getattr(provider, 'metrics', None)
+        # entrypoints of the methods of a route share its metrics
+        if metrics is not None and all(metrics is not seen for _, seen in routes):
+            routes.append((provider.container.service_name, metrics))
+
+    lines = [
+        '# HELP http_requests_total Requests handled, by route, method and status class.',
+        '# TYPE http_requests_total counter',
+    ]
+    for service, metrics in routes:
+        for (method, status), histogram in sorted(metrics.latency.items()):
+            lines.append('http_requests_total{{{}}} {}'.format(
+                _labels(service=service, route=metrics.route, method=method, status=status),
+                histogram.count,
+            ))
+
+    lines += [
+        '# HELP http_request_duration_seconds Time taken to respond to requests.',
+        '# TYPE http_request_duration_seconds histogram',
+    ]
+    for service, metrics in routes:
+        for (method, status), histogram in sorted(metrics.latency.items()):
+            lines.extend(_histogram_lines(
+                'http_request_duration_seconds', histogram,
+                service=service, route=metrics.route, method=method, status=status,
+            ))
+
+    for name, attr, help_text in (
+            ('http_request_queue_seconds', 'queue_time',
+             'Time requests waited for a worker to be spawned.'),
+            ('http_request_handler_seconds', 'handler_time',
+             'Time workers took to run the handler.')):
+        lines += [
+            '# HELP {} {}'.format(name, help_text),
+            '# TYPE {} histogram'.format(name),
+        ]
+        for service, metrics in routes:
+            for method, method_metrics in sorted(metrics.methods.items()):
+                lines.extend(_histogram_lines(
+                    name, getattr(method_metrics, attr),
+                    service=service, route=metrics.route, method=method,
+                ))
+
+    for name, attr, kind, help_text in (
+            ('http_requests_in_flight', 'in_flight', 'gauge',
+             'Requests currently being handled.'),
+            ('http_request_body_bytes_total', 'request_bytes', 'counter',
+             'Bytes received in request bodies.'),
+            ('http_response_body_bytes_total', 'response_bytes', 'counter',
+             'Bytes sent in response bodies.')):
+        lines += [
+            '# HELP {} {}'.format(name, help_text),
+            '# TYPE {} {}'.format(name, kind),
+        ]
+        for service, metrics in routes:
+            for method, method_metrics in sorted(metrics.methods.items()):
+                lines.append('{}{{{}}} {}'.format(
+                    name, _labels(service=service, route=metrics.route, method=method),
+                    getattr(method_metrics, attr),
+                ))
+
+    lines.extend(_limiter_lines(limiters))
+
+    return '\n'.join(lines) + '\n'
+
+
+def _limiter_lines(limiters):
+    if not limiters:
+        return
+
+    for name, attr, kind, help_text in (
+            ('http_admission_in_flight', 'in_flight', 'gauge',
+             'Requests admitted and being handled.'),
+            ('http_admission_queued', 'queued', 'gauge',
+             'Requests waiting to be admitted.'),
+            ('http_admission_admitted_total', 'admitted', 'counter',
+             'Requests admitted.'),
+            ('http_admission_shed_total', 'shed', 'counter',
+             'Requests rejected with 503 Service Unavailable.'),
+            ('http_admission_utilisation', 'utilisation', 'gauge',
+             'Share of the concurrency limit, or of the worker pool, in use.')):
+        yield '# HELP {} {}'.format(name, help_text)
+        yield '# TYPE {} {}'.format(name, kind)
+        for limiter in limiters:
+            yield '{}{{{}}} {}'.format(
+                name, _labels(limiter=limiter.name), getattr(limiter, attr),
+            )
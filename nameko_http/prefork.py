@@ -0,0 +1,184 @@
+"""Runs services in several processes sharing the port of the web server::
+
+    $ python -m nameko_http.prefork --config config.yaml --processes 4 module:Service
+
+Each process binds the port with ``SO_REUSEPORT``, the kernel balancing
+connections across them, ``reuse_port`` being enabled for the processes
+unless configured otherwise. With ``HTTP_SERVER: {reuse_port: false}`` the port
+is bound once by the parent process and the listening socket is inherited
+by the processes instead.
+
+``SIGTERM`` and ``SIGINT`` are forwarded to the processes, which stop
+accepting connections and drain their in-flight requests before exiting.
+Processes still running after the drain timeout are killed. Processes
+exiting unexpectedly are restarted.
+"""
+import argparse
+import logging
+import logging.config
+import os
+import signal
+import socket
+import sys
+import time
+
+import yaml
+from nameko.web.server import WEB_SERVER_CONFIG_KEY, parse_address
+
+from nameko_http import constants
+
+
+_log = logging.getLogger(__name__)
+
+
+def bind_socket(config):
+    """Binds the web server port in the parent process, returns the
+    listening socket.
+    """
+    options = dict(constants.SERVER_DEFAULTS, **(config.get(constants.SERVER_CONFIG_KEY) or {}))
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(parse_address(config.get(WEB_SERVER_CONFIG_KEY, '0.0.0.0:8000')))
+    sock.listen(options['backlog'])
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_process(services, config):  # pragma: no cover (runs in forked processes)
+    """Hosts ``services`` in the current process until it is told to stop."""
+    import eventlet
+    eventlet.monkey_patch()  # noqa (before importing the services)
+
+    from nameko.cli.run import import_service, run
+
+    service_classes = []
+    for path in services:
+        service_classes.extend(import_service(path))
+
+    # the parent handles SIGINT, processes are stopped with SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    run(service_classes, config)
+
+
+class Arbiter(object):
+    """Forks and supervises the serving processes.
+
+    Args:
+        services (list): Python paths of the services, ``module[:Class]``.
+        config (dict): Service config.
+        processes (int): Number of serving processes, defaults to the
+            number of CPUs.
+    """
+
+    def __init__(self, services, config, processes=None):
+        self.services = services
+        self.config = config
+        self.processes = processes or os.cpu_count() or 1
+        self.children = {}
+        self.stopping = False
+        self.kill_at = None
+        self.sock = None
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover (forked process)
+            code = 0
+            try:
+                run_process(self.services, self.config)
+            except Exception:  # pylint: disable=broad-except
+                _log.exception('Serving process %s crashed', os.getpid())
+                code = 1
+            finally:
+                os._exit(code)  # pylint: disable=protected-access
+        self.children[pid] = time.monotonic()
+        _log.info('Started serving process %s', pid)
+
+    def signal_children(self, signum):
+        for pid in self.children:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def stop(self, signum, frame):  # pylint: disable=unused-argument
+        if not self.stopping:
+            self.stopping = True
+            options = self.config.get(constants.SERVER_CONFIG_KEY) or {}
+            drain_timeout = options.get(
+                'drain_timeout', constants.SERVER_DEFAULTS['drain_timeout']
+            )
+            self.kill_at = time.monotonic() + drain_timeout + constants.PREFORK_KILL_GRACE
+        self.signal_children(signal.SIGTERM)
+
+    def run(self):
+        """Serves until the processes are stopped, returns the exit code."""
+        server_config = dict(self.config.get(constants.SERVER_CONFIG_KEY) or {})
+        # off by default for single processes, processes share the port with it
+        server_config.setdefault('reuse_port', True)
+        if not server_config['reuse_port']:
+            self.sock = bind_socket(self.config)
+            server_config['fd'] = self.sock.fileno()
+        self.config = dict(self.config, **{constants.SERVER_CONFIG_KEY: server_config})
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        for _ in range(self.processes):
+            self.spawn()
+
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                if self.kill_at is not None and time.monotonic() > self.kill_at:
+                    _log.warning('Killing serving processes still running after draining')
+                    self.signal_children(signal.SIGKILL)
+                    self.kill_at = None
+                time.sleep(constants.PREFORK_POLL_INTERVAL)
+                continue
+
+            started_at = self.children.pop(pid, None)
+            if started_at is None:
+                continue
+            if not self.stopping:
+                _log.warning('Serving process %s exited with status %s, restarting', pid, status)
+                if time.monotonic() - started_at < constants.PREFORK_RESTART_DELAY:
+                    # don't spin on processes failing at start up
+                    time.sleep(constants.PREFORK_RESTART_DELAY)
+                self.spawn()
+
+        if self.sock is not None:
+            self.sock.close()
+        return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run nameko services in several processes.')
+    parser.add_argument('services', nargs='+', metavar='module[:service class]')
+    parser.add_argument('--config', default='', help='The YAML configuration file')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='Number of serving processes, defaults to the number of CPUs.')
+    args = parser.parse_args(argv)
+
+    if '.' not in sys.path:
+        sys.path.insert(0, '.')
+
+    from nameko.cli.main import setup_yaml_parser
+    setup_yaml_parser()
+    config = {}
+    if args.config:
+        with open(args.config) as fle:
+            config = yaml.safe_load(fle)
+
+    if 'LOGGING' in config:
+        logging.config.dictConfig(config['LOGGING'])
+    else:
+        logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    return Arbiter(args.services, config, args.processes).run()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
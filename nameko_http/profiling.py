@@ -0,0 +1,245 @@
+import cProfile
+import glob
+import hmac
+import os
+import random
+import re
+import signal
+import time
+from collections import Counter, deque
+from itertools import count, islice
+from logging import getLogger
+
+from eventlet.greenthread import getcurrent
+
+from nameko_http import constants
+
+
+_log = getLogger(__name__)
+
+
+class StackSampler(object):
+    """Samples the stack of the running code on ``SIGPROF``, fired every
+    ``interval`` seconds of CPU time while at least one request is watched.
+
+    Green threads share the OS thread, so each sample is tagged with the
+    green thread that was running, and a request gets the samples taken in
+    its own green threads while it was in flight.
+
+    Args:
+        interval (float): Seconds of CPU time between samples.
+        max_samples (int): Samples kept, older ones being dropped.
+    """
+
+    def __init__(self, interval=constants.PROFILING_SAMPLE_INTERVAL,
+                 max_samples=constants.PROFILING_MAX_SAMPLES):
+        self.interval = interval
+        self.samples = deque(maxlen=max_samples)
+        # index of the next sample, never reset
+        self.count = 0
+        self.watchers = 0
+        signal.signal(signal.SIGPROF, self.sample)
+
+    def watch(self):
+        """Starts sampling if needed, returns the index of the next sample."""
+        if self.watchers == 0:
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        self.watchers += 1
+        return self.count
+
+    def unwatch(self):
+        self.watchers -= 1
+        if self.watchers == 0:
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+
+    def sample(self, signum, frame):  # pylint: disable=unused-argument
+        stack = []
+        while frame is not None:
+            stack.append(frame.f_code)
+            frame = frame.f_back
+        # the handler runs in the green thread it interrupted
+        self.samples.append((getcurrent(), tuple(reversed(stack))))
+        self.count += 1
+
+    def between(self, start, end, greenlets):
+        """Returns the stacks sampled in ``greenlets`` from sample ``start``
+        to sample ``end``, those dropped in the meantime aside.
+        """
+        samples = self.samples
+        # index in the deque of sample `count`
+        offset = len(samples) - self.count
+        return [
+            stack for greenlet, stack
+            in islice(samples, max(0, start + offset), max(0, end + offset))
+            if greenlet in greenlets
+        ]
+
+
+def fold(samples):
+    """Folds stack samples into the ``frame;frame;frame count`` lines
+    flamegraph tools read.
+    """
+    counts = Counter(samples)
+    lines = []
+    for stack, hits in counts.most_common():
+        lines.append('{} {}'.format(
+            ';'.join(
+                '{} ({}:{})'.format(code.co_name, code.co_filename, code.co_firstlineno)
+                for code in stack
+            ),
+            hits,
+        ))
+    return '\n'.join(lines) + '\n'
+
+
+class ProfileSession(object):
+    """Profile of one request, with ``cProfile`` or the stack sampler,
+    which keeps the samples of the green thread that started the session
+    and of those added to it, such as the one of its worker.
+    """
+
+    def __init__(self, profiler):
+        self.profiler = profiler
+        self.cprofile = None
+        self.start = None
+        self.end = None
+        self.greenlets = {getcurrent()}
+
+    def add_greenlet(self, greenlet):
+        self.greenlets.add(greenlet)
+
+    def stop(self):
+        if self.cprofile is not None:
+            self.cprofile.disable()
+            self.profiler.active = None
+        else:
+            sampler = self.profiler.sampler
+            self.end = sampler.count
+            sampler.unwatch()
+
+    @property
+    def samples(self):
+        return self.profiler.sampler.between(self.start, self.end, self.greenlets)
+
+
+class Profiler(object):
+    """Profiles a fraction of requests, or those carrying the debug header
+    with the right token, with ``cProfile``. With ``slow_threshold`` set the
+    other requests are watched by a stack sampler, keeping the samples of
+    those slower than the threshold.
+
+    ``cProfile`` profiles every green thread running while it is enabled,
+    so only one request is profiled at a time, and its profiles include the
+    other requests running meanwhile. The sampler only keeps the samples of
+    the green threads of the request.
+
+    Profiles are written to ``directory`` as ``.pstats`` files, read with
+    ``pstats`` or converted to flamegraphs with tools like ``flameprof``,
+    and samples as ``.folded`` files ready for ``flamegraph.pl``. Only the
+    last ``max_files`` files are kept.
+
+    Args:
+        directory (str): Where profiles are written.
+        sample_rate (float): Fraction of requests profiled.
+        header (str): Request header asking for a profile.
+        token (str): Value the header must have, the header being ignored
+            when unset.
+        slow_threshold (float): Seconds over which requests get their
+            samples written, ``None`` to disable the sampler.
+        max_files (int): Number of files kept in ``directory``.
+        sample_interval (float): Seconds of CPU time between samples.
+    """
+
+    def __init__(self, directory, sample_rate=0.0, header=constants.PROFILING_HEADER,
+                 token=None, slow_threshold=None, max_files=constants.PROFILING_MAX_FILES,
+                 sample_interval=constants.PROFILING_SAMPLE_INTERVAL):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.header = header
+        # read from the environ, skipping the parsing of request headers
+        self.environ_key = 'HTTP_' + header.upper().replace('-', '_')
+        self.token = token
+        self.slow_threshold = slow_threshold
+        self.max_files = max_files
+        self.sampler = StackSampler(sample_interval) if slow_threshold is not None else None
+        # session being profiled with cProfile
+        self.active = None
+        self.sequence = count()
+
+        os.makedirs(directory, exist_ok=True)
+        existing = sorted(
+            glob.glob(os.path.join(directory, '*.pstats')) +
+            glob.glob(os.path.join(directory, '*.folded')),
+            key=os.path.getmtime,
+        )
+        self.files = deque(existing)
+        self.rotate()
+
+    @classmethod
+    def from_config(cls, value):
+        """Build a profiler out of the ``HTTP_PROFILING`` config value: a dict
+        of keyword arguments or the profiles directory.
+        """
+        if isinstance(value, dict):
+            return cls(**value)
+        return cls(directory=value)
+
+    def requested(self, request):
+        if self.token is None:
+            return False
+        value = request.environ.get(self.environ_key)
+        return value is not None and hmac.compare_digest(value, self.token)
+
+    def start(self, request):
+        """Returns the profile session of ``request``, ``None`` if it isn't
+        profiled.
+        """
+        if self.requested(request) or (self.sample_rate and random.random() < self.sample_rate):
+            if self.active is None:
+                session = self.active = ProfileSession(self)
+                session.cprofile = cProfile.Profile()
+                session.cprofile.enable()
+                return session
+
+        if self.sampler is not None:
+            session = ProfileSession(self)
+            session.start = self.sampler.watch()
+            return session
+        return None
+
+    def save(self, session, route, request, status_code, duration):
+        """Writes the profile of a request, once stopped, if it is kept."""
+        slow = self.slow_threshold is not None and duration >= self.slow_threshold
+        if session.cprofile is None and not slow:
+            return
+
+        name = '{:.0f}-{}-{}-{}-{}-{}-{:.0f}ms'.format(
+            time.time() * 1000, os.getpid(), next(self.sequence), request.method,
+            re.sub(r'[^A-Za-z0-9]+', '_', route).strip('_') or 'root',
+            status_code, duration * 1000,
+        )
+        try:
+            if session.cprofile is not None:
+                path = os.path.join(self.directory, name + '.pstats')
+                session.cprofile.dump_stats(path)
+            else:
+                samples = session.samples
+                if not samples:
+                    return
+                path = os.path.join(self.directory, name + '.folded')
+                with open(path, 'w') as fle:
+                    fle.write(fold(samples))
+        except OSError:
+            _log.exception('Could not write profile %s', name)
+            return
+
+        self.files.append(path)
+        self.rotate()
+
+    def rotate(self):
+        while len(self.files) > self.max_files:
+            path = self.files.popleft()
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -0,0 +1,160 @@
+import math
+import re
+import time
+from collections import OrderedDict
+
+from nameko.exceptions import ConfigurationError
+
+from nameko_http import constants
+from nameko_http.exceptions import HttpTooManyRequests
+
+
+PERIODS = {
+    'second': 1,
+    'minute': 60,
+    'hour': 3600,
+    'day': 86400,
+}
+
+RATE_RE = re.compile(r'^\s*(?P<count>\d+)\s*/\s*(?P<period>second|minute|hour|day)\s*$')
+
+
+def parse_rate(rate):
+    """Parses rates like ``'100/minute'`` into ``(count, period in seconds)``."""
+    match = RATE_RE.match(rate)
+    if match is None:
+        raise ConfigurationError(
+            'Misconfigured rate `{}`. Should be `<count>/<second|minute|hour|day>`'.format(rate)
+        )
+    return int(match.group('count')), PERIODS[match.group('period')]
+
+
+def client_ip(request, context_data):
+    return context_data.get('client_ip')
+
+
+def client_origin(request, context_data):
+    return context_data.get('origin')
+
+
+def header_key(name):
+    def extract(request, context_data):
+        return request.headers.get(name)
+    return extract
+
+
+def get_key_func(key):
+    """Returns the client key extractor for ``'ip'``, ``'origin'`` or
+    ``'header:<name>'``, callables being returned as they are.
+    """
+    if callable(key):
+        return key
+    if key == 'ip':
+        return client_ip
+    if key == 'origin':
+        return client_origin
+    if key.startswith('header:'):
+        return header_key(key[len('header:'):])
+    raise ConfigurationError('Unknown rate limit key `{}`'.format(key))
+
+
+class TokenBucketStore(object):
+    """Token buckets of the clients of a route, in least recently used
+    order. Buckets left idle long enough to refill are dropped, as a full
+    bucket behaves as a missing one, and the number of buckets is bounded.
+    """
+
+    def __init__(self, rate, burst, max_keys=constants.RATE_LIMIT_MAX_KEYS):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.refill_time = burst / rate
+        # key -> [tokens, last update]
+        self._buckets = OrderedDict()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def consume(self, key, now=None):
+        """Takes a token out of the bucket of ``key``.
+
+        Returns:
+            tuple: ``(allowed, remaining tokens, seconds until a token is available)``
+        """
+        if now is None:
+            now = time.monotonic()
+
+        bucket = self._buckets.pop(key, None)
+        if bucket is None:
+            tokens = self.burst
+        else:
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self._buckets[key] = [tokens, now]
+        self.evict(now)
+
+        wait = 0 if tokens >= 1 else (1 - tokens) / self.rate
+        return allowed, int(tokens), wait
+
+    def evict(self, now):
+        buckets = self._buckets
+        while len(buckets) > self.max_keys:
+            buckets.popitem(last=False)
+        while buckets:
+            key, (_, updated) = next(iter(buckets.items()))
+            if now - updated < self.refill_time:
+                break
+            del buckets[key]
+
+
+class RateLimiter(object):
+    """Token bucket rate limit of an api entrypoint, per client.
+
+    Args:
+        rate (str): Sustained rate, such as ``'100/minute'``.
+        burst (int): Bucket size, requests a client can make at once.
+            Defaults to the count of ``rate``.
+        key: Identifies clients, ``'ip'``, ``'origin'``, ``'header:<name>'``
+            or a callable receiving the request and its context data.
+        max_keys (int): Maximum number of clients tracked at once.
+    """
+
+    def __init__(self, rate, burst=None, key='ip', max_keys=constants.RATE_LIMIT_MAX_KEYS):
+        count, period = parse_rate(rate)
+        self.limit = burst if burst is not None else count
+        self.key = get_key_func(key)
+        self.store = TokenBucketStore(float(count) / period, self.limit, max_keys)
+
+    @classmethod
+    def from_config(cls, value):
+        """Build a limiter out of the ``rate_limit`` api argument: a limiter,
+        a rate string or a dict of keyword arguments.
+        """
+        if isinstance(value, cls):
+            return value
+        if isinstance(value, dict):
+            return cls(**value)
+        return cls(rate=value)
+
+    def check(self, request, context_data):
+        """Consumes a token of the client making the request.
+
+        Returns:
+            dict: ``X-RateLimit-*`` headers to add to the response.
+
+        Raises:
+            HttpTooManyRequests: The client exceeded its rate limit.
+        """
+        allowed, remaining, wait = self.store.consume(self.key(request, context_data))
+        headers = {
+            'X-RateLimit-Limit': str(self.limit),
+            'X-RateLimit-Remaining': str(remaining),
+            'X-RateLimit-Reset': str(int(math.ceil(wait))),
+        }
+        if not allowed:
+            headers['Retry-After'] = headers['X-RateLimit-Reset']
+            raise HttpTooManyRequests('Rate limit exceeded', headers=headers)
+        return headers
@@ -0,0 +1,120 @@
+from werkzeug.exceptions import HTTPException
+from werkzeug.routing import Map
+
+
+def split_path(path):
+    return path.lstrip('/').split('/')
+
+
+def static_prefix(path):
+    """Returns the leading static segments of the path of a rule, short of
+    its last segment, which may match differently once slashes are merged
+    or redirected.
+    """
+    prefix = []
+    for segment in split_path(path)[:-1]:
+        if '<' in segment:
+            break
+        prefix.append(segment)
+    return tuple(prefix)
+
+
+def is_static(rule):
+    return not (rule.arguments or rule.defaults or rule.redirect_to or rule.build_only)
+
+
+class PrefixNode(object):
+    """Node of the static prefix trie of the dynamic rules, one per path
+    segment.
+
+    Attributes:
+        children (dict): Nodes of the next segments, by segment.
+        rules (list): Rules whose static prefix ends at this node.
+        adapter (werkzeug.routing.MapAdapter): Matches the rules of this
+            node and of its ancestors, ``None`` if there are none.
+    """
+
+    def __init__(self):
+        self.children = {}
+        self.rules = []
+        self.adapter = None
+
+
+class CompiledRouter(object):
+    """Route index compiled out of a werkzeug url map, so that matching does
+    not try every rule of the map in turn.
+
+    Static paths are looked up in a dict of ``path -> method -> endpoint``.
+    Dynamic rules are indexed in a trie by the static segments their path
+    starts with, such as ``/api/users`` for ``/api/users/<int:user_id>``. A
+    request walks the trie along its path and only tries the rules of the
+    deepest node it reaches and of its ancestors, matched by a smaller map
+    so that werkzeug still orders them.
+
+    Requests neither index matches, such as those getting a 404, a 405 or a
+    redirect, are left to the url map.
+
+    Args:
+        url_map (werkzeug.routing.Map): Routes of the api entrypoints.
+    """
+
+    def __init__(self, url_map):
+        self.static = {}
+        self.root = PrefixNode()
+
+        for rule in url_map.iter_rules():
+            if is_static(rule):
+                methods = self.static.setdefault(rule.rule, {})
+                for method in rule.methods or (None,):
+                    methods.setdefault(method, rule.endpoint)
+                continue
+
+            node = self.root
+            for segment in static_prefix(rule.rule):
+                node = node.children.setdefault(segment, PrefixNode())
+            node.rules.append(rule)
+
+        self._compile(self.root, [], None, url_map)
+
+    def _compile(self, node, inherited, adapter, url_map):
+        rules = inherited + node.rules
+        if node.rules:
+            adapter = self._bind(rules, url_map)
+        node.adapter = adapter
+        for child in node.children.values():
+            self._compile(child, rules, adapter, url_map)
+
+    @staticmethod
+    def _bind(rules, url_map):
+        sub_map = Map(
+            [rule.empty() for rule in rules],
+            strict_slashes=url_map.strict_slashes,
+            merge_slashes=url_map.merge_slashes,
+            converters=url_map.converters,
+        )
+        return sub_map.bind('localhost')
+
+    def match(self, path, method):
+        """Returns ``(endpoint, path values)`` of the rule matching ``path``
+        and ``method``, ``None`` if the index has no match.
+        """
+        methods = self.static.get(path)
+        if methods is not None:
+            endpoint = methods.get(method) or methods.get(None)
+            if endpoint is not None:
+                return endpoint, {}
+            # the method may be one of a dynamic rule
+
+        node = self.root
+        adapter = node.adapter
+        for segment in split_path(path):
+            node = node.children.get(segment)
+            if node is None:
+                break
+            adapter = node.adapter
+        if adapter is None:
+            return None
+        try:
+            return adapter.match(path, method)
+        except HTTPException:
+            return None
@@ -0,0 +1,152 @@
+from nameko.exceptions import ConfigurationError
+
+from nameko_http.exceptions import HttpValidationError
+
+try:
+    import jsonschema
+except ImportError:  # pragma: no cover
+    jsonschema = None
+
+
+JSON_TYPES = {
+    dict: 'object',
+    list: 'array',
+    str: 'string',
+    int: 'integer',
+    float: 'number',
+    bool: 'boolean',
+    type(None): 'null',
+}
+
+
+def _join(path, key):
+    if isinstance(key, int):
+        return '{}[{}]'.format(path, key)
+    return '{}.{}'.format(path, key) if path else key
+
+
+def _type_name(types):
+    return ' or '.join(JSON_TYPES.get(type_, type_.__name__) for type_ in types)
+
+
+def _compile_spec(spec):
+    """Compiles a simple spec into a function yielding ``(path, message)``
+    pairs for each error of the value it is given.
+    """
+    if isinstance(spec, dict):
+        fields = []
+        for key, field_spec in spec.items():
+            required = not key.endswith('?')
+            fields.append((key.rstrip('?'), required, _compile_spec(field_spec)))
+
+        def check_object(value, path):
+            if not isinstance(value, dict):
+                yield path, 'Expected object'
+                return
+            for name, required, check in fields:
+                if name in value:
+                    yield from check(value[name], _join(path, name))
+                elif required:
+                    yield _join(path, name), 'Field is required'
+        return check_object
+
+    if isinstance(spec, list):
+        if len(spec) != 1:
+            raise ConfigurationError('List specs should hold the spec of their items')
+        check_item = _compile_spec(spec[0])
+
+        def check_array(value, path):
+            if not isinstance(value, list):
+                yield path, 'Expected array'
+                return
+            for index, item in enumerate(value):
+                yield from check_item(item, _join(path, index))
+        return check_array
+
+    types = spec if isinstance(spec, tuple) else (spec,)
+    if not all(isinstance(type_, type) for type_ in types):
+        raise ConfigurationError('Unsupported schema spec `{!r}`'.format(spec))
+    # bool is a subclass of int, but true isn't a number in JSON
+    rejects_bool = bool not in types
+    if float in types and int not in types:
+        types += (int,)
+
+    message = 'Expected {}'.format(_type_name(spec if isinstance(spec, tuple) else (spec,)))
+
+    def check_type(value, path):
+        if not isinstance(value, types) or (rejects_bool and isinstance(value, bool)):
+            yield path, message
+    return check_type
+
+
+def is_json_schema(schema):
+    return isinstance(schema, dict) and (
+        '$schema' in schema or isinstance(schema.get('type'), str)
+    )
+
+
+class SchemaValidator(object):
+    """Request body validator, compiled once out of a JSON Schema or of a
+    simple spec.
+
+    Simple specs map field names to a type, a tuple of types, a nested spec,
+    or a one item list holding the spec of array items. Fields whose name
+    ends with ``?`` are optional::
+
+        {'name': str, 'price': float, 'tags?': [str], 'owner': {'id': int}}
+
+    JSON Schemas, recognised by their ``$schema`` or ``type`` keyword, need
+    the ``jsonschema`` library.
+
+    Args:
+        schema (dict): JSON Schema or simple spec.
+
+    Raises:
+        ConfigurationError: Invalid schema, or ``jsonschema`` not installed.
+    """
+
+    def __init__(self, schema):
+        self.schema = schema
+        if is_json_schema(schema):
+            if jsonschema is None:
+                raise ConfigurationError('JSON Schema validation needs `jsonschema` installed')
+            validator_cls = jsonschema.validators.validator_for(schema)
+            try:
+                validator_cls.check_schema(schema)
+            except jsonschema.SchemaError as exc:
+                raise ConfigurationError('Invalid JSON Schema: {}'.format(exc.message))
+            self._validator = validator_cls(schema)
+            self._check = self._check_json_schema
+        else:
+            self._check = _compile_spec(schema)
+
+    @classmethod
+    def from_config(cls, value):
+        """Build a validator out of the ``schema`` api argument."""
+        if isinstance(value, cls):
+            return value
+        return cls(value)
+
+    def _check_json_schema(self, value, path):
+        for error in self._validator.iter_errors(value):
+            error_path = path
+            for key in error.absolute_path:
+                error_path = _join(error_path, key)
+            yield error_path, error.message
+
+    def errors(self, value):
+        """Returns the errors of ``value``, as dicts with the ``path`` of the
+        invalid field, empty for the body itself, and a ``message``.
+        """
+        return [
+            {'path': path, 'message': message}
+            for path, message in self._check(value, '')
+        ]
+
+    def validate(self, value):
+        """Raises:
+            HttpValidationError: ``value`` doesn't match the schema.
+        """
+        errors = self.errors(value)
+        if errors:
+            raise HttpValidationError('Request body does not match the schema', errors=errors)
@@ -0,0 +1,314 @@
+import datetime
+import decimal
+import json
+import uuid
+from collections import OrderedDict
+from functools import lru_cache
+
+import mimeparse
+from nameko.exceptions import ConfigurationError
+
+from nameko_http import constants
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import ujson
+except ImportError:  # pragma: no cover
+    ujson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+
+def default(obj):
+    """Serializes types that json libraries don't handle out of the box."""
+    if isinstance(obj, (datetime.datetime, datetime.date, datetime.time)):
+        return obj.isoformat()
+    if isinstance(obj, uuid.UUID):
+        return str(obj)
+    if isinstance(obj, decimal.Decimal):
+        return str(obj)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError(
+        'Object of type {} is not JSON serializable'.format(type(obj).__name__)
+    )
+
+
+class JsonCodec(object):
+    """JSON codec backed by the standard library."""
+    name = 'json'
+
+    def dumps(self, obj):
+        return json.dumps(
+            obj, default=default, separators=(',', ':'), ensure_ascii=False
+        ).encode('utf-8')
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class UJsonCodec(JsonCodec):
+    name = 'ujson'
+
+    def dumps(self, obj):
+        return ujson.dumps(obj, default=default, ensure_ascii=False).encode('utf-8')
+
+    def loads(self, data):
+        return ujson.loads(data)
+
+
+class OrjsonCodec(JsonCodec):
+    name = 'orjson'
+
+    def dumps(self, obj):
+        return orjson.dumps(obj, default=default, option=orjson.OPT_NON_STR_KEYS)
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+
+CODECS = {
+    'orjson': (OrjsonCodec, orjson),
+    'ujson': (UJsonCodec, ujson),
+    'json': (JsonCodec, json),
+}
+
+
+def get_codec(name='auto'):
+    """Returns a json codec by name.
+
+    Args:
+        name (str): One of ``'orjson'``, ``'ujson'``, ``'json'`` or ``'auto'``,
+            which picks the fastest installed library.
+
+    Returns:
+        JsonCodec
+
+    Raises:
+        ConfigurationError: Unknown codec or library not installed.
+    """
+    if name == 'auto':
+        for candidate in ('orjson', 'ujson', 'json'):
+            codec_cls, module = CODECS[candidate]
+            if module is not None:
+                return codec_cls()
+
+    try:
+        codec_cls, module = CODECS[name]
+    except KeyError:
+        raise ConfigurationError('Unknown json codec `{}`'.format(name))
+    if module is None:
+        raise ConfigurationError('Json codec `{}` is not installed'.format(name))
+    return codec_cls()
+
+
+_codec = get_codec()
+
+
+def dumps(obj):
+    """Serializes ``obj`` straight to json encoded bytes."""
+    return _codec.dumps(obj)
+
+
+def loads(data):
+    """Parses json from bytes or text."""
+    return _codec.loads(data)
+
+
+class JsonMediaCodec(object):
+    """Codec of ``application/json`` bodies, using the given json codec.
+
+    Codecs using the same json library are equal, as they encode alike.
+    """
+    name = 'json'
+
+    def __init__(self, json_codec):
+        self.json_codec = json_codec
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, JsonMediaCodec) and
+            self.json_codec.name == other.json_codec.name
+        )
+
+    def __hash__(self):
+        return hash(self.json_codec.name)
+
+    def dumps(self, obj):
+        return self.json_codec.dumps(obj)
+
+    def loads(self, data):
+        return self.json_codec.loads(data)
+
+
+class MsgpackCodec(object):
+    """Codec of ``application/msgpack`` bodies."""
+    name = 'msgpack'
+
+    def dumps(self, obj):
+        return msgpack.packb(obj, default=default, use_bin_type=True)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+# codecs only registered when enabled in config, so that installing their
+# library doesn't change the media types a service accepts
+OPTIONAL_MEDIA_CODECS = {
+    'msgpack': (MsgpackCodec, msgpack, ('application/msgpack', 'application/x-msgpack')),
+}
+
+
+class MediaCodecs(object):
+    """Codecs of request and response bodies by media type, which a web
+    server negotiates requests with, so that services sharing a runner may
+    each be configured with their own.
+
+    Args:
+        json_codec (JsonCodec): Codec of ``application/json`` bodies.
+
+    Attributes:
+        codecs (collections.OrderedDict): Codecs by media type, in order of
+            preference.
+    """
+
+    def __init__(self, json_codec=None):
+        self.json_codec = json_codec or get_codec()
+        self.codecs = OrderedDict()
+        # negotiation results are memoized on the raw header values, as in utils
+        self.negotiate_media_type = lru_cache(
+            maxsize=constants.NEGOTIATION_CACHE_SIZE)(self.negotiate_media_type)
+        self.content_media_type = lru_cache(
+            maxsize=constants.NEGOTIATION_CACHE_SIZE)(self.content_media_type)
+        self.register('application/json', JsonMediaCodec(self.json_codec))
+
+    @classmethod
+    def from_config(cls, config):
+        """Build the codecs of a service: json encoded with the library of
+        its ``HTTP_JSON_CODEC`` config, the codecs registered with
+        ``register_media_codec`` and the optional ones enabled in its
+        ``HTTP_MEDIA_CODECS`` config.
+
+        Raises:
+            ConfigurationError: Unknown codec or library not installed.
+        """
+        media_codecs = cls(get_codec(config.get(constants.JSON_CODEC_CONFIG_KEY) or 'auto'))
+        for media_type, codec in MEDIA_CODECS.items():
+            if not isinstance(codec, JsonMediaCodec):
+                media_codecs.register(media_type, codec)
+        for name in config.get(constants.MEDIA_CODECS_CONFIG_KEY) or ():
+            media_codecs.enable(name)
+        return media_codecs
+
+    def dumps(self, obj):
+        """Serializes ``obj`` to json encoded bytes with the json codec."""
+        return self.json_codec.dumps(obj)
+
+    def loads(self, data):
+        """Parses json from bytes or text with the json codec."""
+        return self.json_codec.loads(data)
+
+    def register(self, media_type, codec):
+        """Adds a codec for request and response bodies of ``media_type``,
+        the codecs registered first being preferred when the client accepts
+        several.
+
+        Args:
+            media_type (str): Media type, such as ``'application/msgpack'``.
+            codec: Object with ``dumps(obj) -> bytes`` and ``loads(data)``
+                methods, the latter raising ``ValueError`` on malformed data,
+                and a ``name`` used in error messages.
+        """
+        self.codecs[media_type.lower()] = codec
+        self.negotiate_media_type.cache_clear()
+        self.content_media_type.cache_clear()
+
+    def enable(self, name):
+        """Registers an optional codec by name, such as ``'msgpack'``.
+
+        Raises:
+            ConfigurationError: Unknown codec or library not installed.
+        """
+        try:
+            codec_cls, module, media_types = OPTIONAL_MEDIA_CODECS[name]
+        except KeyError:
+            raise ConfigurationError('Unknown media codec `{}`'.format(name))
+        if module is None:
+            raise ConfigurationError('Media codec `{}` is not installed'.format(name))
+        for media_type in media_types:
+            self.register(media_type, codec_cls())
+
+    def media_codec(self, media_type):
+        """Returns the codec of ``media_type``, the json one if it has none."""
+        return self.codecs.get(media_type) or self.codecs['application/json']
+
+    def names(self):
+        names = []
+        for codec in self.codecs.values():
+            if codec.name not in names:
+                names.append(codec.name)
+        return names
+
+    def negotiate_media_type(self, accept):
+        """Returns the registered media type the client prefers according
+        to the quality values of its ``Accept`` header, ``None`` if it
+        accepts none.
+        """
+        codecs = self.codecs
+        if accept in codecs:
+            return accept
+        if accept == '*/*':
+            return next(iter(codecs))
+        try:
+            # ties go to the last of the supported media types
+            return mimeparse.best_match(list(reversed(codecs)), accept) or None
+        except ValueError:
+            return None
+
+    def content_media_type(self, content_type):
+        """Returns the registered media type of a ``Content-Type`` header,
+        ``application/*+json`` counting as json, ``None`` if it has no codec.
+        """
+        if not content_type:
+            return None
+        media_type = content_type.split(';', 1)[0].strip().lower()
+        if media_type in self.codecs:
+            return media_type
+        if media_type.startswith('application/') and media_type.endswith('+json'):
+            return 'application/json'
+        return None
+
+
+# codecs of code running outside of a web server, such as streamed
+# responses, which services start theirs from
+default_media_codecs = MediaCodecs(_codec)
+
+# media type -> codec, in order of preference
+MEDIA_CODECS = default_media_codecs.codecs
+negotiate_media_type = default_media_codecs.negotiate_media_type
+content_media_type = default_media_codecs.content_media_type
+
+
+def register_media_codec(media_type, codec):
+    """Adds a codec for request and response bodies of ``media_type`` to
+    the services started afterwards, see ``MediaCodecs.register``.
+    """
+    default_media_codecs.register(media_type, codec)
+
+
+def media_codec(media_type):
+    """Returns the default codec of ``media_type``, the json one if it has
+    none.
+    """
+    return default_media_codecs.media_codec(media_type)
+
+
+def media_codec_names():
+    return default_media_codecs.names()
@@ -1,17 +1,267 @@
-from nameko.web.server import WebServer as BaseWebServer
+import os
+import socket
+import time
+from logging import getLogger
+
+import eventlet
+from eventlet.greenio import GreenSocket
+from nameko.exceptions import ConfigurationError
+from nameko.web.server import WebServer as BaseWebServer, WsgiApp as BaseWsgiApp
+from werkzeug.exceptions import HTTPException
+from werkzeug.wrappers import Request, Response
+from werkzeug.wsgi import ClosingIterator
+
+from nameko_http import constants
+from nameko_http.accesslog import AccessLog
+from nameko_http.admission import Bulkhead, Limiter
+from nameko_http.batch import BatchHandler
+from nameko_http.deadlines import DeadlineContextData
+from nameko_http.cache import ResponseCache
+from nameko_http.idempotency import MemoryIdempotencyStore
+from nameko_http.metrics import render_metrics
+from nameko_http.profiling import Profiler
+from nameko_http.routing import CompiledRouter
+from nameko_http.serialization import MediaCodecs
+
+
+_log = getLogger(__name__)
+
+
+class WsgiApp(BaseWsgiApp):
+    """WSGI application that serves the built-in routes of the web server
+    before dispatching requests to entrypoints.
+    """
+
+    def __init__(self, server):
+        super().__init__(server)
+        batch = server.container.config.get(constants.BATCH_CONFIG_KEY)
+        self.batch = BatchHandler.from_config(server, self.url_map, batch) if batch else None
+
+        router = server.container.config.get(constants.ROUTER_CONFIG_KEY, 'werkzeug')
+        if router not in ('werkzeug', 'compiled'):
+            raise ConfigurationError(
+                'Unknown router `{}`. Should be `werkzeug` or `compiled`'.format(router)
+            )
+        self.router = CompiledRouter(self.url_map) if router == 'compiled' else None
+
+    def __call__(self, environ, start_response):
+        server = self.server
+        server.request_started()
+        try:
+            app_iter = self.dispatch(environ, start_response)
+        except BaseException:
+            server.request_finished()
+            raise
+        # the request is over once its response has been sent
+        return ClosingIterator(app_iter, server.request_finished)
+
+    def dispatch(self, environ, start_response):
+        path = environ.get('PATH_INFO')
+        if path == self.server.health_path:
+            return self.server.health_response()(environ, start_response)
+        if path == self.server.metrics_path:
+            return self.server.metrics_response()(environ, start_response)
+        if self.batch is not None and path == self.batch.path:
+            return self.batch(environ, start_response)
+        if self.router is not None:
+            # PATH_INFO holds the utf-8 bytes of the path decoded as latin-1
+            path = (path or '').encode('latin-1').decode('utf-8', 'replace')
+            match = self.router.match(path, environ['REQUEST_METHOD'])
+            if match is not None:
+                request = Request(environ, shallow=True)
+                provider, request.path_values = match
+                try:
+                    rv = provider.handle_request(request)
+                except HTTPException as exc:
+                    rv = exc
+                return rv(environ, start_response)
+        # unmatched requests get their 404, 405 or redirect from the url map
+        return super().__call__(environ, start_response)
 
 
 class WebServer(BaseWebServer):
 
+    def __init__(self):
+        super().__init__()
+        self.pools = {}
+        self.started_at = None
+        self.in_flight = 0
+        self.requests = 0
+        self.draining = False
+        # route -> RouteMetrics, shared by the entrypoints of the route
+        self.route_metrics = {}
+
     @property
     def sharing_key(self):
         # fixes issue described on the following topic
         # https://discourse.nameko.io/t/webserver-can-be-subclassed-but-is-not-work-for-me/266
         return BaseWebServer
 
+    def setup(self):
+        config = self.container.config
+        cache_config = config.get(constants.CACHE_CONFIG_KEY) or {}
+        self.response_cache = ResponseCache(**cache_config)
+        idempotency_config = config.get(constants.IDEMPOTENCY_CONFIG_KEY) or {}
+        self.idempotency_store = MemoryIdempotencyStore(**idempotency_config)
+        self.metrics_path = config.get(constants.METRICS_PATH_CONFIG_KEY)
+        admission = config.get(constants.ADMISSION_CONFIG_KEY)
+        self.admission_limiter = Limiter.from_config('service', admission) if admission else None
+        profiling = config.get(constants.PROFILING_CONFIG_KEY)
+        self.profiler = Profiler.from_config(profiling) if profiling else None
+        access_log = config.get(constants.ACCESS_LOG_CONFIG_KEY)
+        self.access_log = AccessLog.from_config(access_log) if access_log else None
+        self.media_codecs = MediaCodecs.from_config(config)
+
+        options = dict(constants.SERVER_DEFAULTS)
+        server_config = config.get(constants.SERVER_CONFIG_KEY) or {}
+        unknown = set(server_config) - set(options)
+        if unknown:
+            raise ConfigurationError('Unknown {} options: {}'.format(
+                constants.SERVER_CONFIG_KEY, ', '.join(sorted(unknown))
+            ))
+        options.update(server_config)
+        self.backlog = options['backlog']
+        self.reuse_port = options['reuse_port']
+        self.keepalive = options['keepalive']
+        self.drain_timeout = options['drain_timeout']
+        self.health_path = options['health_path']
+        self.listen_fd = options['fd']
+        super().setup()
+
+    def start(self):
+        if not self._starting:
+            self._starting = True
+            self.started_at = time.time()
+            self._sock = self.listen()
+            # work around https://github.com/celery/kombu/issues/838
+            self._sock.settimeout(None)
+            self._serv = self.get_wsgi_server(self._sock, self.get_wsgi_app())
+            self._serv.keepalive = self.keepalive
+            self._gt = self.container.spawn_managed_thread(self.run)
+            if self.access_log is not None:
+                self.access_log.start()
+
+    def listen(self):
+        """Returns the listening socket, inherited from the parent process
+        when its descriptor is configured as ``fd``, otherwise bound with
+        ``SO_REUSEPORT`` if enabled so that processes can share the port.
+        """
+        if self.listen_fd is not None:
+            return GreenSocket(socket.socket(fileno=os.dup(self.listen_fd)))
+        return eventlet.listen(self.bind_addr, backlog=self.backlog, reuse_port=self.reuse_port)
+
+    def unregister_provider(self, provider):
+        # entrypoints unregister as the container stops
+        self.start_draining()
+        super().unregister_provider(provider)
+
+    def start_draining(self):
+        """Stops accepting connections, and closes open ones once their
+        current request is over.
+        """
+        if self.draining:
+            return
+        self.draining = True
+        if self._gt is not None:
+            self._is_accepting = False
+            self._gt.kill()
+            self._sock.close()
+            self._serv.keepalive = False
+
+    def stop(self):
+        """Waits up to ``drain_timeout`` seconds for the requests being
+        handled to complete before stopping.
+        """
+        self.start_draining()
+        self.drain(self.drain_timeout)
+        super().stop()
+        if self.access_log is not None:
+            self.access_log.stop()
+
+    def kill(self):
+        if self.access_log is not None:
+            self.access_log.kill()
+
+    def drain(self, timeout):
+        """Waits for in-flight requests, returns whether they all completed."""
+        deadline = time.monotonic() + timeout
+        while self.in_flight and time.monotonic() < deadline:
+            eventlet.sleep(constants.SERVER_DRAIN_POLL_INTERVAL)
+        if self.in_flight:
+            _log.warning('%s requests still in flight after draining', self.in_flight)
+        return not self.in_flight
+
+    def request_started(self):
+        self.in_flight += 1
+        self.requests += 1
+
+    def request_finished(self):
+        self.in_flight -= 1
+
+    def get_wsgi_app(self):
+        return WsgiApp(self)
+
+    def health_response(self):
+        """Health of the serving process, ``503`` once it is draining."""
+        return Response(
+            self.media_codecs.dumps({
+                'status': 'draining' if self.draining else 'ok',
+                'pid': os.getpid(),
+                'uptime': time.time() - self.started_at,
+                'in_flight': self.in_flight,
+                'requests': self.requests,
+            }),
+            status=503 if self.draining else 200,
+            mimetype='application/json',
+        )
+
+    def metrics_response(self):
+        """Per route metrics of all api entrypoints, in Prometheus text format."""
+        return Response(
+            render_metrics(self._providers, self.limiters()),
+            content_type='text/plain; version=0.0.4; charset=utf-8',
+        )
+
+    def get_pool(self, name):
+        """Returns the worker pool configured under ``name`` in ``HTTP_POOLS``,
+        shared by all the entrypoints that use it.
+        """
+        pool = self.pools.get(name)
+        if pool is None:
+            pools_config = self.container.config.get(constants.POOLS_CONFIG_KEY) or {}
+            if name not in pools_config:
+                raise ConfigurationError('Unknown worker pool `{}`'.format(name))
+            pool = self.pools[name] = Bulkhead.from_config(name, pools_config[name])
+
+            reserved = sum(pool.max_concurrency for pool in self.pools.values())
+            if reserved >= self.container.max_workers:
+                _log.warning(
+                    'Worker pools reserve %s workers, leaving none of the %s '
+                    'max workers to the other entrypoints',
+                    reserved, self.container.max_workers,
+                )
+        return pool
+
+    def limiters(self):
+        """Admission limiters and worker pools of the service and its api
+        entrypoints.
+        """
+        limiters = [self.admission_limiter] + list(self.pools.values())
+        for provider in self._providers:
+            limiters.append(getattr(provider, 'admission_limiter', None))
+            pool = getattr(provider, 'pool_limiter', None)
+            if pool is not None and pool.name not in self.pools:
+                limiters.append(pool)
+        return [limiter for limiter in limiters if limiter is not None]
+
     def context_data_from_headers(self, request):
         context_data = super().context_data_from_headers(request)
+        context_data['client_ip'] = request.remote_addr
         context_data['origin'] = request.headers.get('origin')
         context_data['methods'] = request.headers.get('access-control-request-method')
         context_data['headers'] = request.headers.get('access-control-request-headers')
+        # propagated to downstream services with the rest of the context data
+        deadline = getattr(request, 'deadline', None)
+        if deadline is not None:
+            return DeadlineContextData(context_data, deadline)
         return context_data
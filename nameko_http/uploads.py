@@ -0,0 +1,129 @@
+import hashlib
+import io
+import mmap
+import tempfile
+from logging import getLogger
+
+from nameko_http import constants
+
+
+_log = getLogger(__name__)
+
+
+class Upload(object):
+    """Request body spooled to a temporary file, kept in memory up to
+    ``max_memory_size`` bytes and moved to disk past it.
+
+    Args:
+        file: Body, positioned at its start: a ``BytesIO`` while in memory,
+            a ``tempfile.TemporaryFile`` once on disk.
+        size (int): Body size in bytes.
+        digests (dict): Hex digests of the body, by hash name.
+        in_memory (bool): Whether the body is held in memory.
+    """
+
+    def __init__(self, file, size, digests, in_memory):
+        self.file = file
+        self.size = size
+        self.digests = digests
+        self.in_memory = in_memory
+        self._mmap = None
+        self._views = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def view(self):
+        """Returns a read-only ``memoryview`` of the body, without copying
+        it: the buffer of the in-memory file, or a ``mmap`` of the file on
+        disk. Views are released when the upload is closed.
+        """
+        if self.in_memory:
+            buffer = self.file.getbuffer()
+            self._views.append(buffer)
+        elif self.size == 0:
+            return memoryview(b'')
+        else:
+            if self._mmap is None:
+                self._mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            buffer = memoryview(self._mmap)
+            self._views.append(buffer)
+        view = buffer.toreadonly()
+        self._views.append(view)
+        return view
+
+    def close(self):
+        """Releases the views handed out and closes the file. Slices of the
+        views still referenced keep the body open, it is then closed once
+        they are garbage collected.
+        """
+        for view in reversed(self._views):
+            view.release()
+        del self._views[:]
+        # the file on disk can be closed while its mmap is still exported
+        for closeable in (self._mmap, self.file):
+            if closeable is None:
+                continue
+            try:
+                closeable.close()
+            except BufferError:
+                _log.warning('Upload still referenced by a memoryview, closed once released')
+        self._mmap = None
+
+
+def read_upload(request, hashes=('sha256',),
+                max_memory_size=constants.UPLOAD_MAX_MEMORY_SIZE,
+                chunk_size=constants.UPLOAD_CHUNK_SIZE):
+    """Reads the request body into an ``Upload``, in chunks of
+    ``chunk_size`` bytes hashed as they are read, so that the memory held
+    per upload stays bounded by ``max_memory_size`` whatever the body size.
+
+    The body goes through the ``max_body_size`` limit of the entrypoint:
+    bodies declared larger are rejected before the worker starts, chunked
+    ones are cut off once they exceed it.
+
+    Args:
+        request (werkzeug.Request): Incoming nameko web request.
+        hashes (tuple): Names of the ``hashlib`` hashes computed.
+        max_memory_size (int): Bytes kept in memory before spooling to disk.
+        chunk_size (int): Number of bytes read from the stream at once.
+
+    Returns:
+        Upload: The body, to be closed once handled.
+
+    Raises:
+        HttpPayloadTooLarge: Chunked request body larger than `max_body_size`.
+    """
+    hashers = [(name, hashlib.new(name)) for name in hashes]
+    file = io.BytesIO()
+    in_memory = True
+
+    # bodies read already, to validate or fingerprint them, are kept
+    body = getattr(request, 'body', None)
+    stream = io.BytesIO(body) if body is not None else request.stream
+
+    size = 0
+    try:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            for _, hasher in hashers:
+                hasher.update(chunk)
+            size += len(chunk)
+            if in_memory and size > max_memory_size:
+                disk_file = tempfile.TemporaryFile()
+                with file.getbuffer() as buffer:
+                    disk_file.write(buffer)
+                file.close()
+                file, in_memory = disk_file, False
+            file.write(chunk)
+    except BaseException:
+        file.close()
+        raise
+
+    file.seek(0)
+    return Upload(file, size, {name: hasher.hexdigest() for name, hasher in hashers}, in_memory)
@@ -1,11 +1,15 @@
 # pylint: disable=missing-docstring
+import codecs
+import hashlib
 import json
+import re
 
 import mimeparse
 from nameko.exceptions import BadRequest
 from werkzeug.wrappers import Response
 
-from nameko_http.exceptions import HttpMalformedJSON
+from nameko_http import constants, serialization
+from nameko_http.exceptions import HttpMalformedJSON, HttpPayloadTooLarge
 
 
 def client_accepts_json(accept):
@@ -43,6 +47,7 @@ def is_json_request(mimetype):
         return False
     if ';' in mimetype:  # Allow Content-Type header to be parsed
         mimetype = get_mimetype(mimetype)
+    mimetype = mimetype.lower()
     if mimetype == 'application/json':
         return True
     if mimetype.startswith('application/') and mimetype.endswith('+json'):
@@ -50,10 +55,44 @@ def is_json_request(mimetype):
     return False
 
 
+def negotiation_cache_info(media_codecs=None):
+    """Returns hits, misses, size and hit rate of the negotiation caches of
+    ``media_codecs``, the default codecs if not given.
+    """
+    if media_codecs is None:
+        media_codecs = serialization.default_media_codecs
+    info = {}
+    for func in (media_codecs.negotiate_media_type, media_codecs.content_media_type):
+        hits, misses, _, size = func.cache_info()
+        total = hits + misses
+        info[func.__name__] = {
+            'hits': hits,
+            'misses': misses,
+            'size': size,
+            'hit_rate': float(hits) / total if total else 0.0,
+        }
+    return info
+
+
 def as_string(items):
     return ', '.join(items)
 
 
+def generate_etag(data):
+    """Returns a fast, collision resistant hash of a response body."""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def read_body(request):
+    """Returns the request body, read into memory once and kept on the
+    request as ``body``, so that ``read_upload`` can tell it was read.
+    """
+    body = getattr(request, 'body', None)
+    if body is None:
+        body = request.body = request.get_data()
+    return body
+
+
 def get_json(request):
     """Returns request payload as json. In case of malformed json or
     no body, an appropriate http error gets returned.
@@ -68,19 +107,296 @@ def get_json(request):
         HttpBadRequest: If client has sent empty request body.
         HttpError: Status code 753. If client has sent a malformed request data.
     """
-    body = request.get_data(as_text=True)
+    # already parsed when validated against the schema of the entrypoint
+    parsed = getattr(request, 'parsed_json', None)
+    if parsed is not None:
+        return parsed
+
+    body = read_body(request)
     if not body:
         raise BadRequest('Empty request body')
 
+    # decoded with the codec of the request media type, json by default,
+    # out of the codecs of the service the request was sent to
+    media_codecs = getattr(request, 'media_codecs', None) or serialization.default_media_codecs
+    codec = media_codecs.media_codec(
+        media_codecs.content_media_type(request.headers.get('content-type'))
+    )
     try:
-        return json.loads(body)
+        return codec.loads(body)
     except ValueError:
         raise HttpMalformedJSON('Malformed JSON. Could not decode the request body.')
 
 
+def iter_json_items(request, chunk_size=constants.JSON_STREAM_CHUNK_SIZE,
+                    max_item_size=constants.JSON_STREAM_MAX_ITEM_SIZE):
+    """Parses a request body holding a JSON array incrementally, reading
+    ``request.stream`` in chunks and yielding one array item at a time.
+    Only the item being parsed is held in memory, which allows handling
+    bulk payloads of any size.
+
+    Args:
+        req (werkzeug.Request): Incoming nameko web request.
+        chunk_size (int): Number of bytes read from the stream at once.
+        max_item_size (int): Characters read ahead to decode an item, items
+            that can't be decoded within them are rejected.
+
+    Yields:
+        Top-level items of the JSON array.
+
+    Raises:
+        HttpBadRequest: If client has sent empty request body.
+        HttpError: Status code 753. If request body is not a well formed JSON array.
+    """
+    reader = _JsonStreamReader(request.stream, chunk_size, max_item_size)
+
+    char = reader.next_char()
+    if char is None:
+        raise BadRequest('Empty request body')
+    if char != '[':
+        raise HttpMalformedJSON('Malformed JSON. Expected an array.')
+    reader.advance()
+
+    if reader.next_char() == ']':
+        reader.advance()
+    else:
+        while True:
+            yield reader.decode_value()
+            char = reader.next_char()
+            reader.advance()
+            if char == ']':
+                break
+            if char != ',':
+                raise HttpMalformedJSON('Malformed JSON. Could not decode the request body.')
+
+    if reader.next_char() is not None:
+        raise HttpMalformedJSON('Malformed JSON. Unexpected data after the array.')
+
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+# characters a number cut by the end of a chunk may go on with
+_NUMBER_CHARS = frozenset('.eE+-0123456789')
+
+
+class _JsonStreamReader(object):
+
+    decoder = json.JSONDecoder()
+
+    def __init__(self, stream, chunk_size, max_item_size):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.max_item_size = max_item_size
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        if self.eof:
+            return False
+
+        chunk = self.stream.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+        try:
+            text = self.text_decoder.decode(chunk, final=self.eof)
+        except UnicodeDecodeError:
+            raise HttpMalformedJSON('Malformed JSON. Could not decode the request body.')
+
+        self.buffer = self.buffer[self.pos:] + text
+        self.pos = 0
+        return True
+
+    def advance(self):
+        self.pos += 1
+
+    def next_char(self):
+        while True:
+            self.pos = _WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return None
+
+    def read_ahead(self):
+        """Reads the next chunk, unless ``max_item_size`` characters are
+        buffered already past the item being decoded.
+        """
+        if len(self.buffer) - self.pos >= self.max_item_size:
+            return False
+        return self.fill()
+
+    def decode_value(self):
+        self.next_char()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                if not self.read_ahead():
+                    raise HttpMalformedJSON('Malformed JSON. Could not decode the request body.')
+                continue
+
+            # numbers cut by the end of a chunk, such as `1.` out of `1.5`,
+            # decode to their first part
+            if (
+                isinstance(value, (int, float)) and not isinstance(value, bool) and
+                (end == len(self.buffer) or self.buffer[end] in _NUMBER_CHARS) and
+                self.read_ahead()
+            ):
+                continue
+
+            self.pos = end
+            return value
+
+
+class BoundedStream(object):
+    """Wraps a request input stream and raises ``HttpPayloadTooLarge`` as
+    soon as more than ``limit`` bytes are read from it. Used for request
+    bodies without ``Content-Length``, such as chunked ones.
+    """
+
+    def __init__(self, stream, limit):
+        self.stream = stream
+        self.limit = limit
+        self.consumed = 0
+
+    def _count(self, data):
+        self.consumed += len(data)
+        if self.consumed > self.limit:
+            raise HttpPayloadTooLarge(
+                'Request body exceeds {} bytes'.format(self.limit)
+            )
+        return data
+
+    def read(self, size=-1):
+        # read at most one byte past the limit, enough to tell it was exceeded
+        remaining = self.limit - self.consumed + 1
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        return self._count(self.stream.read(size))
+
+    def readline(self, size=-1):
+        remaining = self.limit - self.consumed + 1
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        return self._count(self.stream.readline(size))
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+
+def limit_body_size(request, max_body_size):
+    """Rejects bodies whose declared length is over ``max_body_size`` before
+    reading any of them, and bounds bodies of unknown length. To be called
+    before ``request.stream`` is first used.
+
+    Raises:
+        HttpPayloadTooLarge: Declared body length over ``max_body_size``.
+    """
+    content_length = request.content_length
+    if content_length is not None:
+        if content_length > max_body_size:
+            raise HttpPayloadTooLarge('Request body exceeds {} bytes'.format(max_body_size))
+    elif is_chunked(request):
+        environ = request.environ
+        environ['wsgi.input'] = BoundedStream(environ['wsgi.input'], max_body_size)
+        # let werkzeug read the body up to its end, now that it is bounded
+        environ['wsgi.input_terminated'] = True
+
+
+def is_chunked(request):
+    return request.headers.get('transfer-encoding', '').lower() == 'chunked'
+
+
+class ApiResponse(Response):
+    """JSON response keeping the data it was built from, so that api
+    entrypoints can encode it again in the media type negotiated with the
+    client.
+    """
+
+    def __init__(self, data=None, status=200, headers=None):
+        super().__init__(
+            response=serialization.dumps(data) if data is not None else b'',
+            status=status,
+            headers=headers,
+            mimetype='application/json',
+        )
+        self.data_object = data
+        self.codec = serialization.media_codec('application/json')
+
+    def encode(self, media_type, media_codecs=None):
+        """Encodes the body in ``media_type`` with its codec out of
+        ``media_codecs``, the default codecs if not given, unless it already
+        is.
+        """
+        if media_codecs is None:
+            media_codecs = serialization.default_media_codecs
+        codec = media_codecs.media_codec(media_type)
+        if self.mimetype != media_type or codec != self.codec:
+            if self.data_object is not None:
+                self.set_data(codec.dumps(self.data_object))
+            self.mimetype = media_type
+            self.codec = codec
+        return self
+
+
 def api_response(status=200, data=None):
-    return Response(
-        response=json.dumps(data) if data is not None else '',
-        status=status,
-        mimetype='application/json'
-    )
+    return ApiResponse(data, status=status)
+
+
+def stream_response(records, status=200, ndjson=False, batch_size=100, headers=None):
+    """Returns a response that serializes ``records`` while it gets sent,
+    using chunked transfer encoding, so neither the whole payload is held
+    in memory nor the client waits for it before receiving the first bytes.
+
+    Records are consumed after the worker has finished, so the iterable
+    should not rely on resources released at worker teardown.
+
+    Args:
+        records (iterable): Records to serialize.
+        status (int): Response status code.
+        ndjson (bool): Write newline delimited JSON instead of a JSON array.
+        batch_size (int): Number of records serialized into each chunk.
+        headers (dict): Additional response headers.
+
+    Returns:
+        werkzeug.Response
+    """
+    if ndjson:
+        body = _iter_ndjson(records, batch_size)
+        mimetype = 'application/x-ndjson'
+    else:
+        body = _iter_json_array(records, batch_size)
+        mimetype = 'application/json'
+
+    return Response(response=body, status=status, headers=headers, mimetype=mimetype)
+
+
+def _iter_json_array(records, batch_size):
+    dumps = serialization.dumps
+    chunk = [b'[']
+    count = 0
+    for record in records:
+        if count:
+            chunk.append(b',')
+        chunk.append(dumps(record))
+        count += 1
+        if count % batch_size == 0:
+            yield b''.join(chunk)
+            chunk = []
+    chunk.append(b']')
+    yield b''.join(chunk)
+
+
+def _iter_ndjson(records, batch_size):
+    dumps = serialization.dumps
+    chunk = []
+    for record in records:
+        chunk.append(dumps(record))
+        chunk.append(b'\n')
+        if len(chunk) >= 2 * batch_size:
+            yield b''.join(chunk)
+            chunk = []
+    if chunk:
+        yield b''.join(chunk)
@@ -38,6 +38,10 @@ setup(
     name='nameko_http',
     packages=find_packages(include=['nameko_http']),
     extras_require={
+        'orjson': ['orjson>=2.0'],
+        'ujson': ['ujson>=5.0'],
+        'jsonschema': ['jsonschema>=3.0'],
+        'msgpack': ['msgpack>=1.0'],
         'dev': [
             'pip==18.1',
             'bumpversion==0.5.3',
@@ -57,6 +61,8 @@ setup(
     tests_require=[
         'pytest>=1.9.3',
         'requests-mock>=1.5.2',
+        'msgpack>=1.0',
+        'jsonschema>=3.0',
     ],
     url='https://github.com/tyler46/nameko_http',
     version='0.1.7',
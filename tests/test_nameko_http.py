@@ -3,20 +3,75 @@
 
 """Tests for `nameko_http` package."""
 
+import datetime
+import decimal
+import hashlib
+import io
 import json
+import signal
+import time
+import uuid
+from functools import partial
+
+import eventlet
 import pytest
+import requests
+
+from nameko.exceptions import ConfigurationError
+from nameko.testing.utils import find_free_port, get_extension
+from werkzeug.routing import Map, Rule
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request, Response
+
+from nameko_http import api, prefork
+from nameko_http.accesslog import AccessLog
+from nameko_http.admission import Limiter
+from nameko_http.cache import CachedResponse, ResponseCache
+from nameko_http.coalescing import SingleFlight
+from nameko_http.cors import CorsPolicy
+from nameko_http.deadlines import get_worker_thread, time_remaining, with_deadline
+from nameko_http.dependencies import Deadline, HttpCache
+from nameko_http.fanout import Call, fan_out
+from nameko_http.idempotency import IdempotencyRule, IdempotencyStore, MemoryIdempotencyStore
+from nameko_http.profiling import Profiler, StackSampler
+from nameko_http.ratelimit import TokenBucketStore
+from nameko_http.routing import CompiledRouter
+from nameko_http import schema
+from nameko_http.schema import SchemaValidator, jsonschema
+from nameko_http.serialization import MediaCodecs
+from nameko_http.server import WebServer
+from nameko_http.uploads import read_upload
+from nameko_http.exceptions import (
+    HttpGatewayTimeout, HttpIdempotencyKeyInUse, HttpMalformedJSON, HttpNotAcceptable,
+    HttpServiceUnavailable,
+)
+from nameko_http import serialization
+from nameko_http.utils import (
+    api_response, client_accepts_json, get_json, is_json_request, iter_json_items,
+    negotiation_cache_info, read_body, stream_response,
+)
+
 
-from nameko.testing.utils import get_extension
 
-from nameko_http import api
-from nameko_http.exceptions import HttpNotAcceptable
-from nameko_http.utils import api_response
+CALLS = []
 
 
+class StandInProxy(object):
+    """Local stand-in for the RPC proxy of a downstream service."""
+
+    def get(self, value, delay=0, fail=False):
+        eventlet.sleep(delay)
+        CALLS.append(value)
+        if fail:
+            raise ValueError('Service unavailable')
+        return value
+
 
 class ExampleService(object):
     name = 'exampleservice'
 
+    http_cache = HttpCache()
+
     @api('GET', '/foo/<int:bar>')
     def do_get(self, request, bar):
         return api_response(
@@ -66,11 +121,167 @@ class ExampleService(object):
     def handle_empty_body(self, request):
         return api_response(status=204)
 
+    @api('POST', '/echo')
+    def do_echo(self, request):
+        return api_response(status=200, data=get_json(request))
+
+    @api('POST', '/bulk', max_body_size=64)
+    def do_bulk(self, request):
+        return api_response(status=200, data={
+            'count': sum(1 for _ in iter_json_items(request, chunk_size=4))
+        })
+
+    @api('GET', '/export', cors_enabled=True)
+    def do_export(self, request):
+        ndjson = request.args.get('format') == 'ndjson'
+        records = ({'id': i} for i in range(int(request.args['count'])))
+        return stream_response(records, ndjson=ndjson, batch_size=10)
+
+    @api('GET', '/compressed', compress={'min_size': 100})
+    def do_compressed(self, request):
+        count = int(request.args['count'])
+        if request.args.get('stream'):
+            return stream_response(({'id': i} for i in range(count)), batch_size=10)
+        return api_response(status=200, data=[{'id': i} for i in range(count)])
+
+    @api('GET', '/etag', etag=True, compress=True)
+    def do_etag(self, request):
+        CALLS.append('etag')
+        return api_response(status=200, data={'value': request.args.get('value')})
+
+    @api('GET', '/versioned/<int:version>',
+         version_key=lambda request, version: 'v{}'.format(version))
+    def do_versioned(self, request, version):
+        CALLS.append('versioned')
+        return api_response(status=200, data={'version': version})
+
+    @api('GET', '/cached/<int:key>', cache={'ttl': 60, 'vary': ['Accept-Language']})
+    def do_cached(self, request, key):
+        CALLS.append(key)
+        return api_response(status=200, data={
+            'key': key, 'language': request.headers.get('Accept-Language')
+        })
+
+    @api('DELETE', '/cached/<int:key>')
+    def do_invalidate(self, request, key):
+        self.http_cache.invalidate('/cached/{}'.format(key))
+        return api_response(status=200, data=self.http_cache.stats())
+
+    @api('GET', '/coalesced', coalesce=True)
+    def do_coalesced(self, request):
+        CALLS.append('coalesced')
+        eventlet.sleep(0.1)
+        return api_response(status=200, data={
+            'calls': len(CALLS), 'user': request.headers.get('Authorization'),
+        })
+
+    @api('GET', '/admission', admission={'max_concurrency': 1, 'max_queue': 1})
+    def do_admission(self, request):
+        eventlet.sleep(0.1)
+        return api_response(status=200, data={'value': 1})
+
+    @api('GET', '/reports/daily', pool='reports')
+    def do_daily_report(self, request):
+        eventlet.sleep(0.1)
+        return api_response(status=200, data={'report': 'daily'})
+
+    @api('GET', '/reports/monthly', pool='reports')
+    def do_monthly_report(self, request):
+        eventlet.sleep(0.1)
+        return api_response(status=200, data={'report': 'monthly'})
+
+    @api('GET', '/limited', rate_limit={'rate': '2/minute', 'key': 'header:X-Api-Key'})
+    def do_limited(self, request):
+        return api_response(status=200, data={'value': 1})
+
+    @api('POST', '/validated', schema={'name': str, 'price': float, 'tags?': [str]})
+    def do_validated(self, request):
+        CALLS.append('validated')
+        return api_response(status=200, data=get_json(request))
+
+    deadline = Deadline()
+
+    @api('GET', '/deadline', timeout=1)
+    def do_deadline(self, request):
+        CALLS.append('started')
+        eventlet.sleep(float(request.args.get('sleep', 0)))
+        CALLS.append('completed')
+        return api_response(status=200, data={'remaining': self.deadline()})
+
+    @api('POST', '/orders', idempotency={'ttl': 60, 'wait_timeout': 1})
+    def do_create_order(self, request):
+        CALLS.append('order')
+        eventlet.sleep(float(request.args.get('sleep', 0)))
+        if request.args.get('fail'):
+            raise ValueError('Payment declined')
+        return api_response(status=201, data={'order': len(CALLS)})
+
+    @api('PUT', '/blobs', upload=True, max_body_size=4096)
+    def do_upload(self, request):
+        spool = int(request.args.get('spool', 1024))
+        with read_upload(request, hashes=('sha256', 'md5'), max_memory_size=spool) as upload:
+            view = upload.view()
+            head = bytes(view[:4]).decode()
+            view.release()
+            return api_response(status=200, data={
+                'size': upload.size, 'digests': upload.digests,
+                'in_memory': upload.in_memory, 'head': head,
+            })
+
+    @api('PUT', '/blobs/unbounded', upload=True)
+    def do_unbounded_upload(self, request):
+        with read_upload(request) as upload:
+            return api_response(status=200, data={'size': upload.size})
+
+    @api('GET', '/dashboard')
+    def do_dashboard(self, request):
+        proxy = StandInProxy()
+        result = fan_out({
+            'user': Call(proxy.get, ('user',), {'fail': 'fail' in request.args}),
+            'offers': Call(proxy.get, ('offers', 0, True), required=False, default=[]),
+        }, deadline=request.deadline)
+        return api_response(status=200, data={
+            'user': result['user'], 'offers': result['offers'],
+            'errors': result.error_details(),
+        })
+
+    @api('GET', '/malformed')
+    def do_malformed(self, request):
+        return Response(b'{"value":', mimetype='application/json')
+
+    @api('GET,POST', '/items', schema={'name': str})
+    def do_items(self, request):
+        return api_response(status=200, data={'method': request.method})
+
+    @api('GET', '/typed')
+    def do_typed(self, request):
+        return api_response(status=200, data={
+            'when': datetime.datetime(2019, 7, 10, 12, 30),
+            'id': uuid.UUID(int=1),
+            'amount': decimal.Decimal('10.50'),
+        })
+
+    @api('GET', '/cors_policy', cors=CorsPolicy(
+        origins=['https://app.example.com', 'https://*.example.org'],
+        methods=['GET'],
+        max_age=3600,
+    ))
+    def do_cors_policy(self, request):
+        return api_response(status=200, data={'value': 1})
+
 
 
 @pytest.fixture
 def web_session(container_factory, web_config, web_session):
-    container = container_factory(ExampleService, web_config)
+    config = dict(
+        web_config,
+        HTTP_METRICS_PATH='/metrics',
+        HTTP_POOLS={'reports': {'size': 1, 'overflow': 'reject'}},
+        HTTP_BATCH={'path': '/batch', 'max_size': 4, 'max_body_size': 1024},
+        HTTP_SERVER={'health_path': '/health', 'drain_timeout': 1},
+        HTTP_ROUTER='compiled',
+    )
+    container = container_factory(ExampleService, config)
     container.start()
     return web_session
 
@@ -178,3 +389,1458 @@ def test_empty_request_body(web_session):
     )
 
     assert rv.status_code == 204
+
+
+def test_options_cors_max_age(web_session):
+    rv = web_session.options(
+        '/cors_headers',
+        headers={'Access-Control-Request-Method': 'GET'}
+    )
+    assert rv.status_code == 200
+    assert rv.headers['Access-Control-Max-Age'] == '600'
+
+
+@pytest.mark.parametrize('origin', [
+    'https://app.example.com',
+    'https://api.example.org',
+])
+def test_cors_policy_allowed_origin(web_session, origin):
+    rv = web_session.options(
+        '/cors_policy',
+        headers={'Origin': origin, 'Access-Control-Request-Method': 'GET'}
+    )
+    assert rv.headers['Access-Control-Allow-Origin'] == origin
+    assert rv.headers['Access-Control-Allow-Methods'] == 'GET'
+    assert rv.headers['Access-Control-Max-Age'] == '3600'
+    assert rv.headers['Vary'] == 'Origin'
+
+
+@pytest.mark.parametrize('origin', [
+    'https://evil.com',
+    'https://example.org',
+    'http://api.example.org',
+])
+def test_cors_policy_rejected_origin(web_session, origin):
+    rv = web_session.get('/cors_policy', headers={'Origin': origin})
+    assert rv.status_code == 200
+    assert 'Access-Control-Allow-Origin' not in rv.headers
+
+
+def test_cors_policy_disallowed_method(web_session):
+    rv = web_session.options(
+        '/cors_policy',
+        headers={
+            'Origin': 'https://app.example.com',
+            'Access-Control-Request-Method': 'DELETE',
+        }
+    )
+    assert rv.headers['Access-Control-Allow-Methods'] == 'GET'
+
+
+def test_get_json(web_session):
+    rv = web_session.post('/echo', json={'value': 'fö'})
+    assert rv.status_code == 200
+    assert rv.json() == {'value': 'fö'}
+
+
+def test_get_json_malformed(web_session):
+    rv = web_session.post(
+        '/echo', data=b'{"value":', headers={'Content-Type': 'application/json'}
+    )
+    assert rv.status_code == 753
+    assert rv.json()['error_code'] == 'MALFORMED_JSON'
+
+
+def test_typed_response(web_session):
+    rv = web_session.get('/typed')
+    assert rv.json() == {
+        'when': '2019-07-10T12:30:00',
+        'id': '00000000-0000-0000-0000-000000000001',
+        'amount': '10.50',
+    }
+
+
+@pytest.mark.parametrize('name', ['json', 'orjson', 'auto'])
+def test_codecs(name):
+    pytest.importorskip(name if name != 'auto' else 'json')
+    codec = serialization.get_codec(name)
+    data = codec.dumps({'value': decimal.Decimal('1.5'), 'ids': {1}})
+    assert isinstance(data, bytes)
+    assert codec.loads(data) == {'value': '1.5', 'ids': [1]}
+
+
+def test_unknown_codec():
+    with pytest.raises(ConfigurationError):
+        serialization.get_codec('yaml')
+
+
+def test_max_body_size(web_session):
+    rv = web_session.post('/bulk', json=list(range(100)))
+    assert rv.status_code == 413
+    assert rv.json()['error_code'] == 'PAYLOAD_TOO_LARGE'
+
+
+def test_max_body_size_chunked(web_session):
+    def chunks():
+        yield b'['
+        for i in range(100):
+            yield b'1,'
+        yield b'1]'
+
+    rv = web_session.post(
+        '/bulk', data=chunks(), headers={'Content-Type': 'application/json'}
+    )
+    assert rv.status_code == 413
+
+
+def test_bulk_chunked(web_session):
+    rv = web_session.post(
+        '/bulk',
+        data=iter([b'[{"a": 1}, 12', b'34, "x,]"', b']']),
+        headers={'Content-Type': 'application/json'}
+    )
+    assert rv.status_code == 200
+    assert rv.json() == {'count': 3}
+
+
+@pytest.mark.parametrize('body, expected', [
+    (b'[]', []),
+    (b' [ 1 , 22 ,"a\\"b", {"k": [1, 2]}, null] ', [1, 22, 'a"b', {'k': [1, 2]}, None]),
+    ('["\u00e9\u20ac"]'.encode('utf-8'), ['\u00e9\u20ac']),
+    (b'[1.5, 2e3, -0.25E-2, 10.25, 3E+2, true]', [1.5, 2e3, -0.25e-2, 10.25, 3e2, True]),
+    (b'[10.25]', [10.25]),
+])
+def test_iter_json_items(body, expected):
+    for chunk_size in (1, 2, 3, 4, 1024):
+        request = Request(EnvironBuilder(method='POST', data=body).get_environ())
+        assert list(iter_json_items(request, chunk_size=chunk_size)) == expected
+
+
+@pytest.mark.parametrize('body', [b'{"a": 1}', b'[1, 2', b'[1 2]', b'[1] 2'])
+def test_iter_json_items_malformed(body):
+    request = Request(EnvironBuilder(method='POST', data=body).get_environ())
+    with pytest.raises(HttpMalformedJSON):
+        list(iter_json_items(request, chunk_size=2))
+
+
+def test_iter_json_items_lookahead():
+    stream = io.BytesIO(b'[1, {"a": ' + b' ' * 1000 + b'1}]')
+    request = Request(EnvironBuilder(method='POST', input_stream=stream).get_environ())
+    items = iter_json_items(request, chunk_size=16, max_item_size=64)
+    assert next(items) == 1
+    with pytest.raises(HttpMalformedJSON):
+        next(items)
+    # the rest of the body isn't buffered
+    assert stream.tell() < 128
+
+    request = Request(EnvironBuilder(method='POST', data=b'[1.]').get_environ())
+    with pytest.raises(HttpMalformedJSON):
+        list(iter_json_items(request, chunk_size=2))
+
+
+@pytest.mark.parametrize('count', [0, 1, 25, 1000])
+def test_stream_response(web_session, count):
+    rv = web_session.get('/export', params={'count': count})
+    assert rv.status_code == 200
+    assert rv.headers['Transfer-Encoding'] == 'chunked'
+    assert rv.headers['Access-Control-Allow-Origin'] == '*'
+    assert rv.json() == [{'id': i} for i in range(count)]
+
+
+def test_stream_response_ndjson(web_session):
+    rv = web_session.get('/export', params={'count': 25, 'format': 'ndjson'})
+    assert rv.headers['Content-Type'] == 'application/x-ndjson'
+    lines = rv.content.decode('utf-8').splitlines()
+    assert [json.loads(line) for line in lines] == [{'id': i} for i in range(25)]
+
+
+@pytest.mark.parametrize('encoding', ['gzip', 'deflate'])
+@pytest.mark.parametrize('stream', ['', '1'])
+def test_compression(web_session, encoding, stream):
+    rv = web_session.get(
+        '/compressed',
+        params={'count': 100, 'stream': stream},
+        headers={'Accept-Encoding': encoding},
+    )
+    assert rv.headers['Content-Encoding'] == encoding
+    assert rv.headers['Vary'] == 'Accept-Encoding'
+    assert rv.json() == [{'id': i} for i in range(100)]
+
+
+def test_compression_below_min_size(web_session):
+    rv = web_session.get(
+        '/compressed', params={'count': 1}, headers={'Accept-Encoding': 'gzip'}
+    )
+    assert 'Content-Encoding' not in rv.headers
+    assert rv.headers['Vary'] == 'Accept-Encoding'
+
+
+def test_compression_not_accepted(web_session):
+    rv = web_session.get(
+        '/compressed', params={'count': 100}, headers={'Accept-Encoding': 'identity'}
+    )
+    assert 'Content-Encoding' not in rv.headers
+    assert rv.json() == [{'id': i} for i in range(100)]
+
+
+def test_etag(web_session):
+    rv = web_session.get('/etag', params={'value': 'foo'})
+    assert rv.status_code == 200
+    etag = rv.headers['ETag']
+
+    rv = web_session.get('/etag', params={'value': 'foo'}, headers={'If-None-Match': etag})
+    assert rv.status_code == 304
+    assert rv.content == b''
+    assert rv.headers['ETag'] == etag
+
+    rv = web_session.get('/etag', params={'value': 'bar'}, headers={'If-None-Match': etag})
+    assert rv.status_code == 200
+    assert rv.headers['ETag'] != etag
+
+
+def test_etag_weak_when_compressed(web_session):
+    rv = web_session.get(
+        '/etag', params={'value': 'x' * 2000}, headers={'Accept-Encoding': 'gzip'}
+    )
+    assert rv.headers['Content-Encoding'] == 'gzip'
+    etag = rv.headers['ETag']
+    assert etag.startswith('W/')
+
+    rv = web_session.get(
+        '/etag', params={'value': 'x' * 2000}, headers={'If-None-Match': etag}
+    )
+    assert rv.status_code == 304
+
+
+def test_version_key(web_session):
+    del CALLS[:]
+    rv = web_session.get('/versioned/1')
+    assert rv.status_code == 200
+    assert rv.headers['ETag'] == '"v1"'
+    assert CALLS == ['versioned']
+
+    rv = web_session.get('/versioned/1', headers={'If-None-Match': '"v1"'})
+    assert rv.status_code == 304
+    assert rv.headers['ETag'] == '"v1"'
+    assert CALLS == ['versioned']
+
+    rv = web_session.get('/versioned/2', headers={'If-None-Match': '"v1"'})
+    assert rv.status_code == 200
+    assert CALLS == ['versioned', 'versioned']
+
+
+def test_response_cache(web_session):
+    del CALLS[:]
+    for _ in range(3):
+        rv = web_session.get('/cached/1')
+        assert rv.json() == {'key': 1, 'language': None}
+    rv = web_session.get('/cached/1', headers={'Accept-Language': 'el'})
+    assert rv.json() == {'key': 1, 'language': 'el'}
+    assert rv.headers['Vary'] == 'Accept-Language'
+    rv = web_session.get('/cached/1', params={'page': 2})
+    assert CALLS == [1, 1, 1]
+
+    rv = web_session.delete('/cached/1')
+    assert rv.json() == {
+        'entries': 0, 'bytes': 0, 'hits': 2, 'misses': 3, 'evictions': 0
+    }
+    web_session.get('/cached/1')
+    assert CALLS == [1, 1, 1, 1]
+
+
+def test_response_cache_eviction():
+    cache = ResponseCache(max_entries=2, max_bytes=1024)
+    for i in range(3):
+        cache.set(('GET', '/{}'.format(i), b'', ()), api_response(data=i), ttl=10)
+    assert len(cache) == 2
+    assert cache.get(('GET', '/0', b'', ())) is None
+    assert cache.get(('GET', '/2', b'', ())).body == b'2'
+    assert cache.stats()['evictions'] == 1
+
+    cache.set(('GET', '/big', b'', ()), api_response(data='x' * 2048), ttl=10)
+    assert cache.get(('GET', '/big', b'', ())) is None
+
+    cache.set(('GET', '/expired', b'', ()), api_response(data=1), ttl=-1)
+    assert cache.get(('GET', '/expired', b'', ())) is None
+
+
+def test_coalesce(web_session):
+    del CALLS[:]
+    pool = eventlet.GreenPool()
+    responses = list(pool.imap(lambda _: web_session.get('/coalesced'), range(5)))
+    assert CALLS == ['coalesced']
+    assert [rv.json() for rv in responses] == [{'calls': 1, 'user': None}] * 5
+
+    web_session.get('/coalesced')
+    assert CALLS == ['coalesced', 'coalesced']
+
+
+def test_coalesce_per_user(web_session):
+    del CALLS[:]
+    pool = eventlet.GreenPool()
+    users = ['Bearer alice', 'Bearer bob', 'Bearer alice']
+    responses = list(pool.imap(
+        lambda user: web_session.get('/coalesced', headers={'Authorization': user}), users,
+    ))
+    assert [rv.json()['user'] for rv in responses] == users
+    assert CALLS == ['coalesced', 'coalesced']
+
+    list(pool.imap(
+        lambda cookie: web_session.get('/coalesced', headers={'Cookie': cookie}),
+        ['session=1', 'session=2'],
+    ))
+    assert CALLS == ['coalesced'] * 4
+
+
+def test_single_flight_timeout():
+    single_flight = SingleFlight()
+    calls = []
+
+    def handler():
+        calls.append(1)
+        count = len(calls)
+        eventlet.sleep(0.1)
+        return api_response(data=count)
+
+    leader = eventlet.spawn(single_flight.do, 'key', handler)
+    eventlet.sleep(0)
+    follower = single_flight.do('key', handler, timeout=0.01)
+    assert follower.get_data() == b'2'
+    assert leader.wait().get_data() == b'1'
+    assert single_flight.stats() == {'in_flight': 0, 'leaders': 1, 'followers': 0}
+
+
+@pytest.mark.parametrize('accept, expected', [
+    ('application/json, text/plain, */*', True),
+    ('text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8', True),
+    ('application/xml', False),
+    ('application/json;q=0', False),
+    ('not a media type', False),
+])
+def test_client_accepts_json(accept, expected):
+    assert client_accepts_json(accept) is expected
+
+
+def test_negotiation_cache_info():
+    accept = 'application/json, text/plain, */*'
+    serialization.negotiate_media_type(accept)
+    hits = negotiation_cache_info()['negotiate_media_type']['hits']
+    assert serialization.negotiate_media_type(accept) == 'application/json'
+    assert negotiation_cache_info()['negotiate_media_type']['hits'] == hits + 1
+    assert set(negotiation_cache_info()) == {'negotiate_media_type', 'content_media_type'}
+
+
+@pytest.mark.parametrize('content_type, expected', [
+    ('application/json', True),
+    ('Application/JSON; charset=utf-8', True),
+    ('application/merge-patch+json', True),
+    ('text/plain', False),
+    (None, False),
+])
+def test_is_json_request(content_type, expected):
+    assert is_json_request(content_type) is expected
+
+
+def test_metrics(web_session):
+    web_session.get('/foo/1')
+    web_session.get('/foo/2')
+    web_session.get('/foo/3', headers={'Accept': 'application/xml'})
+    web_session.post('/echo', json={'value': 1})
+
+    rv = web_session.get('/metrics')
+    assert rv.status_code == 200
+    assert rv.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+    lines = rv.text.splitlines()
+
+    labels = 'service="exampleservice",route="/foo/<int:bar>",method="GET"'
+    assert 'http_requests_total{{{},status="2xx"}} 2'.format(labels) in lines
+    assert 'http_requests_total{{{},status="4xx"}} 1'.format(labels) in lines
+    assert (
+        'http_request_duration_seconds_bucket{{{},status="2xx",le="+Inf"}} 2'.format(labels)
+        in lines
+    )
+    assert 'http_request_queue_seconds_count{{{}}} 2'.format(labels) in lines
+    assert 'http_request_handler_seconds_count{{{}}} 2'.format(labels) in lines
+    assert 'http_requests_in_flight{{{}}} 0'.format(labels) in lines
+    assert (
+        'http_request_body_bytes_total{service="exampleservice",route="/echo",method="POST"} 12'
+        in lines
+    )
+
+
+def test_metrics_series_unique(web_session):
+    web_session.get('/cached/1')
+    web_session.delete('/cached/1')
+    rv = web_session.get('/export', params={'count': 100})
+
+    lines = web_session.get('/metrics').text.splitlines()
+    series = [line.rsplit(' ', 1)[0] for line in lines if not line.startswith('#')]
+    assert len(series) == len(set(series))
+
+    # entrypoints of the methods of a route share its metrics
+    route = 'service="exampleservice",route="/cached/<int:key>"'
+    assert 'http_requests_in_flight{{{},method="GET"}} 0'.format(route) in lines
+    assert 'http_requests_in_flight{{{},method="DELETE"}} 0'.format(route) in lines
+
+    # streamed bodies are counted as they are sent
+    sent = [
+        line for line in lines if line.startswith(
+            'http_response_body_bytes_total{service="exampleservice",route="/export"'
+        )
+    ]
+    assert int(sent[0].rsplit(' ', 1)[1]) >= len(rv.content)
+
+
+def test_admission(web_session):
+    pool = eventlet.GreenPool()
+    responses = list(pool.imap(lambda _: web_session.get('/admission'), range(4)))
+    statuses = sorted(rv.status_code for rv in responses)
+    assert statuses == [200, 200, 503, 503]
+
+    shed = [rv for rv in responses if rv.status_code == 503]
+    assert shed[0].headers['Retry-After'] == '1'
+    assert shed[0].json() == {
+        'error_code': 'SERVICE_UNAVAILABLE', 'reason': 'Too many requests queued'
+    }
+
+    lines = web_session.get('/metrics').text.splitlines()
+    assert 'http_admission_admitted_total{limiter="/admission"} 2' in lines
+    assert 'http_admission_shed_total{limiter="/admission"} 2' in lines
+
+
+def test_limiter_max_queue_time():
+    limiter = Limiter('test', max_concurrency=1, max_queue_time=0.01, retry_after=5)
+    with limiter:
+        with pytest.raises(HttpServiceUnavailable) as exc:
+            limiter.acquire()
+    assert exc.value.headers == {'Retry-After': '5'}
+    assert limiter.stats() == {
+        'in_flight': 0, 'queued': 0, 'admitted': 1, 'shed': 1, 'utilisation': 0.0
+    }
+
+
+def test_pool(web_session):
+    pool = eventlet.GreenPool()
+    daily = pool.spawn(web_session.get, '/reports/daily')
+    eventlet.sleep(0.02)
+    monthly = pool.spawn(web_session.get, '/reports/monthly')
+    other = pool.spawn(web_session.get, '/foo/1')
+
+    assert daily.wait().status_code == 200
+    assert monthly.wait().status_code == 503
+    assert other.wait().status_code == 200
+
+    lines = web_session.get('/metrics').text.splitlines()
+    assert 'http_admission_admitted_total{limiter="reports"} 1' in lines
+    assert 'http_admission_shed_total{limiter="reports"} 1' in lines
+    assert 'http_admission_utilisation{limiter="reports"} 0.0' in lines
+
+
+def test_rate_limit(web_session):
+    headers = {'X-Api-Key': 'foo'}
+    rv = web_session.get('/limited', headers=headers)
+    assert rv.status_code == 200
+    assert rv.headers['X-RateLimit-Limit'] == '2'
+    assert rv.headers['X-RateLimit-Remaining'] == '1'
+
+    rv = web_session.get('/limited', headers=headers)
+    assert rv.status_code == 200
+    assert rv.headers['X-RateLimit-Remaining'] == '0'
+    assert rv.headers['X-RateLimit-Reset'] == '30'
+
+    rv = web_session.get('/limited', headers=headers)
+    assert rv.status_code == 429
+    assert rv.headers['Retry-After'] == '30'
+    assert rv.json() == {'error_code': 'TOO_MANY_REQUESTS', 'reason': 'Rate limit exceeded'}
+
+    rv = web_session.get('/limited', headers={'X-Api-Key': 'bar'})
+    assert rv.status_code == 200
+
+
+def test_token_bucket_store():
+    store = TokenBucketStore(rate=1.0, burst=2, max_keys=2)
+    assert store.consume('a', now=0) == (True, 1, 0)
+    assert store.consume('a', now=0) == (True, 0, 1.0)
+    assert store.consume('a', now=0.5) == (False, 0, 0.5)
+    assert store.consume('a', now=1.5) == (True, 0, 0.5)
+
+    store.consume('b', now=1.5)
+    store.consume('c', now=1.5)
+    assert len(store) == 2
+
+    # idle buckets are full again, and dropped
+    store.consume('d', now=10)
+    assert len(store) == 1
+
+
+def test_batch(web_session):
+    rv = web_session.post('/batch', json=[
+        {'method': 'GET', 'path': '/foo/1'},
+        {'method': 'POST', 'path': '/echo', 'body': {'value': 2}},
+        {'method': 'GET', 'path': '/foo/3', 'headers': {'Accept': 'application/xml'}},
+        {'method': 'GET', 'path': '/missing'},
+    ], headers={'Accept': 'application/json'})
+    assert rv.status_code == 200
+
+    results = rv.json()
+    assert [result['status'] for result in results] == [200, 200, 406, 404]
+    assert results[0]['body'] == {'value': 1}
+    assert results[1]['body'] == {'value': 2}
+    assert results[2]['body']['error_code'] == 'NOT_ACCEPTABLE'
+    assert results[3]['body']['error_code'] == 'NOT_FOUND'
+
+
+def test_batch_errors(web_session):
+    rv = web_session.post('/batch', json=[{'path': '/foo/1'}] * 5)
+    assert rv.status_code == 413
+    assert rv.json()['error_code'] == 'PAYLOAD_TOO_LARGE'
+
+    rv = web_session.post('/batch', json={'path': '/foo/1'})
+    assert rv.status_code == 400
+    assert rv.json()['error_code'] == 'BAD_BATCH'
+
+    assert web_session.get('/batch').status_code == 405
+
+    rv = web_session.post('/batch', json=[{'method': 'GET'}, {'path': '/batch'}])
+    assert [result['status'] for result in rv.json()] == [400, 400]
+
+    rv = web_session.post('/batch', json=[{'path': '/malformed'}])
+    assert rv.json() == [{'status': 500, 'headers': {}, 'body': {
+        'error_code': 'UNEXPECTED_ERROR',
+        'reason': 'Could not decode the sub-request response body',
+    }}]
+
+
+def test_batch_body_size_limit(web_session):
+    items = [{'method': 'POST', 'path': '/echo', 'body': {'value': 'x' * 1024}}]
+    rv = web_session.post('/batch', json=items)
+    assert rv.status_code == 413
+    assert rv.json()['error_code'] == 'PAYLOAD_TOO_LARGE'
+
+    rv = web_session.post('/batch', data=iter([json.dumps(items).encode()]), headers={
+        'Content-Type': 'application/json',
+    })
+    assert rv.status_code == 413
+
+
+def test_batch_sub_request_encoding(web_session):
+    rv = web_session.post('/batch', json=[
+        {'path': '/compressed?count=50', 'headers': {'Accept-Encoding': 'gzip'}},
+    ])
+    [result] = rv.json()
+    assert result['status'] == 200
+    assert 'Content-Encoding' not in result['headers']
+    assert result['body'] == [{'id': i} for i in range(50)]
+
+
+def test_health(web_session):
+    rv = web_session.get('/health')
+    assert rv.status_code == 200
+    health = rv.json()
+    assert health['status'] == 'ok'
+    assert health['in_flight'] == 1
+    assert health['requests'] >= 1
+
+
+def test_port_in_use(container_factory, web_config):
+    config = dict(web_config, HTTP_POOLS={'reports': 1})
+    container_factory(ExampleService, config).start()
+
+    # a second instance on the same port fails rather than sharing it
+    with pytest.raises(OSError):
+        container_factory(ExampleService, config).start()
+
+
+def test_drain(container_factory, web_config, web_config_port):
+    config = dict(
+        web_config,
+        HTTP_POOLS={'reports': 1},
+        HTTP_SERVER={'health_path': '/health', 'keepalive': 5},
+    )
+    container = container_factory(ExampleService, config)
+    container.start()
+    server = get_extension(container, WebServer)
+    assert server.keepalive == 5
+
+    pool = eventlet.GreenPool()
+    slow = pool.spawn(requests.get, 'http://127.0.0.1:{}/coalesced'.format(web_config_port))
+    with eventlet.Timeout(1):
+        while not server.in_flight:
+            eventlet.sleep(0.01)
+
+    stopping = pool.spawn(container.stop)
+    eventlet.sleep(0.02)
+    assert server.health_response().status_code == 503
+
+    assert slow.wait().status_code == 200
+    stopping.wait()
+    assert server.in_flight == 0
+
+
+def test_unknown_server_option(container_factory, web_config):
+    config = dict(web_config, HTTP_POOLS={'reports': 1}, HTTP_SERVER={'workers': 4})
+    with pytest.raises(ConfigurationError):
+        container_factory(ExampleService, config).start()
+
+
+def test_schema(web_session):
+    rv = web_session.post('/validated', json={'name': 'item', 'price': 10, 'tags': ['a']})
+    assert rv.status_code == 200
+    assert rv.json() == {'name': 'item', 'price': 10, 'tags': ['a']}
+
+    del CALLS[:]
+    rv = web_session.post('/validated', json={'price': 'free', 'tags': ['a', 1]})
+    assert rv.status_code == 400
+    assert rv.json() == {
+        'error_code': 'VALIDATION_ERROR',
+        'reason': 'Request body does not match the schema',
+        'errors': [
+            {'path': 'name', 'message': 'Field is required'},
+            {'path': 'price', 'message': 'Expected number'},
+            {'path': 'tags[1]', 'message': 'Expected string'},
+        ],
+    }
+    assert CALLS == []
+
+    rv = web_session.post('/validated', data=b'', headers={'Content-Type': 'application/json'})
+    assert rv.json()['error_code'] == 'VALIDATION_ERROR'
+
+
+def test_schema_body_methods(web_session):
+    # only bodies of POST, PUT and PATCH requests are validated
+    rv = web_session.get('/items')
+    assert rv.json() == {'method': 'GET'}
+
+    assert web_session.post('/items', json={}).status_code == 400
+    assert web_session.post('/items', json={'name': 'item'}).json() == {'method': 'POST'}
+
+
+def test_schema_spec():
+    validator = SchemaValidator({'id': int, 'owner?': {'name': str}, 'flag': (bool, type(None))})
+    assert validator.errors({'id': 1, 'flag': None}) == []
+    assert validator.errors({'id': True, 'owner': {}, 'flag': 1}) == [
+        {'path': 'id', 'message': 'Expected integer'},
+        {'path': 'owner.name', 'message': 'Field is required'},
+        {'path': 'flag', 'message': 'Expected boolean or null'},
+    ]
+    assert validator.errors([]) == [{'path': '', 'message': 'Expected object'}]
+
+    with pytest.raises(ConfigurationError):
+        SchemaValidator({'tags': [str, int]})
+
+
+def test_json_schema_needs_jsonschema(monkeypatch):
+    monkeypatch.setattr(schema, 'jsonschema', None)
+    with pytest.raises(ConfigurationError):
+        SchemaValidator({'type': 'object', 'properties': {'id': {'type': 'integer'}}})
+
+
+ITEM_JSON_SCHEMA = {
+    '$schema': 'http://json-schema.org/draft-07/schema#',
+    'type': 'object',
+    'properties': {
+        'name': {'type': 'string'},
+        'tags': {'type': 'array', 'items': {'type': 'string'}},
+    },
+    'required': ['name'],
+}
+
+
+@pytest.mark.skipif(jsonschema is None, reason='jsonschema is not installed')
+def test_json_schema():
+    validator = SchemaValidator(ITEM_JSON_SCHEMA)
+    assert validator.errors({'name': 'item', 'tags': ['a']}) == []
+    errors = validator.errors({'tags': ['a', 1]})
+    assert sorted(errors, key=lambda error: error['path']) == [
+        {'path': '', 'message': "'name' is a required property"},
+        {'path': 'tags[1]', 'message': "1 is not of type 'string'"},
+    ]
+
+    with pytest.raises(ConfigurationError):
+        SchemaValidator({'type': 'object', 'properties': {'id': {'minimum': 'a'}}})
+
+
+class JsonSchemaService(object):
+    name = 'jsonschemaservice'
+
+    @api('POST', '/items', schema=ITEM_JSON_SCHEMA)
+    def create_item(self, request):
+        return api_response(status=201, data=get_json(request))
+
+
+@pytest.mark.skipif(jsonschema is None, reason='jsonschema is not installed')
+def test_json_schema_route(container_factory, web_config, web_config_port):
+    container_factory(JsonSchemaService, web_config).start()
+    url = 'http://127.0.0.1:{}/items'.format(web_config_port)
+
+    rv = requests.post(url, json={'name': 'item'})
+    assert rv.status_code == 201
+    assert rv.json() == {'name': 'item'}
+
+    rv = requests.post(url, json={'name': 1})
+    assert rv.status_code == 400
+    assert rv.json()['errors'] == [{'path': 'name', 'message': "1 is not of type 'string'"}]
+
+
+class PrefixCodec(object):
+    """Stand-in binary codec, json behind a marker byte."""
+    name = 'prefixed'
+
+    def dumps(self, obj):
+        return b'\x00' + json.dumps(obj).encode('utf-8')
+
+    def loads(self, data):
+        if data[:1] != b'\x00':
+            raise ValueError('Missing marker')
+        return json.loads(data[1:])
+
+
+@pytest.fixture
+def media_codecs():
+    codecs = serialization.MEDIA_CODECS.copy()
+    yield
+    serialization.MEDIA_CODECS.clear()
+    serialization.MEDIA_CODECS.update(codecs)
+    serialization.negotiate_media_type.cache_clear()
+    serialization.content_media_type.cache_clear()
+
+
+@pytest.fixture
+def prefix_codec(media_codecs):
+    # registered before the service starts, which takes the default codecs
+    serialization.register_media_codec('application/x-prefixed', PrefixCodec())
+    return PrefixCodec()
+
+
+@pytest.mark.parametrize('accept, expected', [
+    ('application/json', 'application/json'),
+    ('*/*', 'application/json'),
+    ('application/x-prefixed', 'application/x-prefixed'),
+    ('application/json;q=0.5, application/x-prefixed', 'application/x-prefixed'),
+    ('application/x-prefixed;q=0.1, application/*', 'application/json'),
+    ('text/html', None),
+])
+def test_negotiate_media_type(prefix_codec, accept, expected):
+    assert serialization.negotiate_media_type(accept) == expected
+
+
+def test_media_codecs(prefix_codec, web_session):
+    headers = {'Accept': 'application/x-prefixed', 'Content-Type': 'application/x-prefixed'}
+    rv = web_session.post('/echo', data=prefix_codec.dumps({'value': 1}), headers=headers)
+    assert rv.status_code == 200
+    assert rv.headers['Content-Type'] == 'application/x-prefixed'
+    assert 'Accept' in rv.headers['Vary']
+    assert prefix_codec.loads(rv.content) == {'value': 1}
+
+    rv = web_session.post('/validated', data=prefix_codec.dumps({}), headers=headers)
+    assert rv.status_code == 400
+    assert prefix_codec.loads(rv.content)['error_code'] == 'VALIDATION_ERROR'
+
+    rv = web_session.get('/foo/1', headers={'Accept': 'text/html'})
+    assert rv.status_code == 406
+    assert rv.json()['reason'] == 'Only responses encoded as json or prefixed supported'
+
+    rv = web_session.post('/echo', data='a,b', headers={'Content-Type': 'text/csv'})
+    assert rv.status_code == 415
+    assert rv.json()['reason'] == 'JSON or PREFIXED payload expected'
+
+
+def test_media_codecs_cache(prefix_codec, web_session):
+    rv = web_session.get('/cached/7')
+    assert rv.json()['key'] == 7
+    rv = web_session.get('/cached/7', headers={'Accept': 'application/x-prefixed'})
+    assert prefix_codec.loads(rv.content)['key'] == 7
+
+
+def test_optional_media_codecs(web_session, media_codecs):
+    # installed codecs aren't served unless enabled
+    assert list(serialization.MEDIA_CODECS) == ['application/json']
+    rv = web_session.get('/foo/1', headers={'Accept': 'application/msgpack'})
+    assert rv.status_code == 406
+    assert rv.json()['reason'] == 'Only responses encoded as json supported'
+
+    with pytest.raises(ConfigurationError):
+        MediaCodecs.from_config({'HTTP_MEDIA_CODECS': ['cbor']})
+
+
+def test_media_codecs_encode():
+    response = api_response(data={'value': 1})
+    json_codecs = MediaCodecs(serialization.get_codec('json'))
+    assert response.encode('application/json', json_codecs).get_data() == b'{"value":1}'
+    assert response.codec == json_codecs.media_codec('application/json')
+    # encoded alike, not encoded again
+    assert response.codec == serialization.JsonMediaCodec(serialization.JsonCodec())
+
+
+@pytest.mark.skipif(serialization.msgpack is None, reason='msgpack is not installed')
+def test_msgpack(container_factory, web_config, web_config_port, media_codecs):
+    msgpack = serialization.msgpack
+    config = dict(web_config, HTTP_POOLS={'reports': 1}, HTTP_MEDIA_CODECS=['msgpack'])
+    container_factory(ExampleService, config).start()
+    url = 'http://127.0.0.1:{}'.format(web_config_port)
+
+    payload = {'value': 1, 'items': [1.5, 'two', None, True], 'nested': {'key': -2}}
+    rv = requests.post(url + '/echo', data=msgpack.packb(payload), headers={
+        'Accept': 'application/msgpack', 'Content-Type': 'application/msgpack',
+    })
+    assert rv.status_code == 200
+    assert rv.headers['Content-Type'] == 'application/msgpack'
+    assert msgpack.unpackb(rv.content) == payload
+
+    rv = requests.get(url + '/typed', headers={'Accept': 'application/x-msgpack'})
+    assert msgpack.unpackb(rv.content) == {
+        'when': '2019-07-10T12:30:00',
+        'id': '00000000-0000-0000-0000-000000000001',
+        'amount': '10.50',
+    }
+
+    rv = requests.post(url + '/echo', data=b'\xc1', headers={
+        'Accept': 'application/msgpack', 'Content-Type': 'application/msgpack',
+    })
+    assert rv.status_code == 753
+    assert msgpack.unpackb(rv.content)['error_code'] == 'MALFORMED_JSON'
+
+    rv = requests.get(url + '/foo/1', headers={'Accept': 'text/html'})
+    assert rv.json()['reason'] == 'Only responses encoded as json or msgpack supported'
+
+
+@pytest.mark.skipif(serialization.msgpack is None, reason='msgpack is not installed')
+def test_media_codecs_per_service(container_factory, web_config, web_config_port):
+    # two services of a runner, only the first of which serves msgpack
+    config = dict(web_config, HTTP_POOLS={'reports': 1}, HTTP_MEDIA_CODECS=['msgpack'])
+    container_factory(ExampleService, config).start()
+    other_port = find_free_port()
+    other_config = dict(
+        web_config, HTTP_POOLS={'reports': 1}, HTTP_JSON_CODEC='json',
+        WEB_SERVER_ADDRESS='127.0.0.1:{}'.format(other_port),
+    )
+    container_factory(ExampleService, other_config).start()
+
+    headers = {'Accept': 'application/msgpack'}
+    rv = requests.get('http://127.0.0.1:{}/foo/1'.format(web_config_port), headers=headers)
+    assert rv.headers['Content-Type'] == 'application/msgpack'
+    rv = requests.get('http://127.0.0.1:{}/foo/1'.format(other_port), headers=headers)
+    assert rv.status_code == 406
+    assert rv.json()['reason'] == 'Only responses encoded as json supported'
+    assert list(serialization.MEDIA_CODECS) == ['application/json']
+
+
+def test_compiled_router():
+    url_map = Map([
+        Rule('/items', endpoint='list', methods=['GET']),
+        Rule('/items', endpoint='create', methods=['POST']),
+        Rule('/items/new', endpoint='new', methods=['GET']),
+        Rule('/items/<int:item_id>', endpoint='get', methods=['GET']),
+        Rule('/items/<int:item_id>', endpoint='update', methods=['PUT']),
+        Rule('/<slug>/about', endpoint='about', methods=['GET']),
+        Rule('/users/', endpoint='users', methods=['GET']),
+    ])
+    router = CompiledRouter(url_map)
+
+    assert router.match('/items', 'GET') == ('list', {})
+    assert router.match('/items', 'HEAD') == ('list', {})
+    assert router.match('/items', 'POST') == ('create', {})
+    assert router.match('/items/new', 'GET') == ('new', {})
+    assert router.match('/items/7', 'GET') == ('get', {'item_id': 7})
+    assert router.match('/items/7', 'PUT') == ('update', {'item_id': 7})
+    assert router.match('/items/about', 'GET') == ('about', {'slug': 'items'})
+    assert router.match('/team/about', 'GET') == ('about', {'slug': 'team'})
+
+    # 404, 405 and redirects are left to the url map
+    assert router.match('/items/7', 'DELETE') is None
+    assert router.match('/missing', 'GET') is None
+    assert router.match('/users', 'GET') is None
+
+
+def test_compiled_router_shared_prefix():
+    url_map = Map([
+        Rule('/api/users/<int:user_id>', endpoint='user', methods=['GET']),
+        Rule('/api/users/<int:user_id>/orders', endpoint='orders', methods=['GET']),
+        Rule('/api/<resource>/count', endpoint='count', methods=['GET']),
+        Rule('/api/v2/<path:rest>', endpoint='v2', methods=['GET']),
+        Rule('/<slug>/about', endpoint='about', methods=['GET']),
+    ])
+    adapter = url_map.bind('localhost')
+    router = CompiledRouter(url_map)
+
+    # rules are indexed by their static prefix
+    users = router.root.children['api'].children['users']
+    assert sorted(rule.endpoint for rule in users.rules) == ['orders', 'user']
+
+    for path in (
+            '/api/users/1', '/api/users/1/orders', '/api/users/count', '/api/items/count',
+            '/api/v2/a/b', '/api/about', '/api/v2/about'):
+        assert router.match(path, 'GET') == adapter.match(path, 'GET'), path
+    assert router.match('/api/users/about', 'GET') is None
+
+
+def test_compiled_router_fallback(web_session):
+    assert web_session.get('/foo/abc').status_code == 404
+    assert web_session.delete('/foo/1').status_code == 405
+
+
+def make_request(**kwargs):
+    builder = EnvironBuilder(**kwargs)
+    return Request(builder.get_environ())
+
+
+def test_profiler(tmpdir):
+    profiler = Profiler(str(tmpdir), token='secret', max_files=2)
+
+    assert profiler.start(make_request(headers={'X-Debug-Profile': 'wrong'})) is None
+
+    for _ in range(3):
+        request = make_request(headers={'X-Debug-Profile': 'secret'})
+        session = profiler.start(request)
+        sum(range(1000))
+        session.stop()
+        profiler.save(session, '/foo/<int:bar>', request, 200, 0.01)
+
+    files = sorted(tmpdir.listdir())
+    assert len(files) == 2
+    assert all(f.basename.endswith('-GET-foo_int_bar-200-10ms.pstats') for f in files)
+
+
+def test_profiler_slow_requests(tmpdir):
+    profiler = Profiler(str(tmpdir), slow_threshold=0.05, sample_interval=0.001)
+    request = make_request()
+
+    fast = profiler.start(request)
+    fast.stop()
+    profiler.save(fast, '/fast', request, 200, 0.001)
+    assert tmpdir.listdir() == []
+
+    slow = profiler.start(request)
+    deadline = time.process_time() + 0.05
+    while time.process_time() < deadline:
+        pass
+    slow.stop()
+    profiler.save(slow, '/slow', request, 200, 0.05)
+
+    [folded] = tmpdir.listdir()
+    assert folded.basename.endswith('.folded')
+    assert 'test_profiler_slow_requests' in folded.read()
+    assert profiler.sampler.watchers == 0
+
+
+def test_stack_sampler_between():
+    sampler = StackSampler(max_samples=3)
+    current, other = eventlet.getcurrent(), object()
+    for index in range(5):
+        sampler.samples.append((current if index != 3 else other, index))
+        sampler.count += 1
+    assert sampler.between(1, 4, {current}) == [2]
+    assert sampler.between(3, 5, {current, other}) == [3, 4]
+
+
+def test_profiler_request_greenlets(tmpdir):
+    profiler = Profiler(str(tmpdir), slow_threshold=0.05, sample_interval=0.001)
+
+    def busy():
+        deadline = time.process_time() + 0.05
+        while time.process_time() < deadline:
+            pass
+
+    # other requests running meanwhile are left out
+    session = profiler.start(make_request())
+    eventlet.spawn(busy).wait()
+    session.stop()
+    assert profiler.sampler.count > 0
+    assert session.samples == []
+
+    # green threads added to the session, such as workers, are kept
+    session = profiler.start(make_request())
+    worker = eventlet.spawn(busy)
+    session.add_greenlet(worker)
+    worker.wait()
+    session.stop()
+    assert session.samples
+    assert all(stack[-1].co_name == 'busy' for stack in session.samples)
+
+
+def test_profiling_config(container_factory, web_config, web_config_port, tmpdir):
+    config = dict(
+        web_config,
+        HTTP_POOLS={'reports': 1},
+        HTTP_PROFILING={'directory': str(tmpdir), 'token': 'secret'},
+    )
+    container_factory(ExampleService, config).start()
+
+    rv = requests.get('http://127.0.0.1:{}/foo/1'.format(web_config_port), headers={
+        'Accept': 'application/json', 'X-Debug-Profile': 'secret',
+    })
+    assert rv.status_code == 200
+    [profile] = tmpdir.listdir()
+    assert profile.basename.endswith('.pstats')
+
+
+def test_deadline(web_session):
+    rv = web_session.get('/deadline', headers={'X-Request-Timeout': '0.5'})
+    assert rv.status_code == 200
+    assert 0 < rv.json()['remaining'] <= 0.5
+
+    # capped by the timeout of the route
+    rv = web_session.get('/deadline', headers={'X-Request-Timeout': '30'})
+    assert 0.5 < rv.json()['remaining'] <= 1
+
+    rv = web_session.get('/deadline', headers={'X-Request-Timeout': 'soon'})
+    assert 0.5 < rv.json()['remaining'] <= 1
+
+
+def test_deadline_context_data():
+    data = with_deadline({'deadline_timeout': 2, 'user': 'a'})
+    assert 1.9 < time_remaining(data) <= 2
+    assert with_deadline(data) is data
+    assert with_deadline({}) == {}
+    assert time_remaining({}) is None
+
+    # copied with the budget left, as sent along with outgoing calls
+    data.deadline -= 0.5
+    sent = data.copy()
+    assert type(sent) is dict
+    assert sent['user'] == 'a'
+    assert 1.4 < sent['deadline_timeout'] <= 1.5
+
+    data.deadline -= 2
+    assert data.copy()['deadline_timeout'] == 0
+
+
+def test_worker_thread_fallback(container_factory, web_config, caplog):
+    container = container_factory(ExampleService, web_config)
+    assert get_worker_thread(container, object()) is None
+    assert caplog.text == ''
+
+    assert get_worker_thread(object(), object()) is None
+    assert "workers can't be cancelled" in caplog.text
+
+
+def test_deadline_cancels_worker(web_session):
+    del CALLS[:]
+    rv = web_session.get('/deadline?sleep=0.3', headers={'X-Request-Timeout': '0.1'})
+    assert rv.status_code == 504
+    assert rv.json()['error_code'] == 'GATEWAY_TIMEOUT'
+
+    eventlet.sleep(0.3)
+    assert CALLS == ['started']
+
+
+def test_deadline_exceeded_before_worker(web_session):
+    del CALLS[:]
+    rv = web_session.get('/deadline', headers={'X-Request-Timeout': '0.000001'})
+    assert rv.status_code == 504
+    assert rv.json()['reason'] == 'Request deadline exceeded before a worker started'
+    assert CALLS == []
+
+
+def test_idempotency_replay(web_session):
+    del CALLS[:]
+    headers = {'Idempotency-Key': 'order-1'}
+    rv = web_session.post('/orders', json={'item': 1}, headers=headers)
+    assert rv.status_code == 201
+    assert 'Idempotent-Replayed' not in rv.headers
+
+    replayed = web_session.post('/orders', json={'item': 1}, headers=headers)
+    assert replayed.status_code == 201
+    assert replayed.json() == rv.json()
+    assert replayed.headers['Idempotent-Replayed'] == 'true'
+    assert CALLS == ['order']
+
+    rv = web_session.post('/orders', json={'item': 2}, headers=headers)
+    assert rv.status_code == 422
+    assert rv.json()['error_code'] == 'IDEMPOTENCY_KEY_REUSED'
+
+    # requests without a key always run
+    web_session.post('/orders', json={'item': 1})
+    web_session.post('/orders', json={'item': 1})
+    assert CALLS == ['order'] * 3
+
+
+def test_idempotency_concurrent_duplicates(web_session):
+    del CALLS[:]
+    headers = {'Idempotency-Key': 'order-2'}
+    pool = eventlet.GreenPool()
+    responses = list(pool.imap(
+        lambda _: web_session.post('/orders?sleep=0.2', json={'item': 1}, headers=headers),
+        range(3),
+    ))
+    assert [rv.status_code for rv in responses] == [201] * 3
+    assert len({rv.text for rv in responses}) == 1
+    assert CALLS == ['order']
+
+
+def test_idempotency_server_errors_not_stored(web_session):
+    del CALLS[:]
+    headers = {'Idempotency-Key': 'order-3'}
+    for _ in range(2):
+        rv = web_session.post('/orders?fail=1', json={'item': 1}, headers=headers)
+        assert rv.status_code == 500
+    assert CALLS == ['order', 'order']
+
+
+def test_memory_idempotency_store():
+    store = MemoryIdempotencyStore(max_entries=2)
+    response = CachedResponse(201, [], b'{}')
+    store.set('a', 'fp', response, ttl=60)
+    store.set('b', 'fp', CachedResponse(201, [], b'{}'), ttl=60)
+    assert store.get('a') == ('fp', response)
+
+    store.set('c', 'fp', CachedResponse(201, [], b'{}'), ttl=60)
+    assert store.get('b') is None
+    assert len(store) == 2
+
+    store.set('d', 'fp', CachedResponse(201, [], b'{}'), ttl=-1)
+    assert store.get('d') is None
+
+
+def test_memory_idempotency_store_claims():
+    store = MemoryIdempotencyStore()
+    assert store.claim('a', ttl=60) is True
+    assert store.claim('a', ttl=60) is False
+    store.release('a')
+    assert store.claim('a', ttl=60) is True
+
+    store.set('a', 'fp', CachedResponse(201, [], b'{}'), ttl=60)
+    assert store.claim('a', ttl=60) is False
+
+    # claims of crashed processes expire
+    assert store.claim('b', ttl=-1) is True
+    assert store.claim('b', ttl=60) is True
+
+    class IncompleteStore(IdempotencyStore):
+        def get(self, key):
+            return None
+
+        def set(self, key, fingerprint, response, ttl):
+            pass
+
+    with pytest.raises(TypeError):
+        IncompleteStore()
+
+
+def test_idempotency_shared_store():
+    # rules of several processes, sharing a store
+    store = MemoryIdempotencyStore()
+    first, second = IdempotencyRule(wait_timeout=1), IdempotencyRule(wait_timeout=0.1)
+    request = make_request(method='POST', path='/orders', data=b'{}')
+    calls = []
+
+    def handler():
+        calls.append(1)
+        eventlet.sleep(0.2)
+        return Response('{}', status=201)
+
+    thread = eventlet.spawn(first.replay, 'key', request, handler, store)
+    eventlet.sleep(0)
+    with pytest.raises(HttpIdempotencyKeyInUse):
+        second.replay('key', request, handler, store)
+
+    third = IdempotencyRule(wait_timeout=1)
+    replayed = third.replay('key', request, handler, store)
+    assert thread.wait().status_code == 201
+    assert replayed.headers['Idempotent-Replayed'] == 'true'
+    assert calls == [1]
+
+    # keys whose response isn't stored are released
+    failing = IdempotencyRule()
+    failing.replay('other', request, lambda: Response(status=500), store)
+    assert store.claim('other', ttl=60) is True
+
+
+def test_upload(web_session):
+    body = b'blob' * 100
+    rv = web_session.put('/blobs', data=body, headers={
+        'Content-Type': 'application/octet-stream',
+    })
+    assert rv.status_code == 200
+    assert rv.json() == {
+        'size': 400, 'in_memory': True, 'head': 'blob',
+        'digests': {
+            'sha256': hashlib.sha256(body).hexdigest(), 'md5': hashlib.md5(body).hexdigest(),
+        },
+    }
+
+    body = b'blob' * 1000
+    rv = web_session.put('/blobs?spool=1024', data=body)
+    assert rv.json()['in_memory'] is False
+    assert rv.json()['size'] == 4000
+    assert rv.json()['digests']['sha256'] == hashlib.sha256(body).hexdigest()
+
+
+def test_upload_body_size_limit(web_session):
+    rv = web_session.put('/blobs', data=b'x' * 5000)
+    assert rv.status_code == 413
+
+    # chunked bodies are cut off while being spooled
+    rv = web_session.put('/blobs', data=iter([b'x' * 1000] * 5))
+    assert rv.status_code == 413
+    assert rv.json()['error_code'] == 'PAYLOAD_TOO_LARGE'
+
+
+def test_upload_chunked(web_session):
+    rv = web_session.put('/blobs/unbounded', data=iter([b'x' * 1000] * 5))
+    assert rv.status_code == 200
+    assert rv.json() == {'size': 5000}
+
+    rv = web_session.put('/blobs', data=iter([b'x' * 1000] * 2))
+    assert rv.status_code == 200
+    assert rv.json()['size'] == 2000
+
+
+def test_read_upload_views():
+    request = Request(EnvironBuilder(method='PUT', data=b'0123456789').get_environ())
+    with read_upload(request, hashes=(), max_memory_size=4, chunk_size=3) as upload:
+        assert not upload.in_memory
+        view = upload.view()
+        assert bytes(view[2:5]) == b'234'
+        view.release()
+        assert upload.digests == {}
+
+    # bodies already read are spooled from memory
+    request = Request(EnvironBuilder(method='PUT', data=b'0123456789').get_environ())
+    read_body(request)
+    with read_upload(request) as upload:
+        assert upload.in_memory
+        assert upload.view() == b'0123456789'
+        assert upload.file.read() == b'0123456789'
+
+
+@pytest.mark.parametrize('max_memory_size', [1024, 4])
+def test_upload_closed_while_viewed(max_memory_size, caplog):
+    request = Request(EnvironBuilder(method='PUT', data=b'0123456789').get_environ())
+    with pytest.raises(KeyError):
+        with read_upload(request, max_memory_size=max_memory_size) as upload:
+            view = upload.view()
+            raise KeyError('handler error')
+    assert upload.file.closed
+    with pytest.raises(ValueError):
+        view[0]
+
+    # slices of views keep the body open until they are released
+    request = Request(EnvironBuilder(method='PUT', data=b'0123456789').get_environ())
+    with pytest.raises(KeyError):
+        with read_upload(request, max_memory_size=max_memory_size) as upload:
+            head = upload.view()[:2]
+            raise KeyError('handler error')
+    assert bytes(head) == b'01'
+    assert 'closed once released' in caplog.text
+
+
+def test_fan_out_runs_calls_concurrently():
+    del CALLS[:]
+    proxy = StandInProxy()
+    started_at = time.monotonic()
+    result = fan_out({
+        'a': Call(proxy.get, ('a', 0.1)),
+        'b': Call(proxy.get, ('b', 0.1)),
+        'c': partial(proxy.get, 'c'),
+    })
+    assert time.monotonic() - started_at < 0.19
+    assert result == {'a': 'a', 'b': 'b', 'c': 'c'}
+    assert result.complete
+    assert set(result.durations) == {'a', 'b', 'c'}
+
+
+def test_fan_out_partial_failures():
+    proxy = StandInProxy()
+    result = fan_out({
+        'a': Call(proxy.get, ('a',)),
+        'b': Call(proxy.get, ('b', 0, True), default=[]),
+        'c': Call(proxy.get, ('c', 1), timeout=0.05),
+    }, required=False)
+    assert result == {'a': 'a', 'b': [], 'c': None}
+    assert not result.complete
+    assert result.error_details() == [
+        {'call': 'b', 'error_code': 'BAD_GATEWAY',
+         'reason': "Call to `b` failed: ValueError('Service unavailable')"},
+        {'call': 'c', 'error_code': 'GATEWAY_TIMEOUT', 'reason': 'Call to `c` timed out'},
+    ]
+
+
+def test_fan_out_required_failure_kills_other_calls():
+    del CALLS[:]
+    proxy = StandInProxy()
+    with pytest.raises(HttpGatewayTimeout):
+        fan_out({
+            'fast': Call(proxy.get, ('fast', 0.01)),
+            'slow': Call(proxy.get, ('slow', 0.2), timeout=0.05),
+            'slower': Call(proxy.get, ('slower', 0.3), required=False),
+        })
+    eventlet.sleep(0.3)
+    assert CALLS == ['fast']
+
+    # the deadline caps every call
+    with pytest.raises(HttpGatewayTimeout):
+        fan_out({'slow': Call(proxy.get, ('slow', 0.2))}, deadline=time.monotonic() + 0.05)
+
+
+def test_fan_out_in_handler(web_session):
+    rv = web_session.get('/dashboard')
+    assert rv.status_code == 200
+    assert rv.json()['user'] == 'user'
+    assert rv.json()['offers'] == []
+    assert [error['call'] for error in rv.json()['errors']] == ['offers']
+
+    rv = web_session.get('/dashboard?fail=1')
+    assert rv.status_code == 502
+    assert rv.json() == {
+        'error_code': 'BAD_GATEWAY',
+        'reason': "Call to `user` failed: ValueError('Service unavailable')",
+    }
+
+
+def test_access_log_buffers_and_samples():
+    stream = io.BytesIO()
+    access_log = AccessLog(stream=stream, max_entries=3, sample_rates={'2xx': 0}, batch_size=2)
+    request = make_request(path='/foo/1', headers={'X-Request-Id': 'abc'})
+    request.request_id = access_log.request_id(request)
+
+    access_log.log(request, '/foo/<int:bar>', Response(status=200), 0.01)
+    for status in (404, 500, 503, 502):
+        access_log.log(request, '/foo/<int:bar>', Response(status=status), 0.01)
+    assert access_log.stats() == {
+        'buffered': 3, 'logged': 3, 'dropped': 1, 'sampled_out': 1, 'written': 0,
+    }
+
+    access_log.flush()
+    entries = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert [entry['status'] for entry in entries] == [404, 500, 503]
+    assert entries[0]['request_id'] == 'abc'
+    assert entries[0]['route'] == '/foo/<int:bar>'
+    assert entries[0]['path'] == '/foo/1'
+    assert access_log.stats()['written'] == 3
+
+
+def test_access_log_drop_oldest():
+    access_log = AccessLog(stream=io.BytesIO(), max_entries=2, overflow='drop_oldest')
+    request = make_request()
+    request.request_id = 'abc'
+    for status in (200, 201, 202):
+        access_log.log(request, '/', Response(status=status), 0)
+    assert [entry['status'] for entry in access_log.entries] == [201, 202]
+    assert access_log.dropped == 1
+
+    with pytest.raises(ConfigurationError):
+        AccessLog(stream=io.BytesIO(), overflow='block')
+
+
+@pytest.mark.parametrize('status_class', ['4xx', '5xx', '200'])
+def test_access_log_errors_not_sampled(status_class):
+    with pytest.raises(ConfigurationError):
+        AccessLog(stream=io.BytesIO(), sample_rates={status_class: 0.5})
+
+
+def test_access_log_kill(tmpdir, caplog):
+    access_log = AccessLog(path=str(tmpdir.join('access.log')), flush_interval=60)
+    access_log.start()
+    request = make_request()
+    request.request_id = 'abc'
+    access_log.log(request, '/', Response(status=200), 0)
+
+    file = access_log._file
+
+    def close():
+        raise OSError('Disk full')
+
+    file.close = close
+    access_log.kill()
+    assert access_log._gt is None
+    assert access_log.stats()['written'] == 0
+    assert 'Could not close the access log' in caplog.text
+    assert '1 entries dropped' in caplog.text
+    del file.close
+    file.close()
+
+
+def test_access_log_config(container_factory, web_config, web_config_port, tmpdir):
+    path = str(tmpdir.join('access.log'))
+    config = dict(
+        web_config,
+        HTTP_POOLS={'reports': 1},
+        HTTP_ACCESS_LOG={'path': path, 'flush_interval': 0.01},
+    )
+    container = container_factory(ExampleService, config)
+    container.start()
+
+    url = 'http://127.0.0.1:{}/foo/1'.format(web_config_port)
+    rv = requests.get(url, headers={'Accept': 'application/json', 'X-Request-Id': 'req-1'})
+    assert rv.headers['X-Request-Id'] == 'req-1'
+    rv = requests.get(url, headers={'Accept': 'application/json'})
+    generated = rv.headers['X-Request-Id']
+
+    eventlet.sleep(0.1)
+    with open(path) as fle:
+        entries = [json.loads(line) for line in fle]
+    assert [entry['request_id'] for entry in entries] == ['req-1', generated]
+    assert entries[0]['method'] == 'GET'
+    assert entries[0]['status'] == 200
+    assert entries[1]['bytes_out'] == int(rv.headers['Content-Length'])
+
+
+@pytest.fixture
+def fake_processes(monkeypatch):
+    """Replaces the process calls of the arbiter, ``waitpid`` returning the
+    given results in turn, or calling them first if callable.
+    """
+    pids = iter(range(101, 200))
+    calls = {'killed': [], 'waitpid': []}
+
+    def waitpid(pid, options):
+        result = calls['waitpid'].pop(0)
+        return result() if callable(result) else result
+
+    monkeypatch.setattr(prefork.os, 'fork', lambda: next(pids))
+    monkeypatch.setattr(prefork.os, 'waitpid', waitpid)
+    monkeypatch.setattr(prefork.os, 'kill', lambda pid, signum: calls['killed'].append(
+        (pid, signum)
+    ))
+    monkeypatch.setattr(prefork.signal, 'signal', lambda signum, handler: None)
+    monkeypatch.setattr(prefork.time, 'sleep', lambda seconds: None)
+    return calls
+
+
+def test_prefork_restarts_and_stops(fake_processes):
+    config = {
+        'WEB_SERVER_ADDRESS': '127.0.0.1:0',
+        'HTTP_SERVER': {'reuse_port': False, 'drain_timeout': 0},
+    }
+    arbiter = prefork.Arbiter(['module:Service'], config, processes=2)
+
+    def stop():
+        assert sorted(arbiter.children) == [102, 103]
+        arbiter.stop(signal.SIGTERM, None)
+        return 0, 0
+
+    fake_processes['waitpid'] = [(101, 256), (0, 0), stop, (102, 0), (104, 0), (103, 0)]
+    assert arbiter.run() == 0
+    assert fake_processes['killed'] == [(102, signal.SIGTERM), (103, signal.SIGTERM)]
+    assert arbiter.children == {}
+
+    # the port is bound once, the processes inheriting the socket
+    assert arbiter.config['HTTP_SERVER']['fd'] > 0
+    assert arbiter.sock.fileno() == -1
+
+
+def test_prefork_kills_after_drain_timeout(fake_processes):
+    arbiter = prefork.Arbiter(['module:Service'], {}, processes=1)
+
+    def stop():
+        arbiter.stop(signal.SIGTERM, None)
+        arbiter.kill_at = time.monotonic() - 1
+        return 0, 0
+
+    fake_processes['waitpid'] = [stop, (0, 0), (101, signal.SIGKILL)]
+    assert arbiter.run() == 0
+    assert fake_processes['killed'] == [(101, signal.SIGTERM), (101, signal.SIGKILL)]
+    # processes bind the port with SO_REUSEPORT
+    assert arbiter.sock is None
+    assert arbiter.config['HTTP_SERVER'] == {'reuse_port': True}
+
+
+def test_prefork_children_gone(fake_processes):
+    arbiter = prefork.Arbiter(['module:Service'], {}, processes=1)
+
+    def gone():
+        raise ChildProcessError()
+
+    fake_processes['waitpid'] = [gone]
+    assert arbiter.run() == 0